@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic documentation corpus for benchmarking sphinx-confluence
+
+Generates a Sphinx project with a nested page tree (and the matching
+confluence-publisher ``config.yml``), cross-references between pages, large
+code blocks, tables, images and autodoc'd modules for viewcode::
+
+    python benchmarks/corpus.py /tmp/corpus --pages 500 --modules 20
+
+"""
+
+import argparse
+import base64
+import io
+import json
+import os
+import random
+
+# 1x1 transparent PNG
+PNG = base64.b64decode(b'iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg==')
+
+CONF_PY = '''\
+import json
+import os
+import sys
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, 'src'))
+
+extensions = {extensions!r}
+master_doc = 'index'
+project = 'Benchmark corpus'
+sphinx_confluence_repo_path = {repo_path!r}
+
+
+def _resolve(pages):
+    # what setup_config() would fill in from confluence
+    for page in pages:
+        page['local_path'] = os.path.join(here, page['source'])
+        page['server_path'] = '/confluence/display/BENCH/' + page['title'].replace(' ', '+')
+        page['short_title'] = page['title'].replace(' ', '')
+        _resolve(page.get('pages', []))
+    return pages
+
+
+with open(os.path.join(here, 'pages.json')) as f:
+    sphinx_confluence_pages = _resolve(json.load(f))
+'''
+
+DEFAULTS = {
+    'pages': 100,
+    'fanout': 5,
+    'sections': 4,
+    'xrefs': 5,
+    'code_blocks': 1,
+    'code_lines': 40,
+    'tables': 1,
+    'table_rows': 20,
+    'images': 1,
+    'modules': 10,
+    'classes': 3,
+    'methods': 10,
+    'seed': 0,
+}
+
+
+def page_docname(number):
+    return 'pages/p%05d' % number
+
+
+def page_title(number):
+    return 'Page %d' % number
+
+
+def page_children(number, pages, fanout):
+    first = number * fanout + 1
+    return [child for child in range(first, first + fanout) if child < pages]
+
+
+def page_tree(number, pages, fanout):
+    """
+    Page ``number`` and its descendants as a ``config.yml`` pages entry; pages
+    form a heap, page ``n`` being the parent of ``n * fanout + 1`` and up.
+    """
+    entry = {'id': 100000 + number, 'source': page_docname(number), 'title': page_title(number)}
+    children = [page_tree(child, pages, fanout) for child in page_children(number, pages, fanout)]
+    if children:
+        entry['pages'] = children
+    return entry
+
+
+def write(path, content, mode='w'):
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    if 'b' in mode:
+        with open(path, mode) as f:
+            f.write(content)
+    else:
+        with io.open(path, mode, encoding='utf-8') as f:
+            f.write(content)
+
+
+#: sphinx_confluence replaces toctrees with the confluence TOC macro, so
+#: generated documents are marked as not belonging to any toctree
+ORPHAN = ':orphan:\n'
+
+
+def toctree(entries, maxdepth=1):
+    if not entries:
+        return ''
+    lines = ['.. toctree::', '   :maxdepth: %d' % maxdepth, '']
+    lines.extend('   ' + entry for entry in entries)
+    return '\n'.join(lines) + '\n\n'
+
+
+def code_block(rnd, lines):
+    body = ['.. code-block:: python', '']
+    for i in range(lines):
+        if i % 8 == 0:
+            body.append('    def function_%d(argument, value=%d):' % (i, rnd.randint(0, 1000)))
+        else:
+            body.append('        argument = argument * %d + value  # step %d' % (rnd.randint(1, 9), i))
+    return '\n'.join(body) + '\n\n'
+
+
+def table(rnd, rows):
+    body = ['.. list-table:: Generated table', '   :header-rows: 1', '',
+            '   * - Name', '     - Value', '     - Description']
+    for i in range(rows):
+        body.extend(['   * - row_%d' % i,
+                     '     - %d' % rnd.randint(0, 100000),
+                     '     - Generated cell with some *emphasis* and ``literal`` text'])
+    return '\n'.join(body) + '\n\n'
+
+
+def page_source(number, options, rnd):
+    pages = options['pages']
+    title = page_title(number)
+    out = [ORPHAN, '.. _%s:' % page_docname(number).replace('/', '-'), '', title, '=' * len(title), '']
+    out.append('Overview of page %d with links to other pages of the corpus.\n\n' % number)
+    out.append(toctree(['p%05d' % child for child in page_children(number, pages, options['fanout'])]))
+
+    for section in range(options['sections']):
+        heading = 'Section %d' % section
+        out.extend(['.. _%s-s%d:' % (page_docname(number).replace('/', '-'), section), '',
+                    heading, '-' * len(heading), ''])
+        refs = []
+        for _ in range(options['xrefs']):
+            target = rnd.randrange(pages)
+            if rnd.random() < 0.5:
+                refs.append(':doc:`/%s`' % page_docname(target))
+            else:
+                refs.append(':ref:`%s-s%d`' % (page_docname(target).replace('/', '-'),
+                                               rnd.randrange(options['sections'])))
+        if section:
+            refs.append('`Section %d`_' % (section - 1))
+        out.append('See %s.\n\n' % ', '.join(refs) if refs else 'No references.\n\n')
+        if section < options['code_blocks']:
+            out.append(code_block(rnd, options['code_lines']))
+        if section < options['tables']:
+            out.append(table(rnd, options['table_rows']))
+        if section < options['images']:
+            out.append('.. image:: /images/image%d.png\n   :alt: image %d\n\n' % (section, section))
+    return '\n'.join(out)
+
+
+def module_source(number, options):
+    out = ['"""', 'Generated module %d' % number, '"""', '', '']
+    for cls in range(options['classes']):
+        out.extend(['class Class%d(object):' % cls,
+                    '    """Class %d of module %d."""' % (cls, number), ''])
+        for method in range(options['methods']):
+            out.extend(['    def method_%d(self, value):' % method,
+                        '        """Method %d, returns ``value`` unchanged."""' % method,
+                        '        return value', ''])
+        out.append('')
+    out.extend(['def function(value):', '    """Module level function."""', '    return value', ''])
+    return '\n'.join(out)
+
+
+def generate(path, extensions=None, repo_path='_modules/', **options):
+    """
+    Write a corpus to ``path``; ``options`` are the keys of :data:`DEFAULTS`.
+
+    :return: the options used, suitable for recording with benchmark results
+    """
+    options = dict(DEFAULTS, **options)
+    rnd = random.Random(options['seed'])
+    pages = options['pages']
+    if extensions is None:
+        extensions = ['sphinx.ext.autodoc', 'sphinx_confluence', 'sphinx_confluence.ext.viewcode']
+
+    tree = [page_tree(child, pages, options['fanout']) for child in page_children(0, pages, options['fanout'])]
+    root = {'id': 100000, 'source': page_docname(0), 'title': page_title(0), 'pages': tree}
+    write(os.path.join(path, 'pages.json'), json.dumps([root], indent=1))
+    write(os.path.join(path, 'config.yml'), config_yml([root]))
+    write(os.path.join(path, 'conf.py'), CONF_PY.format(extensions=extensions, repo_path=repo_path))
+
+    modules = ['api/mod%03d' % number for number in range(options['modules'])]
+    write(os.path.join(path, 'index.rst'),
+          'Benchmark corpus\n================\n\n' + toctree([page_docname(0)] + modules))
+
+    for number in range(pages):
+        write(os.path.join(path, page_docname(number) + '.rst'), page_source(number, options, rnd))
+    for number in range(options['images']):
+        write(os.path.join(path, 'images', 'image%d.png' % number), PNG, 'wb')
+
+    write(os.path.join(path, 'src', 'benchpkg', '__init__.py'), '')
+    for number in range(options['modules']):
+        title = 'Module %d' % number
+        write(os.path.join(path, 'api', 'mod%03d.rst' % number),
+              '%s\n%s\n%s\n\n.. automodule:: benchpkg.mod%03d\n   :members:\n\n'
+              % (ORPHAN, title, '=' * len(title), number))
+        write(os.path.join(path, 'src', 'benchpkg', 'mod%03d.py' % number), module_source(number, options))
+    return options
+
+
+def config_yml(pages, indent=0):
+    """
+    confluence-publisher ``config.yml`` for the page tree
+    """
+    lines = [] if indent else ['version: 2', 'url: https://confluence.example.com/confluence',
+                               'base_dir: _build/json', 'pages:']
+    pad = '  ' * (indent + 1)
+    for page in pages:
+        lines.append('%s- id: %d' % (pad, page['id']))
+        lines.append('%s  source: %s' % (pad, page['source']))
+        lines.append('%s  title: %s' % (pad, page['title']))
+        if page.get('pages'):
+            lines.append('%s  pages:' % pad)
+            lines.append(config_yml(page['pages'], indent + 1))
+    return '\n'.join(lines) + ('' if indent else '\n')
+
+
+def add_options(parser):
+    for name, default in sorted(DEFAULTS.items()):
+        parser.add_argument('--' + name.replace('_', '-'), type=int, default=default, dest=name)
+    parser.add_argument('--repo-path', default='_modules/',
+                        help='sphinx_confluence_repo_path; a URL skips the viewcode module pages')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('path', help='directory to write the corpus to')
+    add_options(parser)
+    args = vars(parser.parse_args(argv))
+    path = args.pop('path')
+    options = generate(path, repo_path=args.pop('repo_path'), **args)
+    print('Wrote %d pages and %d modules to %s' % (options['pages'], options['modules'], path))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+Time the build phases of sphinx-confluence on a synthetic corpus
+
+Generates a corpus (see ``corpus.py``) or uses an existing project, builds it
+and records wall and CPU time of the read, resolve (``fix_references``),
+translate (``HTMLConfluenceTranslator``) and viewcode phases as JSON::
+
+    python benchmarks/run.py --pages 500 --builder confluence -o results.json
+    python benchmarks/run.py --pages 500 --compare results.json
+
+Phases nest: ``read`` includes the viewcode ``doctree-read`` handler and
+``write`` includes ``resolve`` and ``translate``. Run serially, as handlers
+running in ``-j`` worker processes are not timed.
+"""
+
+import argparse
+from collections import OrderedDict
+import datetime
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(1, os.path.dirname(HERE))
+
+import corpus  # NOQA
+
+PHASES = ('read', 'viewcode', 'write', 'resolve', 'translate', 'finish', 'total')
+
+
+class PhaseTimer(object):
+    """
+    Accumulates wall time, CPU time and call count per phase
+    """
+
+    def __init__(self):
+        self.phases = OrderedDict((phase, {'wall': 0.0, 'cpu': 0.0, 'calls': 0}) for phase in PHASES)
+
+    def add(self, phase, wall, cpu):
+        entry = self.phases.setdefault(phase, {'wall': 0.0, 'cpu': 0.0, 'calls': 0})
+        entry['wall'] += wall
+        entry['cpu'] += cpu
+        entry['calls'] += 1
+
+    def wrap(self, phase, func):
+        def timed(*args, **kwargs):
+            wall, cpu = time.perf_counter(), time.process_time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(phase, time.perf_counter() - wall, time.process_time() - cpu)
+        timed.__wrapped__ = func
+        return timed
+
+    def wrap_generator(self, phase, func):
+        """
+        Like :meth:`wrap`, for event handlers returning generators
+        (``html-collect-pages``); only the time spent producing items counts
+        """
+        def timed(*args, **kwargs):
+            iterator = iter(func(*args, **kwargs) or ())
+            while True:
+                wall, cpu = time.perf_counter(), time.process_time()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    self.add(phase, time.perf_counter() - wall, time.process_time() - cpu)
+                yield item
+        return timed
+
+
+def replace_listener(app, event, func, wrapper):
+    """
+    Replace the ``event`` handler ``func`` already connected to ``app``
+    """
+    events = getattr(app, 'events', None)
+    listeners = getattr(events, 'listeners', None)
+    if listeners is None:
+        # Sphinx < 1.6
+        listeners = app._listeners
+    entries = listeners[event]
+    if isinstance(entries, dict):
+        for key, handler in list(entries.items()):
+            if handler is func:
+                entries[key] = wrapper
+    else:
+        for i, entry in enumerate(entries):
+            if entry.handler is func:
+                entries[i] = entry._replace(handler=wrapper)
+
+
+def instrument(app, timer):
+    import sphinx_confluence
+    from sphinx.writers.html import HTMLWriter
+    from sphinx_confluence.ext import viewcode
+
+    builder = app.builder
+    builder.read = timer.wrap('read', builder.read)
+    builder.write = timer.wrap('write', builder.write)
+    builder.finish = timer.wrap('finish', builder.finish)
+    replace_listener(app, 'doctree-resolved', sphinx_confluence.fix_references,
+                     timer.wrap('resolve', sphinx_confluence.fix_references))
+    replace_listener(app, 'doctree-read', viewcode.doctree_read,
+                     timer.wrap('viewcode', viewcode.doctree_read))
+    replace_listener(app, 'html-collect-pages', viewcode.collect_pages,
+                     timer.wrap_generator('viewcode', viewcode.collect_pages))
+
+    translate = HTMLWriter.translate
+    HTMLWriter.translate = timer.wrap('translate', translate)
+    return lambda: setattr(HTMLWriter, 'translate', translate)
+
+
+def run_build(srcdir, outdir, builder, confoverrides=None):
+    from sphinx.application import Sphinx
+
+    timer = PhaseTimer()
+    wall, cpu = time.perf_counter(), time.process_time()
+    app = Sphinx(srcdir, srcdir, outdir, os.path.join(outdir, '.doctrees'), builder,
+                 confoverrides or {}, status=None, warning=None, freshenv=True)
+    restore = instrument(app, timer)
+    try:
+        app.build(force_all=True)
+    finally:
+        restore()
+    timer.add('total', time.perf_counter() - wall, time.process_time() - cpu)
+    return timer.phases, len(app.env.found_docs)
+
+
+def best_of(runs):
+    """
+    Fastest wall time of every phase over several runs
+    """
+    result = OrderedDict()
+    for phase in runs[0]:
+        result[phase] = min((run[phase] for run in runs if phase in run), key=lambda entry: entry['wall'])
+    return result
+
+
+def compare(current, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)['phases']
+    print('%-10s %10s %10s %8s' % ('phase', 'baseline', 'current', 'change'))
+    for phase, entry in current.items():
+        before = baseline.get(phase, {}).get('wall')
+        if not before:
+            continue
+        print('%-10s %9.3fs %9.3fs %+7.1f%%' % (phase, before, entry['wall'], (entry['wall'] / before - 1) * 100))
+
+
+def main(argv=None):
+    import sphinx
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--project', help='build an existing project instead of generating a corpus')
+    parser.add_argument('--builder', default='json', help='sphinx builder (default: json)')
+    parser.add_argument('--repeat', type=int, default=1, help='builds to run; the fastest is reported')
+    parser.add_argument('-D', dest='define', action='append', default=[], metavar='name=value',
+                        help='override a configuration value')
+    parser.add_argument('-o', '--output', help='write the results as JSON to this file')
+    parser.add_argument('--compare', metavar='RESULTS', help='compare with earlier JSON results')
+    parser.add_argument('--keep', action='store_true', help='keep the generated corpus and build output')
+    corpus.add_options(parser)
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='sphinx-confluence-bench-')
+    try:
+        options = None
+        srcdir = args.project
+        if srcdir is None:
+            srcdir = os.path.join(workdir, 'corpus')
+            options = corpus.generate(srcdir, repo_path=args.repo_path,
+                                      **dict((name, getattr(args, name)) for name in corpus.DEFAULTS))
+        confoverrides = dict(define.split('=', 1) for define in args.define)
+
+        runs = []
+        for i in range(max(1, args.repeat)):
+            outdir = os.path.join(workdir, 'build%d' % i)
+            phases, documents = run_build(os.path.abspath(srcdir), outdir, args.builder, confoverrides)
+            runs.append(phases)
+            print('run %d: %d documents in %.2fs' % (i + 1, documents, phases['total']['wall']))
+
+        results = OrderedDict([
+            ('timestamp', datetime.datetime.utcnow().isoformat() + 'Z'),
+            ('python', platform.python_version()),
+            ('sphinx', sphinx.__display_version__),
+            ('builder', args.builder),
+            ('project', args.project),
+            ('corpus', options),
+            ('confoverrides', confoverrides),
+            ('documents', documents),
+            ('runs', runs),
+            ('phases', best_of(runs)),
+        ])
+        for phase, entry in results['phases'].items():
+            print('%-10s wall %8.3fs  cpu %8.3fs  calls %d' % (phase, entry['wall'], entry['cpu'], entry['calls']))
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=1)
+        if args.compare:
+            compare(results['phases'], args.compare)
+    finally:
+        if args.keep:
+            print('Corpus and build output kept in %s' % workdir)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
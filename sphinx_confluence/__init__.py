@@ -6,54 +6,83 @@ https://confluence.atlassian.com/display/DOC/Confluence+Storage+Format
 """
 
 from distutils.version import LooseVersion
+import hashlib
+import io
+import json
 import os
+import posixpath
+import shutil
+import time
 
 from docutils import nodes
+from docutils.io import StringOutput
 from docutils.parsers.rst import directives, Directive, roles
 from docutils.parsers.rst.directives import images
 from docutils.parsers.rst.roles import set_classes
 
 import sphinx
-from sphinx.builders.html import JSONHTMLBuilder
+from sphinx.builders.html import JSONHTMLBuilder, StandaloneHTMLBuilder
 from sphinx.directives.code import CodeBlock
 from sphinx.locale import _
+from sphinx.util.osutil import SEP, ensuredir, relative_uri
+from sphinx.util import logging
 from sphinx.writers.html import HTMLTranslator
-import logging
 from urllib.parse import urlparse
 
+from sphinx_confluence import instrumentation, macros, split
+from sphinx_confluence.pages import PageIndex, iter_pages
+from sphinx_confluence.references import ReferenceResolver, count_targets
+from sphinx_confluence.util import StreamingBody
+
+__version__ = '0.0.3'
+
 logger = logging.getLogger(__name__)
 
-def setup_config(config_path, **authentication):
+def setup_config(config_path, max_workers=8, cache_path=None, cache_ttl=24 * 60 * 60, refresh=False,
+                 rate=None, retries=5, batch_size=50, **authentication):
+    """
+    Load the ``pages`` tree from a confluence-publisher ``config.yml`` and
+    resolve the confluence metadata of every page.
+
+    Page metadata is kept in a persistent cache, so warm builds only talk to
+    confluence for pages whose cache entry is older than ``cache_ttl``.
+
+    :param config_path: path to ``config.yml``
+    :param max_workers: number of pages fetched from confluence concurrently
+    :param cache_path: cache file or directory (e.g. the sphinx doctree dir);
+        defaults to the directory of ``config.yml``. ``False`` disables the cache
+    :param cache_ttl: seconds a cache entry is trusted without revalidation
+    :param refresh: ignore the cache and re-fetch every page
+    :param rate: maximum requests per second sent to confluence, unlimited by default
+    :param retries: how often a throttled or failed request is retried
+    :param batch_size: number of pages fetched with a single search request
+    :param authentication: passed to ``conf_publisher.auth.parse_authentication``
+    """
     from yaml import load
-    from conf_publisher.confluence_api import create_confluence_api
-    from conf_publisher.constants import DEFAULT_CONFLUENCE_API_VERSION as version
     from conf_publisher.auth import parse_authentication
+    from sphinx_confluence.api import RequestScheduler, create_confluence_api
+    from sphinx_confluence.pages import PageMetadataCache, PageResolver
     with open(config_path) as f:
         sc_config = load(f.read())
 
     sphinx_confluence_url = sc_config.get('url')
     confluence_path = urlparse(sphinx_confluence_url).path
     session = parse_authentication(**authentication)
-    conf_api = create_confluence_api(version, sphinx_confluence_url, session)
-
-    def update_page(page_dict):
-        page_id = page_dict.get('id')
-        page_path = page_dict.get('source')
-        abspath = os.path.abspath(page_path)
-        page_info = conf_api.get_content(page_id)
-        page_path = page_info.get('_links').get('webui')
-        page_title = page_info.get('title')
-        page_short_title = page_title.replace(' ', '')
-        page_dict.update({'server_path': confluence_path + page_path,
-                          'title': page_title,
-                          'short_title': page_short_title,
-                          'local_path': abspath})
-        if 'pages' in page_dict:
-            for page in page_dict['pages']:
-                update_page(page)
-
-    for page in sc_config.get('pages'):
-        update_page(page)
+    scheduler = RequestScheduler(rate=rate, max_concurrency=max_workers, retries=retries)
+    conf_api = create_confluence_api(sphinx_confluence_url, session, scheduler=scheduler)
+
+    cache = None
+    if cache_path is not False:
+        if cache_path is None:
+            cache_path = os.path.dirname(os.path.abspath(config_path))
+        cache = PageMetadataCache(cache_path, ttl=cache_ttl)
+
+    resolver = PageResolver(conf_api, confluence_path, max_workers=max_workers, cache=cache, refresh=refresh,
+                            batch_size=batch_size)
+    wall, cpu = time.perf_counter(), time.process_time()
+    failed = resolver.resolve(sc_config.get('pages'))
+    instrumentation.record_setup('setup_config', time.perf_counter() - wall, time.process_time() - cpu,
+                                 pages=len(list(iter_pages(sc_config.get('pages')))), failed=len(failed))
 
     return sc_config.get('pages')
 
@@ -65,26 +94,6 @@ def static_dynamic(argument):
     return directives.choice(argument, ('static', 'dynamic'))
 
 
-class TitlesCache(object):
-    titles = {}
-
-    @staticmethod
-    def _document_key(document):
-        return hash(document)
-
-    @classmethod
-    def set_title(cls, document, title):
-        cls.titles[cls._document_key(document)] = title
-
-    @classmethod
-    def get_title(cls, document):
-        return cls.titles.get(cls._document_key(document), None)
-
-    @classmethod
-    def has_title(cls, document):
-        return cls._document_key(document) in cls.titles
-
-
 class JSONConfluenceBuilder(JSONHTMLBuilder):
     """For backward compatibility"""
 
@@ -97,8 +106,247 @@ class JSONConfluenceBuilder(JSONHTMLBuilder):
         self.warn('json_conf builder is deprecated and will be removed in future releases')
 
 
+class ConfluenceStorageBuilder(StandaloneHTMLBuilder):
+    """
+    Writes the confluence storage format of every document straight from
+    :class:`HTMLConfluenceTranslator` into ``<docname>.xml``.
+
+    Unlike the html/json builders no templates are rendered and neither a
+    search index, static files nor the JSON wrapping are written. Page titles
+    go to a single ``confluence_pages.json`` index next to the documents.
+    """
+
+    name = 'confluence'
+    format = 'html'
+    out_suffix = '.xml'
+    pages_index = 'confluence_pages.json'
+    literal_blocks_dir = '_literal_blocks'
+
+    search = False
+    copysource = False
+    allow_parallel = True
+
+    #: stream the translator writes to, set while a document is streamed
+    body_stream = None
+
+    #: part of a split document (see :mod:`sphinx_confluence.split`) being written
+    current_part = None
+
+    #: :class:`~sphinx_confluence.publish.PublishPipeline` publishing while writing
+    publish_pipeline = None
+
+    def init(self):
+        StandaloneHTMLBuilder.init(self)
+        self.out_suffix = self.link_suffix = ConfluenceStorageBuilder.out_suffix
+
+    def get_target_uri(self, docname, typ=None):
+        # the same uris as the json builder; fix_references relies on them
+        if docname == 'index':
+            return ''
+        if docname.endswith(SEP + 'index'):
+            return docname[:-5]  # up to sep
+        return docname + SEP
+
+    def write_doc_serialized(self, docname, doctree):
+        # no search index and no rendered title, just collect the images
+        self.imgpath = relative_uri(self.get_target_uri(docname), self.imagedir)
+        self.post_process_images(doctree)
+
+    def write_doc(self, docname, doctree):
+        destination = StringOutput(encoding='utf-8')
+        doctree.settings = self.docsettings
+
+        self.secnumbers = self.env.toc_secnumbers.get(docname, {})
+        self.fignumbers = self.env.toc_fignumbers.get(docname, {})
+        self.imgpath = relative_uri(self.get_target_uri(docname), self.imagedir)
+        self.dlpath = relative_uri(self.get_target_uri(docname), '_downloads')
+        self.current_docname = docname
+
+        outfilename = self.get_outfilename(docname)
+        ensuredir(os.path.dirname(outfilename))
+        documents = split.split_doctree(doctree, get_parts(self, docname))
+        self.write_page(docname, doctree, destination, outfilename)
+        for part, document in documents:
+            self.current_part = part
+            try:
+                self.write_page(docname, document, StringOutput(encoding='utf-8'),
+                                os.path.join(self.outdir, part['docname'] + self.out_suffix))
+            finally:
+                self.current_part = None
+        if self.publish_pipeline is not None:
+            self.publish_pipeline.written()
+
+    def prepare_writing(self, docnames):
+        StandaloneHTMLBuilder.prepare_writing(self, docnames)
+        if self.config.sphinx_confluence_publish and self.config.sphinx_confluence_publish_pipeline:
+            # titles and parts are known after reading; the publisher needs them now
+            self.write_pages_index()
+            self.publish_pipeline = start_publish_pipeline(self.app, docnames)
+
+    def page_docname(self, docname):
+        """
+        Docname of the page being written, the part's for a split document
+        """
+        return self.current_part['docname'] if self.current_part is not None else docname
+
+    def literal_block_dir(self, page_docname):
+        """
+        Directory of the literal blocks of a page stored as attachments
+        """
+        return os.path.join(self.outdir, self.literal_blocks_dir, page_docname)
+
+    def write_page(self, docname, doctree, destination, outfilename):
+        # attachments of the previous build of this page
+        shutil.rmtree(self.literal_block_dir(self.page_docname(docname)), ignore_errors=True)
+        tmpfilename = outfilename + '.tmp'
+        if self.config.sphinx_confluence_stream_output:
+            self.write_doc_streaming(docname, doctree, destination, tmpfilename)
+        else:
+            self.docwriter.write(doctree, destination)
+            self.docwriter.assemble_parts()
+            with io.open(tmpfilename, 'w', encoding='utf-8') as f:
+                f.write(self.docwriter.parts['fragment'])
+        # a pipelined publish never reads a partially written page
+        os.replace(tmpfilename, outfilename)
+
+    def write_doc_streaming(self, docname, doctree, destination, outfilename):
+        """
+        Let the translator write the storage format to the output file while it
+        walks the document, buffering at most about
+        ``sphinx_confluence_stream_buffer_size`` characters.
+        """
+        with io.open(outfilename, 'w', encoding='utf-8') as f:
+            self.body_stream = f
+            try:
+                self.docwriter.write(doctree, destination)
+            finally:
+                self.body_stream = None
+            body = self.docwriter.visitor.streamed_body
+            if body is not None:
+                logger.verbose('%s: at most %d characters of storage format buffered, %d KiB written',
+                               docname, body.peak_buffered_chars, body.written // 1024)
+            else:
+                # the translator did not stream, e.g. an unexpected document
+                self.docwriter.assemble_parts()
+                f.write(self.docwriter.parts['fragment'])
+
+    def write_pages_index(self):
+        pages = {}
+        for docname in self.env.found_docs:
+            title = self.env.titles.get(docname)
+            pages[docname] = {'title': title.astext() if title is not None else None}
+            for index, part in enumerate(get_parts(self, docname), 1):
+                pages[part['docname']] = {'title': part['title'], 'parent': docname, 'index': index}
+        with io.open(os.path.join(self.outdir, self.pages_index), 'w', encoding='utf-8') as f:
+            f.write(json.dumps(pages, indent=1, sort_keys=True, ensure_ascii=False))
+
+    def finish(self):
+        self.copy_image_files()
+        self.copy_download_files()
+        self.write_pages_index()
+        self.write_buildinfo()
+
+
 class HTMLConfluenceTranslator(HTMLTranslator):
 
+    def __init__(self, builder, *args, **kwargs):
+        HTMLTranslator.__init__(self, builder, *args, **kwargs)
+        self.page_title = self._page_title()
+        self.page_title_skipped = False
+        self.part_links = {}
+        self.main_title = self.page_title
+        if self._is_page() and self.page_title is not None:
+            docname = self.builder.current_docname
+            self.part_links = split.part_links(get_parts(self.builder, docname))
+            self.main_title = self.builder.env._confluence_titles.get(docname)
+        self.streamed_body = None
+        self.recorder = getattr(self.builder, 'confluence_recorder', None)
+        self.compact = bool(self.builder.config.sphinx_confluence_compact_output)
+        self.references = get_reference_resolver(self.builder)
+
+        stream = getattr(self.builder, 'body_stream', None)
+        if stream is not None and self._is_page():
+            self.body = StreamingBody(stream, self.builder.config.sphinx_confluence_stream_buffer_size)
+
+    def _is_page(self):
+        """
+        Whether this translator writes the page itself rather than a partial
+        render (toctrees, relbars, ...)
+        """
+        docname = getattr(self.builder, 'current_docname', None)
+        return docname is not None and self.document.get('source') == self.builder.env.doc2path(docname)
+
+    def _page_title(self):
+        """
+        Title of the confluence page being written, i.e. the first section title
+        collected by :func:`collect_titles`. Confluence prefixes anchors of a page
+        with its title, so this is used to build internal links. Partial renders
+        (toctrees, relbars, ...) are not the page itself and get no title.
+        """
+        docname = getattr(self.builder, 'current_docname', None)
+        title = getattr(self.builder.env, '_confluence_titles', {}).get(docname)
+        if title is None or self.initial_header_level != 1 or not self._is_page():
+            return None
+        part = getattr(self.builder, 'current_part', None)
+        if part is not None:
+            return part['title']
+        return title
+
+    def _part_link(self, node):
+        """
+        Title of the page and anchor of a reference whose target is on another
+        page of a split document, ``None`` for every other reference
+        """
+        refpage = node.get('refpage')
+        if refpage is not None and refpage.get('part_title'):
+            return refpage['part_title'], refpage['part_anchor']
+
+        if 'refid' in node:
+            target = node['refid']
+        elif node.get('refuri', '').startswith('#'):
+            target = node['refuri'][1:]
+        else:
+            return None
+        if not self.part_links:
+            return None
+        title, anchor = self.part_links.get(target, (self.main_title, target))
+        if title is None or title == self.page_title:
+            return None
+        return title, anchor
+
+    def dispatch_visit(self, node):
+        # everything before a top-level body element is complete, which makes
+        # this the place to hand buffered output to the stream
+        if isinstance(self.body, StreamingBody) and isinstance(node.parent, (nodes.section, nodes.document)):
+            self.body.flush_if_full()
+        if self.recorder is None:
+            return HTMLTranslator.dispatch_visit(self, node)
+        start = time.perf_counter()
+        try:
+            return HTMLTranslator.dispatch_visit(self, node)
+        finally:
+            self.recorder.visit('visit_' + node.__class__.__name__, time.perf_counter() - start)
+
+    def dispatch_departure(self, node):
+        if self.recorder is None:
+            return HTMLTranslator.dispatch_departure(self, node)
+        start = time.perf_counter()
+        try:
+            return HTMLTranslator.dispatch_departure(self, node)
+        finally:
+            self.recorder.visit('depart_' + node.__class__.__name__, time.perf_counter() - start)
+
+    def depart_document(self, node):
+        if isinstance(self.body, StreamingBody):
+            self.body.close()
+            self.streamed_body, self.body = self.body, []
+        if self.recorder is not None and self._is_page():
+            size = len(''.join(self.body).encode('utf-8'))
+            if self.streamed_body is not None:
+                size += self.streamed_body.written
+            self.recorder.page_bytes[self.builder.current_docname] = size
+        HTMLTranslator.depart_document(self, node)
+
     def unimplemented_visit(self, node):
         self.builder.warn('Unimplemented visit is not implemented for node: {}'.format(node))
 
@@ -135,21 +383,13 @@ class HTMLConfluenceTranslator(HTMLTranslator):
 
         admonition_type = confluence_admonition_map.get(name, 'info')
 
-        macro = """\
-            <ac:structured-macro ac:name="{admonition_type}">
-              <ac:parameter ac:name="icon">true</ac:parameter>
-              <ac:parameter ac:name="title"></ac:parameter>
-              <ac:rich-text-body>
-        """
-
-        self.body.append(macro.format(admonition_type=admonition_type))
+        self.body.append(macros.admonition(admonition_type).render_start(self.compact)
+                         + macros.rich_text_body().render_start(self.compact, 1))
 
     def depart_admonition(self, node=None):
-        macro = """
-              </ac:rich-text-body>
-            </ac:structured-macro>\n
-        """
-        self.body.append(macro)
+        newline = not self.body[-1].endswith('\n')
+        self.body.append(macros.rich_text_body().render_end(self.compact, 1, newline)
+                         + macros.admonition('').render_end(self.compact))
 
     def imgtag(self, filename, suffix='\n', **attributes):
         """
@@ -224,18 +464,20 @@ class HTMLConfluenceTranslator(HTMLTranslator):
         else:
             suffix = '\n'
 
-        self.context.append('')
         self.body.append(self.imgtag(filename, suffix, **atts))
 
+    def depart_image(self, node):
+        # the image is complete after visit_image; sphinx's depart_image
+        # pops a context entry for SVG images only
+        pass
+
     def visit_title(self, node):
-        if isinstance(node.parent, nodes.section) and not TitlesCache.has_title(self.document):
+        if isinstance(node.parent, nodes.section) and self.page_title is not None and not self.page_title_skipped:
             h_level = self.section_level + self.initial_header_level - 1
             if h_level == 1:
                 # Confluence take first title for page title from rst
-                # It use for making internal links
-                TitlesCache.set_title(self.document, node.children[0])
-
                 # ignore first header; document must have title header
+                self.page_title_skipped = True
                 raise nodes.SkipNode
 
         HTMLTranslator.visit_title(self, node)
@@ -251,13 +493,6 @@ class HTMLConfluenceTranslator(HTMLTranslator):
         </ac:structured-macro>
         """
 
-        # Anchor confluence macros
-        anchor_macros = """
-            <ac:structured-macro ac:name="anchor">
-              <ac:parameter ac:name="">%s</ac:parameter>
-            </ac:structured-macro>
-        """
-
         if 'refid' in node or 'refname' in node:
 
             if 'refuri' in node:
@@ -267,12 +502,17 @@ class HTMLConfluenceTranslator(HTMLTranslator):
             else:
                 link = node['refname']
 
-            self.body.append(anchor_macros % link)
+            self.body.append(macros.anchor(link).render(self.compact))
 
     def depart_target(self, node):
         pass
 
 
+    #: Languages of the confluence code block macro
+    code_languages = ['actionscript3', 'bash', 'csharp', 'coldfusion', 'cpp', 'css', 'delphi', 'diff', 'erlang',
+                      'groovy', 'html/xml', 'java', 'javafx', 'javascript', 'none', 'perl', 'php', 'powershell',
+                      'python', 'ruby', 'scala', 'sql', 'vb']
+
     def visit_literal_block(self, node):
         """
         Code Block Macro
@@ -290,33 +530,69 @@ class HTMLConfluenceTranslator(HTMLTranslator):
         </ac:structured-macro>
         """
 
-        parts = ['<ac:structured-macro ac:name="code">']
+        if self._literal_block_attachment(node):
+            raise nodes.SkipNode
+
+        language = None
+        collapse = False
         if 'language' in node:
 
             # Collapsible argument
-            if node['language'] == 'collapse':
-                parts.append('<ac:parameter ac:name="collapse">true</ac:parameter>')
-
-            valid = ['actionscript3', 'bash', 'csharp', 'coldfusion', 'cpp', 'css', 'delphi', 'diff', 'erlang',
-                     'groovy', 'html/xml', 'java', 'javafx', 'javascript', 'none', 'perl', 'php', 'powershell',
-                     'python', 'ruby', 'scala', 'sql', 'vb']
+            collapse = node['language'] == 'collapse'
 
-            if node['language'] not in valid:
+            if node['language'] not in self.code_languages:
                 node['language'] = 'none'
 
-            parts.append('<ac:parameter ac:name="language">%s</ac:parameter>' % node['language'])
+            language = node['language']
 
-        if 'linenos' in node and node['linenos']:
-            parts.append('<ac:parameter ac:name="linenumbers">true</ac:parameter>')
+        macro = macros.code_block(node.rawsource, language, collapse, node.get('linenos'), node.get('caption'))
+        self.body.append(macro.render(compact=True))
+        raise nodes.SkipNode
 
-        if 'caption' in node and node['caption']:
-            parts.append('<ac:parameter ac:name="title">%s</ac:parameter>' % node['caption'])
+    #: File extensions of literal blocks stored as attachments, by language
+    literal_block_extensions = {
+        'bash': '.sh', 'cpp': '.cpp', 'csharp': '.cs', 'css': '.css', 'diff': '.diff', 'html/xml': '.xml',
+        'java': '.java', 'javascript': '.js', 'perl': '.pl', 'php': '.php', 'powershell': '.ps1',
+        'python': '.py', 'ruby': '.rb', 'scala': '.scala', 'sql': '.sql',
+    }
 
-        parts.append('<ac:plain-text-body><![CDATA[%s]]></ac:plain-text-body>' % node.rawsource)
-        parts.append('</ac:structured-macro>')
+    def _literal_block_attachment(self, node):
+        """
+        Store a literal block larger than ``sphinx_confluence_literal_block_max_size``
+        bytes as an attachment of the page and show a preview of its first
+        ``sphinx_confluence_literal_block_preview_lines`` lines with a link to
+        the attachment instead.
 
-        self.body.append(''.join(parts))
-        raise nodes.SkipNode
+        Only the confluence builder writes attachments, which the publisher
+        uploads with the page.
+
+        :return: ``True`` if the block was stored as an attachment
+        """
+        max_size = self.builder.config.sphinx_confluence_literal_block_max_size
+        if not max_size or not isinstance(self.builder, ConfluenceStorageBuilder) or not self._is_page():
+            return False
+        data = node.rawsource.encode('utf-8')
+        if len(data) <= int(max_size):
+            return False
+
+        language = node.get('language')
+        filename = 'literal-{}{}'.format(hashlib.sha1(data).hexdigest()[:16],
+                                         self.literal_block_extensions.get(language, '.txt'))
+        directory = self.builder.literal_block_dir(self.builder.page_docname(self.builder.current_docname))
+        ensuredir(directory)
+        with open(os.path.join(directory, filename), 'wb') as f:
+            f.write(data)
+
+        preview_lines = int(self.builder.config.sphinx_confluence_literal_block_preview_lines)
+        lines = node.rawsource.splitlines()
+        if preview_lines > 0:
+            preview = macros.code_block('\n'.join(lines[:preview_lines]),
+                                        language if language in self.code_languages else 'none',
+                                        linenumbers=node.get('linenos'), title=node.get('caption'))
+            self.body.append(preview.render(compact=True))
+        text = 'Full listing: {} ({} lines, {} KiB)'.format(filename, len(lines), len(data) // 1024)
+        self.body.append('<p>' + macros.attachment_link(filename, text).render(compact=True) + '</p>\n')
+        return True
 
     def visit_download_reference(self, node):
         """
@@ -337,16 +613,7 @@ class HTMLConfluenceTranslator(HTMLTranslator):
         if len(node.children) > 0 and len(node.children[0].children) > 0:
             text = node.children[0].children[0]
 
-        parts = [
-            '<ac:link>',
-            '<ri:attachment ri:filename="%s" />' % node['filename'],
-            '<ac:plain-text-link-body>',
-            '<![CDATA[%s]]>' % text if text else '',
-            '</ac:plain-text-link-body>',
-            '</ac:link>',
-        ]
-
-        self.body.append(''.join(parts))
+        self.body.append(macros.attachment_link(node['filename'], text).render(compact=True))
         raise nodes.SkipNode
 
     def visit_section(self, node):
@@ -358,36 +625,26 @@ class HTMLConfluenceTranslator(HTMLTranslator):
         self.section_level -= 1
 
     def visit_reference(self, node):
-        anchor_macros = """
-            <ac:structured-macro ac:name="anchor">
-              <ac:parameter ac:name="">%s</ac:parameter>
-            </ac:structured-macro>
-        """
+        link = self._part_link(node)
+        if link is not None:
+            # the target moved to another page of the split document
+            node['confluence_link'] = True
+            self.body.append(macros.page_link(*link).render_start(compact=True)
+                             + macros.link_body().render_start(compact=True))
+            return
 
         atts = {'class': 'reference'}
         if node.get('internal') or 'refuri' not in node:
             atts['class'] += ' internal'
         else:
             atts['class'] += ' external'
-        if 'refuri' in node:
-            atts['href'] = ''
-            # Confluence makes internal links with prefix from page title
-            if node.get('internal') and TitlesCache.has_title(self.document):
-                atts['href'] += '#%s-' % TitlesCache.get_title(self.document).replace(' ', '')
-
-            atts['href'] += node['refuri']
-            if self.settings.cloak_email_addresses and atts['href'].startswith('mailto:'):
-                atts['href'] = self.cloak_mailto(atts['href'])
-                self.in_mailto = 1
-        else:
+        if 'refuri' not in node:
             assert 'refid' in node, 'References must have "refuri" or "refid" attribute.'
 
-            atts['href'] = ''
-            # Confluence makes internal links with prefix from page title
-            if node.get('internal') and TitlesCache.has_title(self.document):
-                atts['href'] += '#%s-' % TitlesCache.get_title(self.document).replace(' ', '')
-            atts['href'] += node['refid']
-
+        atts['href'], anchors = self.references.resolve_node(node, self.page_title)
+        if 'refuri' in node and self.settings.cloak_email_addresses and atts['href'].startswith('mailto:'):
+            atts['href'] = self.cloak_mailto(atts['href'])
+            self.in_mailto = 1
 
         if not isinstance(node.parent, nodes.TextElement):
             assert len(node) == 1 and isinstance(node[0], nodes.image)
@@ -395,62 +652,8 @@ class HTMLConfluenceTranslator(HTMLTranslator):
         if 'reftitle' in node:
             atts['title'] = node['reftitle']
 
-
-        if atts['href'].startswith("#"):
-
-            href = atts['href']
-            start = href.find('https:')
-            href = href[start:]
-            parts = href.split('/')
-
-            if start >= 0 and len(parts) > 2 and "#" in parts[-2] and "#" in parts[-1]:
-                # if it's a bitbucket viewcode
-                anchor = None
-                href = "/".join(parts[:-1])
-                atts['href'] = href
-
-
-                if 'refuri' in node:
-                    uri = node.get('refuri')
-                    if uri:
-                        start = uri.find('/browse/') + 8
-                        uri = uri[start:]
-                        uri_parts = uri.split('/')
-                        uri_parts[-1] = uri_parts[-1].replace('#', '')
-                        uri_parts[-2] = uri_parts[-2][:uri_parts[-2].find('.py')]
-                        anchor = '.'.join(uri_parts)
-
-
-                elif 'reftitle' in node and node.get('reftitle'):
-                    title = node.get('reftitle')
-                    if title:
-                        anchor = title.split('#')[-1]
-
-                if anchor:
-                    self.body.append(anchor_macros % anchor)
-
-                self.body.append(anchor_macros % parts[-1][1:])
-
-
-        if "refpage" in node and not atts['href'].startswith('http'):
-            # Fix links for confluence pages
-            refpage = node.get('refpage')
-            target = None
-
-            if 'refuri' in node:
-                uri = node.get('refuri')
-                if uri:
-                    target = uri.split('/')[-1][1:]
-
-            if 'reftitle' in node:
-                if not target:
-                    title = node.get('reftitle')
-                    target = title.split('#')[-1]
-
-            href = refpage.get('server_path') + "#%s-" % refpage.get('short_title')
-            if target:
-                href += target
-            atts['href'] = href
+        for anchor in anchors:
+            self.body.append(macros.anchor(anchor).render(self.compact))
 
         self.body.append(self.starttag(node, 'a', '', **atts))
 
@@ -458,6 +661,13 @@ class HTMLConfluenceTranslator(HTMLTranslator):
             self.body.append(('%s' + self.secnumber_suffix) % '.'.join(map(str, node['secnumber'])))
 
 
+    def depart_reference(self, node):
+        if node.get('confluence_link'):
+            self.body.append(macros.link_body().render_end(compact=True)
+                             + macros.page_link('').render_end(compact=True))
+            return
+        HTMLTranslator.depart_reference(self, node)
+
     def visit_table(self, node):
         """ Fix ugly table border
         """
@@ -521,17 +731,12 @@ class TocTree(Directive):
     }
 
     def run(self):
-        macro = """
-            <ac:structured-macro ac:name="toc">
-              <ac:parameter ac:name="style">square</ac:parameter>
-              <ac:parameter ac:name="minLevel">1</ac:parameter>
-              <ac:parameter ac:name="maxLevel">3</ac:parameter>
-              <ac:parameter ac:name="type">list</ac:parameter>
-            </ac:structured-macro>\n
-        """
+        macro = macros.toc().render(macros.compact_output(self.state.document))
 
         attributes = {'format': 'html'}
         raw_node = nodes.raw('', macro, **attributes)
+        # dropped from the page of a split document without sections left
+        raw_node['toc'] = True
         return [raw_node]
 
 
@@ -568,43 +773,32 @@ class JiraIssuesDirective(Directive):
     }
 
     def run(self):
-        result = ['<ac:structured-macro ac:name="jira" ac:schema-version="1">']
-        param_macro = '<ac:parameter ac:name="{name}">{value}</ac:parameter>'
-
-        for name, value in self.options.items():
-            result.append(param_macro.format(name=underscore_to_camelcase(name), value=value))
+        parameters = [(underscore_to_camelcase(name), value) for name, value in self.options.items()]
 
         jql_query = self.arguments[0]
-        result.append(param_macro.format(name='jqlQuery', value=jql_query))
+        parameters.append(('jqlQuery', jql_query))
 
-        result.append('</ac:structured-macro>')
+        macro = macros.jira_issues(parameters).render(macros.compact_output(self.state.document))
         attributes = {'format': 'html'}
 
-        raw_node = nodes.raw('', '\n'.join(result), **attributes)
+        raw_node = nodes.raw('', macro, **attributes)
+        # dropped from the page of a split document without sections left
+        raw_node['toc'] = True
         return [raw_node]
 
 
 class JiraIssueRole(roles.GenericRole):
-    def __call__(self, role, rawtext, text, *args, **kwargs):
-        macro = """\
-          <ac:structured-macro ac:name="jira" ac:schema-version="1">
-            <ac:parameter ac:name="key">{key}</ac:parameter>
-            <ac:parameter ac:name="showSummary">false</ac:parameter>
-          </ac:structured-macro>
-        """
+    def __call__(self, role, rawtext, text, lineno, inliner, *args, **kwargs):
+        macro = macros.jira_issue(text).render(macros.compact_output(inliner.document))
         attributes = {'format': 'html'}
-        return [nodes.raw('', macro.format(key=text), **attributes)], []
+        return [nodes.raw('', macro, **attributes)], []
 
 
 class JiraUserRole(roles.GenericRole):
-    def __call__(self, role, rawtext, text, *args, **kwargs):
-        macro = """\
-        <ac:link>
-            <ri:user ri:username="{username}"/>
-        </ac:link>
-        """
+    def __call__(self, role, rawtext, text, lineno, inliner, *args, **kwargs):
+        macro = macros.user_link(text).render(macros.compact_output(inliner.document))
         attributes = {'format': 'html'}
-        return [nodes.raw('', macro.format(username=text), **attributes)], []
+        return [nodes.raw('', macro, **attributes)], []
 
 
 
@@ -624,10 +818,9 @@ class CaptionedCodeBlock(CodeBlock):
 class EmoteDirective(Directive):
     required_arguments = 1
     def run(self):
-        macro = """<ac:emoticon ac:name="{name}" />"""
         attributes = {'format': 'html'}
         name = self.arguments[0]
-        raw_node = nodes.raw('', macro.format(name=name), **attributes)
+        raw_node = nodes.raw('', macros.emoticon(name).render(compact=True), **attributes)
         return [raw_node]
 
 def underscore_to_camelcase(text):
@@ -642,60 +835,272 @@ def get_path():
 
 
 def find_page(pages, **params):
-    for page in pages:
+    for page in iter_pages(pages):
         if all(page.get(param) == value for param, value in params.items()):
             return page
     else:
         return None
 
 
+def get_page_index(app):
+    """
+    :class:`~sphinx_confluence.pages.PageIndex` of ``sphinx_confluence_pages``,
+    built once per build
+    """
+    index = getattr(app.builder, 'confluence_page_index', None)
+    if index is None:
+        index = app.builder.confluence_page_index = PageIndex(app.config.sphinx_confluence_pages)
+    return index
+
+
+def get_reference_resolver(builder):
+    """
+    :class:`~sphinx_confluence.references.ReferenceResolver` shared by all
+    translators of a build
+    """
+    resolver = getattr(builder, 'confluence_reference_resolver', None)
+    if resolver is None:
+        resolver = builder.confluence_reference_resolver = ReferenceResolver(count_targets(builder.env))
+    return resolver
+
+
+def target_docname(app, docname, uri):
+    """
+    Docname a relative ``uri`` written into ``docname`` points to, ``None`` if
+    it is not a document of the project
+    """
+    base = posixpath.dirname(app.builder.get_target_uri(docname))
+    target = posixpath.normpath(posixpath.join(base, uri)) if uri else docname
+    link_suffix = getattr(app.builder, 'link_suffix', '')
+    if link_suffix and target.endswith(link_suffix):
+        target = target[:-len(link_suffix)]
+    for candidate in (target, posixpath.join(target, 'index')):
+        if candidate in app.env.found_docs:
+            return candidate
+    return None
+
+
+def find_reference_page(app, index, docname, uri):
+    """
+    Page of the document ``uri`` (relative to the uri of ``docname``) points
+    to. Falls back to resolving ``uri`` against the current directory, which
+    is all earlier versions did.
+    """
+    target = target_docname(app, docname, uri)
+    if target is not None:
+        page = index.find_by_path(os.path.join(app.srcdir, target)) or index.find_by_docname(target)
+        if page is not None:
+            return page
+    return index.find_by_path(uri)
+
 
 def fix_references(app, doctree, docname):
-    pages = app.config.sphinx_confluence_pages
-    for page in pages:
-        if page.get('local_path').endswith(docname):
-            break
-    else:
+    index = get_page_index(app)
+    if index.find_by_docname(docname) is None:
         logger.debug('Didn\'t find confluence page for %s', docname)
         return
 
-    for node in doctree.traverse():
-        if hasattr(node, 'tagname') and node.tagname == 'reference':
-            if "refuri" in node:
-                uri = node.get('refuri')
-                if 'http' in uri:
-                    continue
-                parts = uri.split('/')
-                if len(parts) < 2:
-                    continue
-                clean_uri = '/'.join(part for part in parts if not part.startswith('#'))
-                docpath = os.path.abspath(clean_uri)
-                realpage = find_page(pages, local_path=docpath)
-                if realpage:
-                    logger.debug('Confluence page \'%s\' found for reference node with uri %s', realpage.get('title'), uri)
-                    node['refpage'] = realpage
+    for node in doctree.traverse(nodes.reference):
+        if "refuri" in node:
+            uri = node.get('refuri')
+            if 'http' in uri:
+                continue
+            parts = uri.split('/')
+            if len(parts) < 2:
+                continue
+            clean_uri = '/'.join(part for part in parts if not part.startswith('#'))
+            refdoc = target_docname(app, docname, clean_uri)
+            realpage = find_reference_page(app, index, docname, clean_uri)
+            if realpage and 'server_path' in realpage:
+                logger.debug('Confluence page \'%s\' found for reference node with uri %s', realpage.get('title'), uri)
+                # only what the translator needs; doctrees are pickled to the
+                # worker processes of a parallel write
+                node['refpage'] = {'server_path': realpage['server_path'],
+                                   'short_title': realpage.get('short_title'),
+                                   'title': realpage.get('title')}
+                anchor = parts[-1][1:] if parts[-1].startswith('#') else None
+                if anchor and refdoc is not None:
+                    link = split.part_links(get_parts(app.builder, refdoc)).get(anchor)
+                    if link is not None:
+                        node['refpage'].update(part_title=link[0], part_anchor=link[1])
+
+
+def collect_titles(app, doctree):
+    """
+    Remember the first section title of every document; confluence uses it as
+    the page title and as the prefix of all anchors on the page.
+    """
+    env = app.builder.env
+    if not hasattr(env, '_confluence_titles'):
+        env._confluence_titles = {}
+    for section in doctree.traverse(nodes.section):
+        if len(section) and isinstance(section[0], nodes.title) and len(section[0]):
+            env._confluence_titles[env.docname] = section[0][0].astext()
+        break
 
 
-def publish_main(app, exception):
-    if exception is not None:
+def purge_titles(app, env, docname):
+    if hasattr(env, '_confluence_titles'):
+        env._confluence_titles.pop(docname, None)
+
+
+def merge_titles(app, env, docnames, other):
+    if not hasattr(other, '_confluence_titles'):
         return
+    if not hasattr(env, '_confluence_titles'):
+        env._confluence_titles = {}
+    for docname in docnames:
+        if docname in other._confluence_titles:
+            env._confluence_titles[docname] = other._confluence_titles[docname]
 
-    if app.config.sphinx_confluence_publish is False:
+
+def get_parts(builder, docname):
+    """
+    Parts of a document split into child pages, empty unless ``builder`` is
+    the confluence builder, the only one writing them as pages of their own
+    """
+    if builder.name != ConfluenceStorageBuilder.name:
+        return []
+    return getattr(builder.env, '_confluence_parts', {}).get(docname, [])
+
+
+def collect_parts(app, doctree):
+    """
+    Decide whether a document is split into child pages, see
+    ``sphinx_confluence_split_level`` and ``sphinx_confluence_split_size``
+    """
+    env = app.builder.env
+    if not hasattr(env, '_confluence_parts'):
+        env._confluence_parts = {}
+    env._confluence_parts.pop(env.docname, None)
+
+    level = app.config.sphinx_confluence_split_level
+    size = app.config.sphinx_confluence_split_size
+    if not level and not size:
+        return
+    if size and split.document_size(doctree, int(size)) <= int(size):
         return
+
+    parts = split.find_parts(env.docname, doctree, int(level or 2), app.config.sphinx_confluence_split_title,
+                             getattr(env, '_confluence_titles', {}).get(env.docname))
+    if parts:
+        logger.verbose('%s: split into %d child pages', env.docname, len(parts))
+        env._confluence_parts[env.docname] = parts
+
+
+def purge_parts(app, env, docname):
+    if hasattr(env, '_confluence_parts'):
+        env._confluence_parts.pop(docname, None)
+
+
+def merge_parts(app, env, docnames, other):
+    if not hasattr(other, '_confluence_parts'):
+        return
+    if not hasattr(env, '_confluence_parts'):
+        env._confluence_parts = {}
+    for docname in docnames:
+        if docname in other._confluence_parts:
+            env._confluence_parts[docname] = other._confluence_parts[docname]
+
+
+def create_app_publisher(app):
+    """
+    Publisher configured by the ``sphinx_confluence_*`` settings
+
+    :return: ``(publisher, metrics, publish_options)``
+    """
     try:
-        from conf_publisher.publish import DEFAULT_CONFLUENCE_API_VERSION, create_publisher, create_confluence_api, parse_authentication, ConfigLoader
+        from conf_publisher.publish import parse_authentication, ConfigLoader
+        from sphinx_confluence.api import PublishMetrics, RequestScheduler, create_confluence_api
+        from sphinx_confluence.publish import PublishManifest, create_publisher
     except ImportError:
         raise ImportError("Could not import from conf_publisher. Is confluence-publisher installed?")
 
-    publish_options = app.config.sphinx_confluence_publish_options
+    publish_options = dict(app.config.sphinx_confluence_publish_options)
     auth_options = publish_options.pop('auth')
     auth = parse_authentication(**auth_options)
     config = ConfigLoader.from_yaml(app.config.sphinx_confluence_config_path)
 
-    confluence_api = create_confluence_api(DEFAULT_CONFLUENCE_API_VERSION, config.url, auth)
-    publisher = create_publisher(config, confluence_api)
-    print('Publishing...')
-    publisher.publish(**publish_options)
+    manifest_path = app.config.sphinx_confluence_manifest_path
+    if manifest_path is None:
+        manifest_path = os.path.dirname(os.path.abspath(app.config.sphinx_confluence_config_path))
+    manifest = PublishManifest(manifest_path) if manifest_path is not False else None
+
+    metrics = PublishMetrics()
+    scheduler = RequestScheduler(rate=app.config.sphinx_confluence_request_rate,
+                                 max_concurrency=app.config.sphinx_confluence_publish_workers,
+                                 retries=app.config.sphinx_confluence_request_retries)
+    confluence_api = create_confluence_api(config.url, auth, metrics, scheduler)
+    publisher = create_publisher(config, confluence_api, manifest,
+                                 max_workers=app.config.sphinx_confluence_publish_workers)
+    return publisher, metrics, publish_options
+
+
+def start_publish_pipeline(app, docnames):
+    """
+    Start publishing the pages of the confluence builder while it writes
+    ``docnames``
+    """
+    from sphinx_confluence.publish import PublishPipeline
+
+    publisher, metrics, publish_options = create_app_publisher(app)
+    pipeline = PublishPipeline(publisher, metrics, timeout=app.config.sphinx_confluence_publish_pipeline_timeout,
+                               **publish_options)
+    print('Publishing while writing...')
+    pipeline.start(docnames)
+    return pipeline
+
+
+def publish_main(app, exception):
+    pipeline = getattr(app.builder, 'publish_pipeline', None)
+    if exception is not None:
+        if pipeline is not None:
+            logger.warning('Build failed, cancelling the pending uploads')
+            pipeline.stop()
+        return
+
+    if app.config.sphinx_confluence_publish is False:
+        return
+    from sphinx_confluence.publish import PublishError
+
+    if pipeline is not None:
+        metrics = pipeline.metrics
+        run = pipeline.finish
+        print('Waiting for the pending uploads...')
+    else:
+        if app.config.sphinx_confluence_publish_pipeline:
+            logger.warning('sphinx_confluence_publish_pipeline requires the confluence builder, '
+                           'publishing after the build')
+        publisher, metrics, publish_options = create_app_publisher(app)
+        run = lambda: publisher.publish(**publish_options)
+        print('Publishing...')
+    results = None
+    try:
+        results = run()
+    except PublishError as e:
+        results = e.results
+        raise
+    finally:
+        metrics.finish(results)
+        metrics.log_summary()
+        write_publish_metrics(app, metrics)
+
+
+def write_publish_metrics(app, metrics):
+    """
+    Write the publish report to ``sphinx_confluence_publish_metrics_path`` and
+    the Prometheus textfile to ``sphinx_confluence_publish_prometheus_path``
+    """
+    report_path = app.config.sphinx_confluence_publish_metrics_path
+    if report_path is None:
+        report_path = os.path.join(app.outdir, 'sphinx_confluence_publish_metrics.json')
+    for path, prometheus in ((report_path, False), (app.config.sphinx_confluence_publish_prometheus_path, True)):
+        if not path:
+            continue
+        try:
+            metrics.write(path, prometheus=prometheus)
+        except (IOError, OSError) as e:
+            logger.warning('Could not write publish metrics to %s: %s', path, e)
 
 
 def setup(app):
@@ -707,6 +1112,22 @@ def setup(app):
     app.add_config_value('sphinx_confluence_publish', False, False)
     app.add_config_value('sphinx_confluence_config_path', 'config.yml', False)
     app.add_config_value('sphinx_confluence_publish_options', dict(), False)
+    app.add_config_value('sphinx_confluence_manifest_path', None, False)
+    app.add_config_value('sphinx_confluence_publish_workers', 4, False)
+    app.add_config_value('sphinx_confluence_publish_pipeline', False, False)
+    app.add_config_value('sphinx_confluence_publish_pipeline_timeout', 3600, False)
+    app.add_config_value('sphinx_confluence_publish_metrics_path', None, False)
+    app.add_config_value('sphinx_confluence_request_rate', None, False)
+    app.add_config_value('sphinx_confluence_request_retries', 5, False)
+    app.add_config_value('sphinx_confluence_publish_prometheus_path', None, False)
+    app.add_config_value('sphinx_confluence_stream_output', False, False)
+    app.add_config_value('sphinx_confluence_stream_buffer_size', 1024 * 1024, False)
+    app.add_config_value('sphinx_confluence_compact_output', False, 'env')
+    app.add_config_value('sphinx_confluence_literal_block_max_size', None, False)
+    app.add_config_value('sphinx_confluence_literal_block_preview_lines', 20, False)
+    app.add_config_value('sphinx_confluence_split_level', None, 'env')
+    app.add_config_value('sphinx_confluence_split_size', None, 'env')
+    app.add_config_value('sphinx_confluence_split_title', '{page} - {section}', 'env')
 
 
     app.config.html_theme_path = [get_path()]
@@ -715,6 +1136,7 @@ def setup(app):
     if LooseVersion(sphinx.__version__) >= LooseVersion("1.4"):
         app.set_translator("html", HTMLConfluenceTranslator)
         app.set_translator("json", HTMLConfluenceTranslator)
+        app.set_translator("confluence", HTMLConfluenceTranslator)
     else:
         app.config.html_translator_class = 'sphinx_confluence.HTMLConfluenceTranslator'
     app.config.html_add_permalinks = ''
@@ -730,11 +1152,24 @@ def setup(app):
     app.add_directive('jira_issues', JiraIssuesDirective)
     app.add_directive('code-block', CaptionedCodeBlock)
     app.add_directive('emote', EmoteDirective)
+    app.connect('doctree-read', collect_titles)
+    app.connect('env-purge-doc', purge_titles)
+    app.connect('env-merge-info', merge_titles)
+    app.connect('doctree-read', collect_parts)
+    app.connect('env-purge-doc', purge_parts)
+    app.connect('env-merge-info', merge_parts)
     app.connect('doctree-resolved', fix_references)
     app.connect('build-finished', publish_main)
+    instrumentation.setup(app)
 
 
     app.add_builder(JSONConfluenceBuilder)
+    app.add_builder(ConfluenceStorageBuilder)
+
+    return {'version': __version__,
+            'env_version': 1,
+            'parallel_read_safe': True,
+            'parallel_write_safe': True}
 
 if __name__ == '__main__':
     publish_main()
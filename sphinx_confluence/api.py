@@ -0,0 +1,432 @@
+# -*- coding: utf-8 -*-
+"""
+Confluence REST API client shared by page resolution and publishing
+
+:class:`ConfluenceApi` is the confluence-publisher client with every request
+metered into :class:`PublishMetrics`: latency histograms per endpoint,
+failed requests, retries and bytes transferred. Requests go through a
+:class:`RequestScheduler`, which rate limits them, retries throttled and
+transient failures and adapts the number of concurrent requests to the
+throttling of the server.
+
+This module requires ``conf_publisher``.
+
+"""
+
+from email.utils import parsedate_to_datetime
+import io
+import json
+import os
+import random
+import re
+import threading
+import time
+
+from conf_publisher.confluence_api import ConfluenceRestApi553
+import requests
+
+from sphinx.util import logging
+
+logger = logging.getLogger(__name__)
+
+ID_SEGMENT = re.compile(r'^\d+$')
+
+
+def new_histogram(buckets):
+    return {'count': 0, 'errors': 0, 'sum': 0.0, 'buckets': [0] * (len(buckets) + 1)}
+
+
+def file_size(f):
+    try:
+        return os.fstat(f.fileno()).st_size
+    except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+        return 0
+
+
+class PublishMetrics(object):
+    """
+    Thread safe counters of a publish run.
+
+    ``endpoints`` maps an endpoint (``GET content/{id}``) to its request count,
+    failed requests, summed latency and a histogram of latencies over
+    :attr:`buckets` (plus one for everything slower).
+    """
+
+    #: Upper bounds of the latency histogram buckets in seconds
+    buckets = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.clock = time.perf_counter()
+        self.elapsed = None
+        self.endpoints = {}
+        self.retries = {}
+        self.sent = 0
+        self.received = 0
+        self.uploaded_pages = {}
+        self.uploaded_attachments = {}
+        self.pages = {}
+
+    def observe(self, endpoint, seconds, error=False, sent=0, received=0):
+        with self.lock:
+            histogram = self.endpoints.get(endpoint)
+            if histogram is None:
+                histogram = self.endpoints[endpoint] = new_histogram(self.buckets)
+            histogram['count'] += 1
+            histogram['sum'] += seconds
+            if error:
+                histogram['errors'] += 1
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    break
+            else:
+                i = len(self.buckets)
+            histogram['buckets'][i] += 1
+            self.sent += sent
+            self.received += received
+
+    def retry(self, endpoint):
+        with self.lock:
+            self.retries[endpoint] = self.retries.get(endpoint, 0) + 1
+
+    def uploaded(self, kind, key, size):
+        """
+        Count ``size`` bytes uploaded for a page (``kind`` ``page``, keyed by
+        content id) or an attachment (``attachment``, keyed by
+        ``<content id>/<filename>``)
+        """
+        counters = self.uploaded_pages if kind == 'page' else self.uploaded_attachments
+        with self.lock:
+            counters[key] = counters.get(key, 0) + size
+
+    def finish(self, results):
+        """
+        Stop the clock and count the pages by :class:`PublishResult` status
+        """
+        self.elapsed = time.perf_counter() - self.clock
+        for result in results or ():
+            self.pages[result.status] = self.pages.get(result.status, 0) + 1
+
+    @property
+    def pages_per_second(self):
+        published = self.pages.get('published', 0)
+        return published / self.elapsed if self.elapsed else 0.0
+
+    def report(self):
+        with self.lock:
+            return {
+                'started': self.started,
+                'elapsed': self.elapsed,
+                'pages': dict(self.pages),
+                'pages_per_second': self.pages_per_second,
+                'requests': sum(histogram['count'] for histogram in self.endpoints.values()),
+                'retries': dict(self.retries),
+                'bytes_sent': self.sent,
+                'bytes_received': self.received,
+                'uploaded_pages': dict(self.uploaded_pages),
+                'uploaded_attachments': dict(self.uploaded_attachments),
+                'latency_buckets': list(self.buckets),
+                'endpoints': json.loads(json.dumps(self.endpoints)),
+            }
+
+    def prometheus(self, prefix='sphinx_confluence'):
+        """
+        The metrics in the Prometheus text exposition format, for the textfile
+        collector of node_exporter
+        """
+        report = self.report()
+        lines = []
+
+        def metric(name, kind, help_text):
+            lines.append('# HELP {}_{} {}'.format(prefix, name, help_text))
+            lines.append('# TYPE {}_{} {}'.format(prefix, name, kind))
+
+        def sample(name, value, **labels):
+            label_text = ','.join('{}="{}"'.format(key, str(labels[key]).replace('\\', '\\\\').replace('"', '\\"'))
+                                  for key in sorted(labels))
+            lines.append('{}_{}{} {}'.format(prefix, name, '{' + label_text + '}' if label_text else '', value))
+
+        metric('request_duration_seconds', 'histogram', 'Latency of confluence REST requests')
+        for endpoint, histogram in sorted(report['endpoints'].items()):
+            cumulative = 0
+            for bound, count in zip(list(self.buckets) + ['+Inf'], histogram['buckets']):
+                cumulative += count
+                sample('request_duration_seconds_bucket', cumulative, endpoint=endpoint, le=bound)
+            sample('request_duration_seconds_sum', repr(histogram['sum']), endpoint=endpoint)
+            sample('request_duration_seconds_count', histogram['count'], endpoint=endpoint)
+        metric('request_errors_total', 'counter', 'Failed confluence REST requests')
+        for endpoint, histogram in sorted(report['endpoints'].items()):
+            sample('request_errors_total', histogram['errors'], endpoint=endpoint)
+        metric('request_retries_total', 'counter', 'Retried confluence REST requests')
+        for endpoint, count in sorted(report['retries'].items()):
+            sample('request_retries_total', count, endpoint=endpoint)
+        metric('transferred_bytes_total', 'counter', 'Bytes sent to and received from confluence')
+        sample('transferred_bytes_total', report['bytes_sent'], direction='sent')
+        sample('transferred_bytes_total', report['bytes_received'], direction='received')
+        metric('uploaded_bytes_total', 'counter', 'Bytes of page bodies and attachments uploaded')
+        sample('uploaded_bytes_total', sum(report['uploaded_pages'].values()), kind='page')
+        sample('uploaded_bytes_total', sum(report['uploaded_attachments'].values()), kind='attachment')
+        metric('publish_pages', 'gauge', 'Pages of the last publish by status')
+        for status, count in sorted(report['pages'].items()):
+            sample('publish_pages', count, status=status)
+        metric('publish_duration_seconds', 'gauge', 'Duration of the last publish')
+        sample('publish_duration_seconds', repr(report['elapsed'] or 0.0))
+        metric('publish_pages_per_second', 'gauge', 'Published pages per second of the last publish')
+        sample('publish_pages_per_second', repr(report['pages_per_second']))
+        metric('publish_timestamp_seconds', 'gauge', 'Start of the last publish')
+        sample('publish_timestamp_seconds', repr(report['started']))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path, prometheus=False):
+        """
+        Write the report (or the Prometheus textfile) atomically to ``path``
+        """
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        content = self.prometheus() if prometheus else json.dumps(self.report(), indent=1, sort_keys=True)
+        tmp_path = path + '.tmp'
+        with io.open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+    def log_summary(self):
+        report = self.report()
+        logger.info('Published %d pages in %.1fs (%.2f pages/s): %d requests, %d retries, %d KiB sent, %d KiB received',
+                    report['pages'].get('published', 0), report['elapsed'] or 0.0, report['pages_per_second'],
+                    report['requests'], sum(report['retries'].values()),
+                    report['bytes_sent'] // 1024, report['bytes_received'] // 1024)
+        for endpoint, histogram in sorted(report['endpoints'].items(), key=lambda item: -item[1]['sum']):
+            logger.verbose('  %-50s %6d requests %4d failed, %.3fs mean', endpoint, histogram['count'],
+                           histogram['errors'], histogram['sum'] / histogram['count'])
+
+
+def retry_after(response):
+    """
+    Seconds to wait according to the ``Retry-After`` header of a response
+    (delay seconds or an HTTP date), ``None`` without a usable header
+    """
+    value = response.headers.get('Retry-After') if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+class RequestScheduler(object):
+    """
+    Shared admission control for the requests of one confluence client.
+
+    A token bucket limits requests to ``rate`` per second with bursts of up to
+    ``burst`` requests (``rate=None`` disables it). The number of requests in
+    flight is limited by an AIMD window between 1 and ``max_concurrency``: it
+    is halved whenever confluence throttles (at most once per ``cooldown``
+    seconds) and grows by one request per window of successful requests.
+    Throttled (429), unavailable (502, 503, 504) and failed connections are
+    retried up to ``retries`` times with jittered exponential backoff, or after
+    ``Retry-After`` if the server sends it, which pauses every request.
+    """
+
+    #: Status codes that are retried
+    retry_statuses = frozenset((429, 502, 503, 504))
+
+    #: Status codes that mean the server throttles and shrink the window
+    throttle_statuses = frozenset((429, 503))
+
+    def __init__(self, rate=None, burst=None, max_concurrency=8, retries=5, backoff=0.5, max_backoff=60.0,
+                 cooldown=1.0):
+        self.rate = float(rate) if rate else None
+        self.burst = float(burst or max(1.0, self.rate or 1.0))
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.retries = max(0, int(retries))
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.cooldown = cooldown
+        self.window = float(self.max_concurrency)
+        self.in_flight = 0
+        self.tokens = self.burst
+        self.refilled = time.monotonic()
+        self.paused_until = 0.0
+        self.throttled_at = 0.0
+        self.condition = threading.Condition()
+
+    def _refill(self, now):
+        if self.rate is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+
+    def acquire(self):
+        """
+        Block until a request may be sent
+        """
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self.paused_until - now
+                if wait <= 0 and self.in_flight >= int(self.window):
+                    wait = None
+                elif wait <= 0 and self.rate is not None and self.tokens < 1:
+                    wait = (1 - self.tokens) / self.rate
+                elif wait <= 0:
+                    break
+                self.condition.wait(wait)
+            if self.rate is not None:
+                self.tokens -= 1
+            self.in_flight += 1
+
+    def release(self, throttled=False):
+        with self.condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if throttled:
+                if now - self.throttled_at >= self.cooldown:
+                    self.throttled_at = now
+                    self.window = max(1.0, self.window / 2)
+                    logger.verbose('Confluence is throttling, limiting to %d concurrent requests', int(self.window))
+            elif self.window < self.max_concurrency:
+                self.window = min(float(self.max_concurrency), self.window + 1.0 / self.window)
+            self.condition.notify_all()
+
+    def pause(self, seconds):
+        with self.condition:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def delay(self, attempt, response=None):
+        """
+        Seconds to wait before retry number ``attempt`` (counting from 1)
+        """
+        seconds = retry_after(response)
+        if seconds is not None:
+            self.pause(seconds)
+            return seconds
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def retryable(self, response):
+        return response is not None and response.status_code in self.retry_statuses
+
+
+class ConfluenceApi(ConfluenceRestApi553):
+    """
+    confluence-publisher REST client metering every request into ``metrics``
+    and sending it through ``scheduler``
+    """
+
+    def __init__(self, url, auth, metrics=None, scheduler=None):
+        super(ConfluenceApi, self).__init__(url, auth)
+        self.metrics = metrics if metrics is not None else PublishMetrics()
+        self.scheduler = scheduler if scheduler is not None else RequestScheduler()
+
+    def endpoint(self, requester, url):
+        """
+        Method and path of a request with content ids replaced by ``{id}``,
+        e.g. ``PUT content/{id}``
+        """
+        path = url.split('?', 1)[0]
+        prefix = '/'.join([self.confluence_url, self.api_path]) + '/'
+        if path.startswith(prefix):
+            path = path[len(prefix):]
+        path = '/'.join('{id}' if ID_SEGMENT.match(part) else part for part in path.split('/'))
+        return '{} {}'.format(getattr(requester, '__name__', 'request').upper(), path)
+
+    def _account_upload(self, url, kwargs):
+        """
+        Bytes a request uploads, counted against its page or attachment
+        """
+        parts = url.split('?', 1)[0].split('/')
+        content_id = next((part for part in reversed(parts) if ID_SEGMENT.match(part)), None)
+        if kwargs.get('files'):
+            size = 0
+            for f in kwargs['files'].values():
+                if isinstance(f, tuple):
+                    f = f[1]
+                attachment_size = file_size(f)
+                size += attachment_size
+                self.metrics.uploaded('attachment', '{}/{}'.format(
+                    parts[parts.index('content') + 1] if 'content' in parts else '?',
+                    os.path.basename(getattr(f, 'name', '?'))), attachment_size)
+            return size
+        data = kwargs.get('json')
+        if data is not None:
+            size = len(json.dumps(data).encode('utf-8'))
+            if isinstance(data, dict) and data.get('type') == 'page':
+                self.metrics.uploaded('page', content_id or data.get('title'), size)
+            return size
+        return 0
+
+    def search_content(self, cql, expand=None, start=0, limit=25):
+        """
+        Returns a paginated list of the content matching a CQL query.
+
+        GET /rest/api/content/search?cql&expand&start&limit
+        """
+        params = self._build_params({'cql': cql, 'expand': expand, 'start': start, 'limit': limit})
+        return self._get(self._construct_url('content', 'search'), params=params)
+
+    @staticmethod
+    def _rewind(kwargs):
+        """
+        Seek the uploaded files back to their start before a retry
+        """
+        for f in (kwargs.get('files') or {}).values():
+            if isinstance(f, tuple):
+                f = f[1]
+            if hasattr(f, 'seek'):
+                f.seek(0)
+
+    def _request(self, requester, url, **kwargs):
+        endpoint = self.endpoint(requester, url)
+        sent = self._account_upload(url, kwargs)
+        metrics = self.metrics
+        scheduler = self.scheduler
+
+        def metered(*args, **kw):
+            start = time.perf_counter()
+            response = None
+            try:
+                response = requester(*args, **kw)
+                return response
+            finally:
+                failed = response is None or response.status_code >= 400
+                received = len(response.content or b'') if response is not None else 0
+                metrics.observe(endpoint, time.perf_counter() - start, failed, sent, received)
+
+        def scheduled(*args, **kw):
+            attempt = 0
+            while True:
+                response = None
+                scheduler.acquire()
+                try:
+                    response = metered(*args, **kw)
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    if attempt >= scheduler.retries:
+                        raise
+                    logger.debug('%s failed (%s), retrying', endpoint, e)
+                finally:
+                    scheduler.release(response is not None
+                                      and response.status_code in scheduler.throttle_statuses)
+
+                if response is not None and (not scheduler.retryable(response) or attempt >= scheduler.retries):
+                    return response
+                attempt += 1
+                metrics.retry(endpoint)
+                delay = scheduler.delay(attempt, response)
+                if response is not None:
+                    logger.debug('%s returned %d, retry %d of %d in %.1fs', endpoint, response.status_code,
+                                 attempt, scheduler.retries, delay)
+                time.sleep(delay)
+                self._rewind(kw)
+        scheduled.__name__ = getattr(requester, '__name__', 'request')
+
+        return super(ConfluenceApi, self)._request(scheduled, url, **kwargs)
+
+
+def create_confluence_api(url, auth, metrics=None, scheduler=None):
+    return ConfluenceApi(url, auth, metrics, scheduler)
@@ -9,8 +9,18 @@
     :license: BSD, see LICENSE for details.
 """
 
+import ast
+import hashlib
+import io
+import json
+import multiprocessing
+import multiprocessing.util
+import os
+import time
 import traceback
+from urllib.parse import urlparse
 
+import pygments
 from six import iteritems, text_type
 
 from docutils import nodes
@@ -18,21 +28,188 @@ from docutils import nodes
 import sphinx
 from sphinx import addnodes
 from sphinx.locale import _
-from sphinx.pycode import ModuleAnalyzer
+from sphinx.pycode import ModuleAnalyzer, PycodeError
 from sphinx.util import logging, status_iterator#, get_full_modname
 from sphinx.util.nodes import make_refnode
+from sphinx.util.osutil import ensuredir
 import sys
 
 if False:
     # For type annotation
-    from typing import Any, Dict, Iterable, Iterator, Set, Tuple  # NOQA
+    from typing import Any, Dict, Iterable, Iterator, List, Set, Tuple  # NOQA
     from sphinx.application import Sphinx  # NOQA
+    from sphinx.config import Config  # NOQA
     from sphinx.environment import BuildEnvironment  # NOQA
 
 logger = logging.getLogger(__name__)
 import inspect
-def get_full_modname(modname, attribute):
-    # type: (str, unicode) -> unicode
+
+
+class SourceLineTable(object):
+    """
+    Per-build memo of where documented objects are defined.
+
+    ``resolved`` maps ``(modname, attribute)`` to the result of
+    :func:`get_full_modname`, failures included. Line numbers come from the
+    tag table of the defining module, which ModuleAnalyzer builds in a single
+    pass over the source; :func:`inspect.getsourcelines` is only used for
+    objects the table does not know (e.g. functions returned by decorators
+    that do not use ``functools.wraps``).
+    """
+
+    #: Maximum number of re-exports followed by :meth:`find_static`
+    max_reexports = 10
+
+    def __init__(self, static=False):
+        self.static = static
+        self.resolved = {}  # type: Dict[Tuple[str, unicode], Any]
+        self.tables = {}  # type: Dict[str, Dict[unicode, Tuple[unicode, int, int]]]
+        self.imports = {}  # type: Dict[str, Tuple[Dict[unicode, Tuple[str, unicode]], List[str]]]
+        self.checked = set()  # type: Set[str]
+
+    def analyzer(self, modname):
+        # type: (str) -> ModuleAnalyzer
+        """
+        ModuleAnalyzer of a module; in static mode (which is also used with an
+        import pool) the source file is looked up on ``sys.path`` instead of
+        importing the module.
+        """
+        if not self.static:
+            return ModuleAnalyzer.for_module(modname)
+        filename = find_module_file(modname)
+        if filename is None:
+            raise PycodeError('no source found for module %r' % modname)
+        return ModuleAnalyzer.for_file(filename, modname)
+
+    def module_file(self, modname):
+        # type: (str) -> unicode
+        """
+        Source file of a module, without reading it
+        """
+        module = None if self.static else sys.modules.get(modname)
+        filename = getattr(module, '__file__', None)
+        if filename and filename.endswith('.py'):
+            return os.path.normpath(os.path.abspath(filename))
+        return find_module_file(modname)
+
+    def module_tags(self, modname):
+        # type: (str) -> Dict[unicode, Tuple[unicode, int, int]]
+        if modname not in self.tables:
+            try:
+                self.tables[modname] = self.analyzer(modname).find_tags()
+            except Exception:
+                self.tables[modname] = {}
+        return self.tables[modname]
+
+    def module_imports(self, modname):
+        # type: (str) -> Tuple[Dict[unicode, Tuple[str, unicode]], List[str]]
+        """
+        Names a module imports at its top level, as a ``{name: (module,
+        attribute)}`` map (``attribute`` is empty for whole modules) and the
+        list of modules it star-imports.
+        """
+        if modname not in self.imports:
+            names, star = {}, []
+            try:
+                analyzer = self.analyzer(modname)
+                tree = ast.parse(analyzer.code)
+            except Exception:
+                tree = None
+            for node in tree.body if tree is not None else ():
+                if isinstance(node, ast.Import):
+                    for alias in node.names:
+                        if alias.asname:
+                            names[alias.asname] = (alias.name, '')
+                elif isinstance(node, ast.ImportFrom):
+                    source = node.module or ''
+                    if node.level:
+                        package = modname
+                        if not analyzer.srcname.endswith('__init__.py'):
+                            package = modname.rpartition('.')[0]
+                        if node.level > 1:
+                            package = '.'.join(package.split('.')[:1 - node.level])
+                        source = '.'.join(part for part in (package, source) if part)
+                    for alias in node.names:
+                        if alias.name == '*':
+                            star.append(source)
+                        else:
+                            names[alias.asname or alias.name] = (source, alias.name)
+            self.imports[modname] = names, star
+        return self.imports[modname]
+
+    def find_static(self, modname, attribute):
+        # type: (str, unicode) -> Tuple[str, int]
+        """
+        Find the module defining ``modname.attribute`` and its line from the
+        source alone, following re-exports (``from ._impl import Widget``).
+        """
+        pending = [(modname, attribute)]
+        seen = set()
+        while pending and len(seen) <= self.max_reexports:
+            modname, attribute = pending.pop(0)
+            if (modname, attribute) in seen:
+                continue
+            seen.add((modname, attribute))
+            tag = self.module_tags(modname).get(attribute)
+            if tag:
+                return modname, tag[1]
+            head, _, rest = attribute.partition('.')
+            names, star = self.module_imports(modname)
+            if head in names:
+                source, name = names[head]
+                if not name:
+                    pending.append((source, rest))
+                elif find_module_file(source + '.' + name):
+                    # ``from package import submodule``
+                    pending.append((source + '.' + name, rest))
+                else:
+                    pending.append((source, '.'.join(part for part in (name, rest) if part)))
+            elif rest and find_module_file(modname + '.' + head):
+                # ``package.submodule.attribute``
+                pending.append((modname + '.' + head, rest))
+            else:
+                pending.extend((source, attribute) for source in star)
+        return None
+
+    def object_line(self, value):
+        # type: (Any) -> int
+        value = inspect.unwrap(value) if callable(value) else value
+        modname = getattr(value, '__module__', None)
+        qualname = getattr(value, '__qualname__', None)
+        if not isinstance(modname, str) or not isinstance(qualname, str):
+            return None
+        tag = self.module_tags(modname).get(qualname)
+        return tag[1] if tag else None
+
+
+def find_module_file(modname):
+    # type: (str) -> unicode
+    """
+    Source file of a module on ``sys.path``, found without importing it
+    """
+    parts = modname.split('.')
+    for base in sys.path:
+        path = os.path.join(base or os.curdir, *parts)
+        for filename in (path + '.py', os.path.join(path, '__init__.py')):
+            if os.path.isfile(filename):
+                return os.path.normpath(os.path.abspath(filename))
+    return None
+
+
+def get_line_table(app):
+    # type: (Sphinx) -> SourceLineTable
+    table = getattr(app.builder, '_viewcode_lines', None)
+    if table is None:
+        # modules are only imported into the build process itself if there is
+        # no import pool to do it
+        static = not app.config.viewcode_import or app.config.viewcode_import_processes > 0
+        table = SourceLineTable(static=static)
+        app.builder._viewcode_lines = table
+    return table
+
+
+def get_full_modname(modname, attribute, line_table=None):
+    # type: (str, unicode, SourceLineTable) -> unicode
     if modname is None:
         # Prevents a TypeError: if the last getattr() call will return None
         # then it's better to return it directly
@@ -45,27 +222,357 @@ def get_full_modname(modname, attribute):
     for attr in attribute.split('.'):
         if attr:
             value = getattr(value, attr)
-    _, line_no = inspect.getsourcelines(value)
+    line_no = line_table.object_line(value) if line_table is not None else None
+    if line_no is None:
+        _, line_no = inspect.getsourcelines(value)
     return getattr(value, '__module__', None), line_no
 
 
+class ModuleRecord(object):
+    """
+    What the environment keeps about a module with documented objects: its
+    source file with mtime and content hash, the ``tags`` table, the ``used``
+    map of tag names to the documents describing them and the ``refname``
+    the module was documented as. The source itself is read again only when
+    a module page is written.
+    """
+
+    def __init__(self, path, mtime, hash, tags, refname):
+        self.path = path
+        self.mtime = mtime
+        self.hash = hash
+        self.tags = tags
+        self.used = {}  # type: Dict[unicode, unicode]
+        self.refname = refname
+
+
+def module_code(analyzer):
+    # type: (ModuleAnalyzer) -> unicode
+    if not isinstance(analyzer.code, text_type):
+        return analyzer.code.decode(analyzer.encoding)
+    return analyzer.code
+
+
+def get_module_record(app, env, modname, refname):
+    # type: (Sphinx, BuildEnvironment, str, str) -> ModuleRecord
+    """
+    Up to date record of a module, checked once per build: an unchanged
+    mtime keeps the record without reading the source, an unchanged content
+    hash keeps it without parsing the source again.
+    """
+    table = get_line_table(app)
+    entry = env._viewcode_modules.get(modname)  # type: ignore
+    if not isinstance(entry, ModuleRecord):
+        # ``False`` for modules that could not be analyzed
+        entry = None
+    if modname in table.checked:
+        return entry
+    table.checked.add(modname)
+
+    path = table.module_file(modname)
+    try:
+        mtime = os.stat(path).st_mtime if path else None
+    except OSError:
+        mtime = None
+    if entry is not None and mtime is not None and entry.path == path and entry.mtime == mtime:
+        return entry
+
+    try:
+        analyzer = table.analyzer(modname)
+        code = module_code(analyzer)
+    except Exception:
+        env._viewcode_modules[modname] = False  # type: ignore
+        return None
+    digest = hashlib.sha1(code.encode('utf-8')).hexdigest()
+    if entry is not None and entry.hash == digest:
+        entry.path, entry.mtime = path, mtime
+        return entry
+
+    record = ModuleRecord(path, mtime, digest, analyzer.find_tags(),
+                          refname or (entry.refname if entry is not None else modname))
+    if entry is not None:
+        # documents that were not read again still describe these objects
+        record.used.update((name, docname) for name, docname in iteritems(entry.used)
+                           if name in record.tags)
+    env._viewcode_modules[modname] = record  # type: ignore
+    return record
+
+
+class HighlightCache(object):
+    """
+    On-disk cache of highlighted module sources, one file per code hash,
+    lexer and highlighting settings, so unchanged modules are not run through
+    Pygments again. Entries not used by a build are removed by :meth:`prune`.
+
+    ``options`` are the build settings that change the highlighted output,
+    see :func:`highlight_settings`.
+    """
+
+    def __init__(self, path, options=None):
+        self.path = path
+        self.options = options or {}
+        self.used = set()  # type: Set[str]
+        self.hits = 0
+
+    def key(self, highlighter, code, lexer):
+        # type: (Any, unicode, unicode) -> str
+        formatter = getattr(highlighter, 'formatter', None)
+        formatter_args = getattr(highlighter, 'formatter_args', {})
+        digest = hashlib.sha256()
+        for part in (sphinx.__display_version__, pygments.__version__,
+                     getattr(highlighter, 'dest', 'html'),
+                     '%s.%s' % (getattr(formatter, '__module__', ''), getattr(formatter, '__name__', '')),
+                     repr(sorted(formatter_args.items())),
+                     json.dumps(self.options, sort_keys=True, default=repr),
+                     lexer, code):
+            digest.update(part.encode('utf-8') + b'\0')
+        return digest.hexdigest()
+
+    def highlight(self, highlighter, code, lexer):
+        # type: (Any, unicode, unicode) -> unicode
+        key = self.key(highlighter, code, lexer)
+        self.used.add(key)
+        filename = os.path.join(self.path, key + '.html')
+        try:
+            with io.open(filename, encoding='utf-8') as f:
+                highlighted = f.read()
+            self.hits += 1
+            return highlighted
+        except (IOError, OSError):
+            pass
+        highlighted = highlighter.highlight_block(code, lexer, linenos=False)
+        try:
+            ensuredir(self.path)
+            with io.open(filename + '.tmp', 'w', encoding='utf-8') as f:
+                f.write(highlighted)
+            os.replace(filename + '.tmp', filename)
+        except (IOError, OSError) as e:
+            logger.verbose('Could not cache highlighted code in %s: %s', filename, e)
+        return highlighted
+
+    def prune(self):
+        if not os.path.isdir(self.path):
+            return
+        for filename in os.listdir(self.path):
+            if os.path.splitext(filename)[0] not in self.used:
+                try:
+                    os.remove(os.path.join(self.path, filename))
+                except OSError:
+                    pass
+
+
+def highlight_settings(config):
+    # type: (Config) -> Dict[unicode, Any]
+    """
+    Settings of the build that change how module code is highlighted
+    """
+    return {'pygments_style': config.pygments_style,
+            'highlight_options': config.highlight_options,
+            'trim_doctest_flags': config.trim_doctest_flags}
+
+
+def links_are_external(config):
+    # type: (Config) -> bool
+    """
+    Whether ``[source]`` links point to a repository browser rather than to
+    the ``_modules`` pages
+    """
+    url = urlparse(config.sphinx_confluence_repo_path)
+    return bool(url.scheme or url.netloc)
+
+
 def _get_full_modname(app, modname, attribute):
     # type: (Sphinx, str, unicode) -> unicode
+    table = get_line_table(app)
+    key = (modname, attribute)
+    if key not in table.resolved:
+        table.resolved[key] = _resolve_full_modname(table, modname, attribute)
+    return table.resolved[key]
+
+
+def _get_static_modname(app, modname, attribute):
+    # type: (Sphinx, str, unicode) -> Tuple[str, int]
+    table = get_line_table(app)
+    key = (modname, attribute)
+    if key not in table.resolved:
+        table.resolved[key] = table.find_static(modname, attribute) if modname else None
+        if table.resolved[key] is None:
+            logger.verbose('Didn\'t find the source of %s in %s', attribute, modname)
+    return table.resolved[key]
+
+
+def _resolve_full_modname(table, modname, attribute):
+    # type: (SourceLineTable, str, unicode) -> unicode
+    result, messages = _try_full_modname(table, modname, attribute)
+    for message in messages:
+        logger.verbose(message)
+    return result
+
+
+def _try_full_modname(table, modname, attribute):
+    # type: (SourceLineTable, str, unicode) -> Tuple[Any, List[unicode]]
+    """
+    :func:`get_full_modname` returning the messages to log along with the
+    result, so worker processes can hand them back to the build
+    """
     try:
-        return get_full_modname(modname, attribute)
+        return get_full_modname(modname, attribute, table), []
     except AttributeError:
         # sphinx.ext.viewcode can't follow class instance attribute
         # then AttributeError logging output only verbose mode.
-        logger.verbose('Didn\'t find %s in %s', attribute, modname)
-        return None
+        return None, ['Didn\'t find %s in %s' % (attribute, modname)]
     except Exception as e:
         # sphinx.ext.viewcode follow python domain directives.
         # because of that, if there are no real modules exists that specified
         # by py:function or other directives, viewcode emits a lot of warnings.
         # It should be displayed only verbose mode.
-        logger.verbose(traceback.format_exc().rstrip())
-        logger.verbose('viewcode can\'t import %s, failed with error "%s"', modname, e)
-        return None
+        return None, [traceback.format_exc().rstrip(),
+                      'viewcode can\'t import %s, failed with error "%s"' % (modname, e)]
+
+
+# line table of an import pool worker process
+_worker_table = None
+
+
+def _init_import_worker(path):
+    # type: (List[unicode]) -> None
+    global _worker_table
+    sys.path[:] = path
+    _worker_table = SourceLineTable()
+
+
+def _import_worker(modname, attributes):
+    # type: (str, List[unicode]) -> Dict[unicode, Tuple[Any, List[unicode]]]
+    return dict((attribute, _try_full_modname(_worker_table, modname, attribute))
+                for attribute in attributes)
+
+
+class ImportPool(object):
+    """
+    Resolves ``(modname, attribute)`` pairs by importing the modules in a
+    pool of worker processes, so the documented packages and their
+    dependencies are never imported into the build process.
+
+    Every module is imported by a single task; tasks of independent modules
+    run in parallel. At most ``processes`` tasks are submitted at a time, so
+    a task starts right away and is given ``timeout`` seconds from its
+    submission. A module that takes longer is given up on and the pool is
+    replaced, as the worker importing it may hang forever; the tasks that
+    were still running are submitted again with a new deadline. Workers are
+    recycled after ``maxtasks`` modules to release the memory of everything
+    they imported.
+
+    The pool is closed at ``build-finished``; a pool created in a ``-j``
+    reading process is closed when that process exits.
+    """
+
+    #: Seconds between checks for finished tasks
+    poll_interval = 0.05
+
+    def __init__(self, processes, timeout=30, maxtasks=20):
+        self.processes = max(1, int(processes))
+        self.timeout = timeout
+        self.maxtasks = maxtasks or None
+        self.pool = None
+        self.pid = None
+        self.finalizer_pid = None
+
+    def _get_pool(self):
+        if self.pool is None or self.pid != os.getpid():
+            # a pool inherited from a forked parent has no workers of ours
+            self.pool = multiprocessing.Pool(self.processes, _init_import_worker, (list(sys.path),),
+                                             maxtasksperchild=self.maxtasks)
+            self.pid = os.getpid()
+        if self.finalizer_pid != self.pid:
+            # build-finished is only emitted in the main process; runs before
+            # the pool terminates itself at exit (priority 15)
+            multiprocessing.util.Finalize(self, self.close, exitpriority=20)
+            self.finalizer_pid = self.pid
+        return self.pool
+
+    def _submit(self, modname, attributes):
+        return (self._get_pool().apply_async(_import_worker, (modname, attributes)),
+                time.time() + self.timeout)
+
+    def resolve(self, table, pairs):
+        # type: (SourceLineTable, Iterable[Tuple[str, unicode]]) -> None
+        """
+        Resolve all pairs not resolved yet into ``table.resolved``
+        """
+        modules = {}  # type: Dict[str, List[unicode]]
+        for modname, attribute in pairs:
+            if modname and (modname, attribute) not in table.resolved:
+                attributes = modules.setdefault(modname, [])
+                if attribute not in attributes:
+                    attributes.append(attribute)
+
+        waiting = sorted(modules)
+        running = {}  # type: Dict[str, Tuple[Any, float]]
+        while waiting or running:
+            while waiting and len(running) < self.processes:
+                modname = waiting.pop(0)
+                running[modname] = self._submit(modname, modules[modname])
+
+            done = [modname for modname, (task, _) in iteritems(running) if task.ready()]
+            if not done:
+                task, deadline = min(running.values(), key=lambda item: item[1])
+                task.wait(max(0, min(deadline - time.time(), self.poll_interval)))
+                done = [modname for modname, (task, _) in iteritems(running) if task.ready()]
+            for modname in done:
+                task, _ = running.pop(modname)
+                try:
+                    results = task.get()
+                except Exception as e:
+                    logger.verbose('viewcode: import worker for %s failed: %s', modname, e)
+                    results = {}
+                self._store(table, modname, modules[modname], results)
+
+            now = time.time()
+            expired = [modname for modname, (_, deadline) in iteritems(running) if deadline <= now]
+            if expired:
+                for modname in expired:
+                    logger.warning('viewcode: importing %s took longer than %s seconds, skipped',
+                                   modname, self.timeout)
+                    del running[modname]
+                    self._store(table, modname, modules[modname], {})
+                self.close(terminate=True)
+                for modname in running:
+                    running[modname] = self._submit(modname, modules[modname])
+
+    @staticmethod
+    def _store(table, modname, attributes, results):
+        for attribute in attributes:
+            result, messages = results.get(attribute, (None, []))
+            for message in messages:
+                logger.verbose(message)
+            table.resolved[modname, attribute] = result
+
+    def close(self, terminate=False):
+        if self.pool is not None and self.pid == os.getpid():
+            if terminate:
+                self.pool.terminate()
+            else:
+                self.pool.close()
+            self.pool.join()
+        self.pool = None
+
+
+def get_import_pool(app):
+    # type: (Sphinx) -> ImportPool
+    pool = getattr(app.builder, '_viewcode_import_pool', None)
+    if pool is None:
+        pool = ImportPool(app.config.viewcode_import_processes,
+                          app.config.viewcode_import_timeout,
+                          app.config.viewcode_import_maxtasks)
+        app.builder._viewcode_import_pool = pool
+    return pool
+
+
+def close_import_pool(app, exception):
+    # type: (Sphinx, Exception) -> None
+    pool = getattr(app.builder, '_viewcode_import_pool', None)
+    if pool is not None:
+        pool.close(terminate=exception is not None)
 
 
 def doctree_read(app, doctree):
@@ -79,27 +586,18 @@ def doctree_read(app, doctree):
         return
 
     def has_tag(modname, fullname, docname, refname):
-        entry = env._viewcode_modules.get(modname, None)  # type: ignore
-        try:
-            analyzer = ModuleAnalyzer.for_module(modname)
-        except Exception:
-            env._viewcode_modules[modname] = False  # type: ignore
-            return
-        if not isinstance(analyzer.code, text_type):
-            code = analyzer.code.decode(analyzer.encoding)
-        else:
-            code = analyzer.code
-        if entry is None or entry[0] != code:
-            analyzer.find_tags()
-            entry = code, analyzer.tags, {}, refname
-            env._viewcode_modules[modname] = entry  # type: ignore
-        elif entry is False:
-            return
-        _, tags, used, _ = entry
-        if fullname in tags:
-            used[fullname] = docname
+        record = get_module_record(app, env, modname, refname)
+        if record is not None and fullname in record.tags:
+            record.used[fullname] = docname
             return True
 
+    if env.config.viewcode_import and env.config.viewcode_import_processes > 0:
+        # import the modules of all signatures of the document in one go
+        get_import_pool(app).resolve(get_line_table(app), (
+            (signode.get('module'), signode.get('fullname'))
+            for objnode in doctree.traverse(addnodes.desc) if objnode.get('domain') == 'py'
+            for signode in objnode if isinstance(signode, addnodes.desc_signature)))
+
     for objnode in doctree.traverse(addnodes.desc):
         if objnode.get('domain') != 'py':
             continue
@@ -111,8 +609,9 @@ def doctree_read(app, doctree):
             fullname = signode.get('fullname')
             refname = modname
             if env.config.viewcode_import:
-
                 modname = _get_full_modname(app, modname, fullname)
+            else:
+                modname = _get_static_modname(app, modname, fullname)
             if not modname:
                 continue
             else:
@@ -146,7 +645,21 @@ def env_merge_info(app, env, docnames, other):
     if not hasattr(env, '_viewcode_modules'):
         env._viewcode_modules = {}  # type: ignore
     # now merge in the information from the subprocess
-    env._viewcode_modules.update(other._viewcode_modules)  # type: ignore
+    for modname, entry in iteritems(other._viewcode_modules):  # type: ignore
+        current = env._viewcode_modules.get(modname)  # type: ignore
+        if isinstance(current, ModuleRecord) and entry and current.hash == entry.hash:
+            current.used.update(entry.used)
+            current.path, current.mtime = entry.path, entry.mtime
+        elif entry or modname not in env._viewcode_modules:  # type: ignore
+            env._viewcode_modules[modname] = entry  # type: ignore
+
+
+def env_purge_doc(app, env, docname):
+    # type: (Sphinx, BuildEnvironment, unicode) -> None
+    for entry in getattr(env, '_viewcode_modules', {}).values():
+        if entry:
+            for name in [name for name, used_in in iteritems(entry.used) if used_in == docname]:
+                del entry.used[name]
 
 
 def missing_reference(app, env, node, contnode):
@@ -162,7 +675,14 @@ def collect_pages(app):
     env = app.builder.env
     if not hasattr(env, '_viewcode_modules'):
         return
+    collect = app.config.viewcode_collect_pages
+    if collect is None:
+        collect = not links_are_external(app.config)
+    if not collect:
+        logger.verbose('viewcode: [source] links are external, not writing module code pages')
+        return
     highlighter = app.builder.highlighter  # type: ignore
+    cache = HighlightCache(os.path.join(app.doctreedir, 'viewcode'), highlight_settings(app.config))
     urito = app.builder.get_relative_uri
     modnames = set(env._viewcode_modules)  # type: ignore
 
@@ -174,9 +694,15 @@ def collect_pages(app):
             'highlighting module code... ', "blue",
             len(env._viewcode_modules),  # type: ignore
             app.verbosity, lambda x: x[0]):
+        # modules of documents that were not read again may have changed
+        entry = get_module_record(app, env, modname, None)
         if not entry:
             continue
-        code, tags, used, refname = entry
+        try:
+            code = module_code(get_line_table(app).analyzer(modname))
+        except Exception:
+            continue
+        tags, used, refname = entry.tags, entry.used, entry.refname
         # construct a page name for the highlighted source
         pagename = '_modules/' + modname.replace('.', '/')
         # highlight the source using the builder's highlighter
@@ -184,7 +710,7 @@ def collect_pages(app):
             lexer = env.config.highlight_language
         else:
             lexer = 'python'
-        highlighted = highlighter.highlight_block(code, lexer, linenos=False)
+        highlighted = cache.highlight(highlighter, code, lexer)
         # split the code into lines
         lines = highlighted.splitlines()
         # split off wrap markup from the first line of the actual code
@@ -225,6 +751,10 @@ def collect_pages(app):
         }  # type: Dict[unicode, Any]
         yield (pagename, context, 'page.html')
 
+    cache.prune()
+    if cache.hits:
+        logger.verbose('viewcode: reused highlighted code of %d modules', cache.hits)
+
     if not modnames:
         return
 
@@ -261,11 +791,17 @@ def setup(app):
     app.add_config_value('viewcode_import', True, False)
     app.add_config_value('viewcode_enable_epub', False, False)
     app.add_config_value('sphinx_confluence_repo_path', '_modules/', False)
+    app.add_config_value('viewcode_collect_pages', None, False)
+    app.add_config_value('viewcode_import_processes', 0, False)
+    app.add_config_value('viewcode_import_timeout', 30, False)
+    app.add_config_value('viewcode_import_maxtasks', 20, False)
     app.connect('doctree-read', doctree_read)
     app.connect('env-merge-info', env_merge_info)
+    app.connect('env-purge-doc', env_purge_doc)
     app.connect('html-collect-pages', collect_pages)
     app.connect('missing-reference', missing_reference)
+    app.connect('build-finished', close_import_pool)
     # app.add_config_value('viewcode_include_modules', [], 'env')
     # app.add_config_value('viewcode_exclude_modules', [], 'env')
-    return {'version': sphinx.__display_version__, 'parallel_read_safe': True}
+    return {'version': sphinx.__display_version__, 'env_version': 1, 'parallel_read_safe': True}
 
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""
+Opt-in build instrumentation
+
+With ``sphinx_confluence_instrument = True`` the build records wall and CPU
+time of every event handler and of reading and writing every document, call
+counts and cumulative time of every ``visit_*``/``depart_*`` method of the
+translator and the size of the storage format of every page. With
+``sphinx_confluence_instrument_memory = True`` the peak of memory allocated
+while writing every document is measured with :mod:`tracemalloc` as well,
+which slows down writing. The report is written as JSON at
+``build-finished``, and the top entries are logged.
+
+"""
+
+from collections import defaultdict
+import io
+import json
+import os
+import time
+import tracemalloc
+
+import sphinx
+from sphinx.util import logging
+
+logger = logging.getLogger(__name__)
+
+#: Timings recorded before the extension is set up (``setup_config`` runs in
+#: ``conf.py``); picked up by the next :class:`BuildRecorder`
+setup_timings = []
+
+
+def record_setup(name, wall, cpu, **details):
+    entry = dict(details, name=name, wall=wall, cpu=cpu)
+    setup_timings.append(entry)
+    return entry
+
+
+def new_timing():
+    return {'wall': 0.0, 'cpu': 0.0, 'calls': 0}
+
+
+class BuildRecorder(object):
+    """
+    Collects the measurements of one build
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter(), time.process_time()
+        self.setup = list(setup_timings)
+        del setup_timings[:]
+        self.events = defaultdict(lambda: defaultdict(new_timing))
+        self.documents = defaultdict(lambda: defaultdict(new_timing))
+        self.visitors = defaultdict(lambda: [0, 0.0])
+        self.page_bytes = {}
+        self.peak_memory = {}
+        self.memory_untraced = False
+
+    @staticmethod
+    def add(timing, wall, cpu):
+        timing['wall'] += wall
+        timing['cpu'] += cpu
+        timing['calls'] += 1
+
+    def timed(self, timing, func):
+        def wrapper(*args, **kwargs):
+            wall, cpu = time.perf_counter(), time.process_time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(timing(args), time.perf_counter() - wall, time.process_time() - cpu)
+        wrapper.__wrapped__ = func
+        return wrapper
+
+    def traced(self, func):
+        """
+        ``func(docname, ...)`` recording the peak of memory allocated while it
+        runs by docname.
+
+        Nothing is recorded while something else is tracing already on
+        Python < 3.9, which cannot reset the peak: it would be the peak since
+        tracing started rather than that of the document.
+        """
+        def wrapper(docname, *args, **kwargs):
+            tracing = tracemalloc.is_tracing()
+            if not tracing:
+                tracemalloc.start()
+            elif hasattr(tracemalloc, 'reset_peak'):
+                # Python >= 3.9
+                tracemalloc.reset_peak()
+            else:
+                if not self.memory_untraced:
+                    logger.warning('tracemalloc is already tracing and cannot reset its peak before '
+                                   'Python 3.9, peak memory is not recorded')
+                self.memory_untraced = True
+                return func(docname, *args, **kwargs)
+            start = tracemalloc.get_traced_memory()[0]
+            try:
+                return func(docname, *args, **kwargs)
+            finally:
+                peak = tracemalloc.get_traced_memory()[1] - start
+                if not tracing:
+                    tracemalloc.stop()
+                self.peak_memory[docname] = max(peak, self.peak_memory.get(docname, 0))
+        wrapper.__wrapped__ = func
+        return wrapper
+
+    def wrap_handler(self, event, handler):
+        name = '%s.%s' % (getattr(handler, '__module__', '?'), getattr(handler, '__qualname__', repr(handler)))
+        return self.timed(lambda args: self.events[event][name], handler)
+
+    def wrap_builder(self, builder, memory=False):
+        builder.read_doc = self.timed(lambda args: self.documents[args[0]]['read'], builder.read_doc)
+        write_doc = self.traced(builder.write_doc) if memory else builder.write_doc
+        builder.write_doc = self.timed(lambda args: self.documents[args[0]]['write'], write_doc)
+
+    def visit(self, name, elapsed):
+        entry = self.visitors[name]
+        entry[0] += 1
+        entry[1] += elapsed
+
+    def report(self, app):
+        wall, cpu = self.started
+        return {
+            'sphinx': sphinx.__display_version__,
+            'builder': app.builder.name,
+            'parallel': app.parallel,
+            'total': {'wall': time.perf_counter() - wall, 'cpu': time.process_time() - cpu},
+            'setup': self.setup,
+            'events': self.events,
+            'documents': self.documents,
+            'visitors': dict((name, {'calls': calls, 'wall': elapsed})
+                             for name, (calls, elapsed) in self.visitors.items()),
+            'page_bytes': self.page_bytes,
+            'peak_memory': self.peak_memory,
+        }
+
+
+def iter_listeners(app):
+    """
+    ``(event, container, key, handler)`` of every connected event handler,
+    where ``container[key]`` holds the handler (or its listener tuple)
+    """
+    events = getattr(app, 'events', None)
+    listeners = getattr(events, 'listeners', None)
+    if listeners is None:
+        # Sphinx < 1.6
+        listeners = app._listeners
+    for event, entries in list(listeners.items()):
+        if isinstance(entries, dict):
+            for key, handler in list(entries.items()):
+                yield event, entries, key, handler
+        else:
+            # Sphinx >= 3: EventListener(id, handler, priority)
+            for i, entry in enumerate(entries):
+                yield event, entries, i, entry
+
+
+def wrap_listeners(app, recorder):
+    for event, container, key, entry in iter_listeners(app):
+        if hasattr(entry, '_replace'):
+            container[key] = entry._replace(handler=recorder.wrap_handler(event, entry.handler))
+        else:
+            container[key] = recorder.wrap_handler(event, entry)
+
+
+def start_recording(app):
+    if not app.config.sphinx_confluence_instrument:
+        return
+    if app.parallel > 1:
+        logger.warning('sphinx_confluence_instrument: documents read and written in -j worker processes '
+                       'are not recorded, build serially for a complete report')
+    recorder = app.builder.confluence_recorder = BuildRecorder()
+    wrap_listeners(app, recorder)
+    recorder.wrap_builder(app.builder, app.config.sphinx_confluence_instrument_memory)
+    # every extension is set up by now, so the report comes after all other
+    # build-finished handlers (publishing included)
+    app.connect('build-finished', write_report)
+
+
+def top(items, count, key):
+    return sorted(items, key=key, reverse=True)[:count]
+
+
+def write_report(app, exception):
+    recorder = getattr(app.builder, 'confluence_recorder', None)
+    if recorder is None:
+        return
+    app.builder.confluence_recorder = None
+    report = recorder.report(app)
+
+    path = app.config.sphinx_confluence_instrument_path
+    if not path:
+        path = os.path.join(app.outdir, 'sphinx_confluence_instrumentation.json')
+    try:
+        with io.open(path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(report, indent=1, sort_keys=True, ensure_ascii=False))
+    except (IOError, OSError) as e:
+        logger.warning('Could not write the instrumentation report %s: %s', path, e)
+    else:
+        logger.info('Instrumentation report written to %s', path)
+
+    count = app.config.sphinx_confluence_instrument_top
+    total = report['total']
+    logger.info('Build took %.2fs wall, %.2fs CPU', total['wall'], total['cpu'])
+    for entry in report['setup']:
+        logger.info('  setup: %-40s %8.3fs', entry['name'], entry['wall'])
+
+    handlers = [(event, name, timing) for event, names in report['events'].items()
+                for name, timing in names.items()]
+    logger.info('Slowest event handlers:')
+    for event, name, timing in top(handlers, count, lambda item: item[2]['wall']):
+        logger.info('  %-20s %-50s %8.3fs %6d calls', event, name, timing['wall'], timing['calls'])
+
+    logger.info('Slowest documents (read + write):')
+    documents = [(docname, sum(timing['wall'] for timing in phases.values()))
+                 for docname, phases in report['documents'].items()]
+    for docname, elapsed in top(documents, count, lambda item: item[1]):
+        logger.info('  %-60s %8.3fs', docname, elapsed)
+
+    logger.info('Slowest translator methods:')
+    for name, entry in top(report['visitors'].items(), count, lambda item: item[1]['wall']):
+        logger.info('  %-40s %8.3fs %8d calls', name, entry['wall'], entry['calls'])
+
+    if report['page_bytes']:
+        logger.info('Largest pages:')
+        for docname, size in top(report['page_bytes'].items(), count, lambda item: item[1]):
+            logger.info('  %-60s %10d bytes', docname, size)
+
+    if report['peak_memory']:
+        logger.info('Largest peak memory while writing:')
+        for docname, size in top(report['peak_memory'].items(), count, lambda item: item[1]):
+            logger.info('  %-60s %10d KiB', docname, size // 1024)
+
+
+def setup(app):
+    app.add_config_value('sphinx_confluence_instrument', False, False)
+    app.add_config_value('sphinx_confluence_instrument_path', None, False)
+    app.add_config_value('sphinx_confluence_instrument_top', 10, False)
+    app.add_config_value('sphinx_confluence_instrument_memory', False, False)
+    app.connect('builder-inited', start_recording)
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+Confluence storage format macros
+
+Every macro the translator and the directives emit is built as a small
+:class:`Element` tree and rendered either readable (one element per line,
+indented) or compact (no whitespace between elements). Both renderings only
+differ in whitespace between tags; parameter values and attributes are
+escaped either way.
+
+https://confluence.atlassian.com/display/DOC/Confluence+Storage+Format
+
+"""
+
+from xml.sax.saxutils import escape
+
+
+def escape_attribute(value):
+    return escape(u'{}'.format(value), {'"': '&quot;'})
+
+
+def escape_text(value):
+    return escape(u'{}'.format(value))
+
+
+def cdata(value):
+    """
+    ``value`` as a CDATA section; ``]]>`` is split across two sections
+    """
+    return u'<![CDATA[{}]]>'.format(u'{}'.format(value).replace(']]>', ']]]]><![CDATA[>'))
+
+
+class Element(object):
+    """
+    Storage format element with escaped ``text`` or ``children`` elements.
+
+    ``raw`` is inserted verbatim instead (e.g. a CDATA section).
+    """
+
+    def __init__(self, tag, attributes=(), children=(), text=None, raw=None):
+        self.tag = tag
+        self.attributes = list(attributes)
+        self.children = list(children)
+        self.text = text
+        self.raw = raw
+
+    def start_tag(self, empty=False):
+        parts = [self.tag] + ['{}="{}"'.format(name, escape_attribute(value)) for name, value in self.attributes]
+        return '<{}{}>'.format(' '.join(parts), ' /' if empty else '')
+
+    def end_tag(self):
+        return '</{}>'.format(self.tag)
+
+    def render(self, compact=False, depth=0):
+        if self.children:
+            if compact:
+                return ''.join([self.start_tag()] + [child.render(compact) for child in self.children]
+                               + [self.end_tag()])
+            indent = '  ' * depth
+            return ''.join([indent, self.start_tag(), '\n']
+                           + [child.render(compact, depth + 1) for child in self.children]
+                           + [indent, self.end_tag(), '\n'])
+
+        if self.raw is not None:
+            content = self.raw
+        elif self.text is not None:
+            content = escape_text(self.text)
+        else:
+            content = None
+        rendered = self.start_tag(empty=True) if content is None else self.start_tag() + content + self.end_tag()
+        return rendered if compact else '  ' * depth + rendered + '\n'
+
+    def render_start(self, compact=False, depth=0):
+        """
+        Start tag and children of an element whose remaining content is
+        written by the caller, e.g. the rich text body of an admonition
+        """
+        if compact:
+            return ''.join([self.start_tag()] + [child.render(compact) for child in self.children])
+        return ''.join(['  ' * depth, self.start_tag(), '\n']
+                       + [child.render(compact, depth + 1) for child in self.children])
+
+    def render_end(self, compact=False, depth=0, newline=False):
+        """
+        End tag of an element started with :meth:`render_start`; readable
+        output puts it on a line of its own, which ``newline`` starts when the
+        content written by the caller does not end with one
+        """
+        if compact:
+            return self.end_tag()
+        return ('\n' if newline else '') + '  ' * depth + self.end_tag() + '\n'
+
+
+def parameter(name, value):
+    return Element('ac:parameter', [('ac:name', name)], text=value)
+
+
+def structured_macro(name, parameters=(), children=(), **attributes):
+    """
+    ``<ac:structured-macro>`` with ``parameters`` as ``(name, value)`` pairs
+    followed by ``children`` elements
+    """
+    attributes = [('ac:name', name)] + sorted(('ac:' + key.replace('_', '-'), value)
+                                              for key, value in attributes.items())
+    return Element('ac:structured-macro', attributes,
+                   [parameter(key, value) for key, value in parameters] + list(children))
+
+
+def anchor(name):
+    """
+    Anchor Macro
+
+    https://confluence.atlassian.com/display/DOC/Anchor+Macro
+    """
+    return structured_macro('anchor', [('', name)])
+
+
+def admonition(admonition_type):
+    """
+    Info, Tip, Note, and Warning Macros, without the content of the rich text
+    body; render with :meth:`Element.render_start` and
+    :meth:`Element.render_end` around the body.
+
+    https://confluence.atlassian.com/conf58/info-tip-note-and-warning-macros-771892344.html
+    """
+    return structured_macro(admonition_type, [('icon', 'true'), ('title', '')])
+
+
+def rich_text_body():
+    return Element('ac:rich-text-body')
+
+
+def code_block(code, language=None, collapse=False, linenumbers=False, title=None):
+    """
+    Code Block Macro
+
+    https://confluence.atlassian.com/display/DOC/Code+Block+Macro
+    """
+    parameters = []
+    if collapse:
+        parameters.append(('collapse', 'true'))
+    if language is not None:
+        parameters.append(('language', language))
+    if linenumbers:
+        parameters.append(('linenumbers', 'true'))
+    if title:
+        parameters.append(('title', title))
+    return structured_macro('code', parameters, [Element('ac:plain-text-body', raw=cdata(code))])
+
+
+def toc(style='square', min_level=1, max_level=3, toc_type='list'):
+    """
+    Table of Contents Macro
+
+    https://confluence.atlassian.com/display/DOC/Table+of+Contents+Macro
+    """
+    return structured_macro('toc', [('style', style), ('minLevel', min_level), ('maxLevel', max_level),
+                                    ('type', toc_type)])
+
+
+def jira_issue(key):
+    return structured_macro('jira', [('key', key), ('showSummary', 'false')], schema_version='1')
+
+
+def jira_issues(parameters):
+    """
+    JIRA Issues Macro
+
+    https://confluence.atlassian.com/doc/jira-issues-macro-139380.html
+    """
+    return structured_macro('jira', parameters, schema_version='1')
+
+
+def user_link(username):
+    return Element('ac:link', children=[Element('ri:user', [('ri:username', username)])])
+
+
+def page_link(title, anchor=None):
+    """
+    Link to an anchor on another page of the space, without the link body;
+    render with :meth:`Element.render_start` and :meth:`Element.render_end`
+    around a :func:`link_body`
+    """
+    attributes = [('ac:anchor', anchor)] if anchor else []
+    return Element('ac:link', attributes, [Element('ri:page', [('ri:content-title', title)])])
+
+
+def attachment_link(filename, text):
+    """
+    Link to an attachment of the page, with an empty link body when there is
+    no ``text``
+    """
+    return Element('ac:link', children=[Element('ri:attachment', [('ri:filename', filename)]),
+                                        Element('ac:plain-text-link-body', raw=cdata(text) if text else '')])
+
+
+def link_body():
+    return Element('ac:link-body')
+
+
+def emoticon(name):
+    return Element('ac:emoticon', [('ac:name', name)])
+
+
+def compact_output(document):
+    """
+    Whether macros of a document are rendered compact, from the
+    ``sphinx_confluence_compact_output`` setting of its build
+    """
+    env = getattr(document.settings, 'env', None)
+    return bool(env is not None and env.config.sphinx_confluence_compact_output)
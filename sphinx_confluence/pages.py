@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers for the ``pages`` tree of a confluence-publisher ``config.yml``
+
+"""
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import os
+import time
+
+from sphinx.util import logging
+
+from sphinx_confluence.util import JSONStore
+
+logger = logging.getLogger(__name__)
+
+
+def iter_pages(pages):
+    """
+    Walk a ``pages`` tree depth-first, parents before their children
+    """
+    for page in pages or ():
+        yield page
+        for subpage in iter_pages(page.get('pages')):
+            yield subpage
+
+
+def normalize_path(path):
+    return os.path.normcase(os.path.abspath(path))
+
+
+class PageIndex(object):
+    """
+    Lookup tables over every page of a ``pages`` tree, nested pages included.
+
+    ``by_path`` maps the normalized absolute ``local_path`` of a page to the
+    page, ``by_suffix`` maps every trailing run of path components (``index``,
+    ``docs/index``, ...) to the first page in tree order that ends with it, so
+    a docname resolves to its page with a single dict lookup.
+    """
+
+    def __init__(self, pages):
+        self.by_path = {}
+        self.by_suffix = {}
+        for page in iter_pages(pages):
+            local_path = page.get('local_path')
+            if not local_path:
+                continue
+            path = normalize_path(local_path)
+            self.by_path.setdefault(path, page)
+            parts = path.replace(os.sep, '/').split('/')
+            for i in range(len(parts)):
+                self.by_suffix.setdefault('/'.join(parts[i:]), page)
+
+    def __len__(self):
+        return len(self.by_path)
+
+    def find_by_path(self, path):
+        return self.by_path.get(normalize_path(path))
+
+    def find_by_docname(self, docname):
+        return self.by_suffix.get(os.path.normcase(docname))
+
+
+class PageMetadataCache(JSONStore):
+    """
+    Persistent JSON store of confluence page metadata keyed by page id.
+
+    Every entry holds the page ``title``, its ``webui`` link, the content
+    ``version`` it was fetched at and the ``fetched`` timestamp. Entries older
+    than ``ttl`` seconds are stale and have to be revalidated against the
+    content version on the server: an entry still at the current version is
+    kept as is and only gets a new ``fetched`` timestamp.
+    """
+
+    filename = '.sphinx_confluence_pages.json'
+
+    def __init__(self, path, ttl=24 * 60 * 60):
+        super(PageMetadataCache, self).__init__(path)
+        self.ttl = ttl
+
+    def get(self, page_id):
+        return self.entries.get(str(page_id))
+
+    def is_fresh(self, entry):
+        return self.ttl is not None and time.time() - entry.get('fetched', 0) < self.ttl
+
+    def put(self, page_id, meta):
+        entry = dict(meta, fetched=time.time())
+        self.entries[str(page_id)] = entry
+        return entry
+
+    def touch(self, page_id):
+        """
+        Mark the entry of a page as fetched now, keeping its metadata
+        """
+        entry = self.entries[str(page_id)]
+        entry['fetched'] = time.time()
+        return entry
+
+
+class PageResolver(object):
+    """
+    Fills in ``server_path``, ``title``, ``short_title`` and ``local_path`` for
+    every page of a ``pages`` tree, fetching page metadata through a bounded
+    pool of worker threads.
+
+    Pages are fetched ``batch_size`` at a time with a single CQL search
+    (``id in (...)``); pages missing from the search results are fetched one
+    by one. ``batch_size=1`` fetches every page on its own.
+    """
+
+    #: Log a progress line roughly every this many percent of resolved pages
+    progress_step = 10
+
+    def __init__(self, conf_api, confluence_path, max_workers=8, cache=None, refresh=False, batch_size=50):
+        self.conf_api = conf_api
+        self.confluence_path = confluence_path
+        self.max_workers = max(1, int(max_workers))
+        self.cache = cache
+        self.refresh = refresh
+        self.batch_size = max(1, int(batch_size))
+
+    @staticmethod
+    def page_meta(page_info):
+        return {'title': page_info.get('title'),
+                'webui': page_info.get('_links').get('webui'),
+                'version': (page_info.get('version') or {}).get('number')}
+
+    def fetch(self, page_id):
+        """
+        Fetch the metadata of a single page. Only ``version`` is expanded, which
+        keeps the request cheap enough to be used for revalidation as well.
+        """
+        return self.page_meta(self.conf_api.get_content(page_id, expand='version'))
+
+    def fetch_many(self, page_ids):
+        """
+        Fetch the metadata of several pages with one CQL search.
+
+        :return: dict of metadata by page id (as a string); pages the search
+            did not return are missing
+        """
+        cql = 'id in ({})'.format(','.join(str(page_id) for page_id in page_ids))
+        found = {}
+        start = 0
+        while True:
+            data = self.conf_api.search_content(cql, expand='version', start=start, limit=len(page_ids))
+            results = data.get('results', [])
+            for page_info in results:
+                found[str(page_info.get('id'))] = self.page_meta(page_info)
+            start += len(results)
+            if not results or 'next' not in data.get('_links', {}):
+                break
+        return found
+
+    def fetch_batch(self, page_dicts):
+        """
+        :return: list of ``(page_dict, metadata)`` pairs, where ``metadata`` is
+            the exception if the page could not be fetched
+        """
+        found = {}
+        if len(page_dicts) > 1:
+            try:
+                found = self.fetch_many(sorted(set(str(page_dict.get('id')) for page_dict in page_dicts)))
+            except Exception as e:
+                logger.debug('Batched lookup of %d confluence pages failed, fetching them one by one: %s',
+                             len(page_dicts), e)
+
+        results = []
+        for page_dict in page_dicts:
+            meta = found.get(str(page_dict.get('id')))
+            if meta is None:
+                try:
+                    meta = self.fetch(page_dict.get('id'))
+                except Exception as e:
+                    meta = e
+            results.append((page_dict, meta))
+        return results
+
+    def update_page(self, page_dict, meta):
+        page_title = meta['title']
+        page_short_title = page_title.replace(' ', '')
+        page_dict.update({'server_path': self.confluence_path + meta['webui'],
+                          'title': page_title,
+                          'short_title': page_short_title})
+
+    def resolve(self, pages):
+        """
+        Resolve all pages of the tree in place.
+
+        A page whose metadata can not be fetched keeps its ``local_path`` but
+        gets no ``server_path``, so references to it are left untouched.
+
+        :return: list of page dicts that could not be resolved
+        """
+        all_pages = list(iter_pages(pages))
+        for page_dict in all_pages:
+            page_dict['local_path'] = os.path.abspath(page_dict.get('source'))
+
+        failed = []
+        total = len(all_pages)
+        if not total:
+            return failed
+
+        to_fetch = []
+        for page_dict in all_pages:
+            entry = self.cache.get(page_dict.get('id')) if self.cache and not self.refresh else None
+            if entry and self.cache.is_fresh(entry):
+                self.update_page(page_dict, entry)
+            else:
+                to_fetch.append(page_dict)
+
+        if len(to_fetch) < total:
+            logger.info('Using cached metadata for %d of %d confluence pages', total - len(to_fetch), total)
+
+        self._fetch_pages(to_fetch, failed)
+
+        if self.cache is not None and to_fetch:
+            try:
+                self.cache.save()
+            except (IOError, OSError) as e:
+                logger.warning('Could not write confluence page cache %s: %s', self.cache.path, e)
+
+        if failed:
+            logger.warning('%d of %d confluence pages could not be resolved; '
+                           'references to them will not be rewritten', len(failed), total)
+        return failed
+
+    def _fetch_pages(self, to_fetch, failed):
+        total = len(to_fetch)
+        if not total:
+            return
+
+        next_report = self.progress_step
+        done = 0
+        batches = [to_fetch[i:i + self.batch_size] for i in range(0, total, self.batch_size)]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self.fetch_batch, batch) for batch in batches]
+            for future in as_completed(futures):
+                for page_dict, meta in future.result():
+                    if isinstance(meta, Exception):
+                        self._fetch_failed(page_dict, meta, failed)
+                    else:
+                        self._store(page_dict, meta)
+
+                    done += 1
+                    percent = done * 100 // total
+                    if percent >= next_report or done == total:
+                        logger.info('Resolved confluence page metadata: %d/%d (%d%%)', done, total, percent)
+                        next_report = percent + self.progress_step
+
+    def _fetch_failed(self, page_dict, error, failed):
+        entry = self.cache.get(page_dict.get('id')) if self.cache else None
+        if entry and not self.refresh:
+            logger.warning('Could not revalidate confluence page %s (%s), using cached metadata: %s',
+                           page_dict.get('id'), page_dict.get('source'), error)
+            self.update_page(page_dict, entry)
+        else:
+            logger.warning('Could not resolve confluence page %s (%s): %s',
+                           page_dict.get('id'), page_dict.get('source'), error)
+            failed.append(page_dict)
+
+    def _store(self, page_dict, meta):
+        if self.cache is not None:
+            entry = self.cache.get(page_dict.get('id'))
+            if entry and entry.get('version') is not None and entry.get('version') == meta['version']:
+                # title and link only change with a new version of the page
+                logger.debug('Confluence page %s is unchanged at version %s', page_dict.get('id'), meta['version'])
+                meta = self.cache.touch(page_dict.get('id'))
+            else:
+                meta = self.cache.put(page_dict.get('id'), meta)
+        self.update_page(page_dict, meta)
@@ -0,0 +1,750 @@
+# -*- coding: utf-8 -*-
+"""
+Publishing of built documentation through confluence-publisher
+
+This module requires ``conf_publisher`` and is only imported when publishing.
+
+"""
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+import copy
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+
+from conf_publisher.config import PageConfig, flatten_page_config_list
+from conf_publisher.confluence import Ancestor, AttachmentPublisher, ConfluencePageManager, Page
+from conf_publisher.data_providers.sphinx_base_data_provider import SphinxBaseDataProvider
+from conf_publisher.publish import Publisher, get_data_provider_class
+
+from sphinx.util import logging
+
+from sphinx_confluence.util import JSONStore
+
+logger = logging.getLogger(__name__)
+
+
+def hash_file(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class FileHasher(object):
+    """
+    Memoized :func:`hash_file`, keyed by real path, size and mtime, so a file
+    shared by several pages is read and hashed once per publish.
+    """
+
+    def __init__(self):
+        self._digests = {}
+
+    def __call__(self, path):
+        path = os.path.realpath(path)
+        stat = os.stat(path)
+        key = (path, stat.st_size, stat.st_mtime)
+        digest = self._digests.get(key)
+        if digest is None:
+            digest = self._digests[key] = hash_file(path)
+        return digest
+
+
+def hash_text(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(u'{}'.format(part).encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class PublishManifest(JSONStore):
+    """
+    Content hashes of everything published by the last successful publish.
+
+    Keyed by page id; every entry holds the hash of the page (storage format
+    body, title and publishing options), the hashes of its attachments by
+    path and the ids of the child pages of a split document by title.
+    """
+
+    filename = '.sphinx_confluence_manifest.json'
+
+    def _entry(self, page_id):
+        return self.entries.setdefault(str(page_id), {'page': None, 'attachments': {}})
+
+    def page_changed(self, page_id, digest):
+        return self.entries.get(str(page_id), {}).get('page') != digest
+
+    def set_page(self, page_id, digest):
+        self._entry(page_id)['page'] = digest
+
+    def attachment_changed(self, page_id, path, digest):
+        return self.entries.get(str(page_id), {}).get('attachments', {}).get(path) != digest
+
+    def set_attachment(self, page_id, path, digest):
+        self._entry(page_id)['attachments'][path] = digest
+
+    def part_page(self, parent_id, title):
+        return self.entries.get(str(parent_id), {}).get('parts', {}).get(title)
+
+    def set_part_page(self, parent_id, title, page_id):
+        self._entry(parent_id).setdefault('parts', {})[title] = page_id
+
+
+class PublishError(Exception):
+    def __init__(self, message, results=None):
+        super(PublishError, self).__init__(message)
+        self.results = results
+
+
+class PublishResult(object):
+    PUBLISHED = 'published'
+    UNCHANGED = 'unchanged'
+    FAILED = 'failed'
+    SKIPPED = 'skipped'
+
+    def __init__(self, page_id, source, status, error=None, elapsed=0.0):
+        self.page_id = page_id
+        self.source = source
+        self.status = status
+        self.error = error
+        self.elapsed = elapsed
+
+    def __repr__(self):
+        return '<PublishResult {} ({}): {}>'.format(self.page_id, self.source, self.status)
+
+
+class PublishScheduler(object):
+    """
+    Runs one task per page of a ``pages`` tree on a bounded pool of worker
+    threads.
+
+    The tree is a DAG where every page depends on its parent only, so a page is
+    started as soon as its parent has been published and siblings run
+    concurrently. When a page fails, its descendants are skipped, every other
+    page is still processed.
+
+    Pages may also have to wait until they are ready, e.g. written by a running
+    build: they are checked again every ``poll_interval`` seconds and whenever
+    :attr:`wake` is set. Once :attr:`cancelled` is set, no further page is
+    started and the remaining ones are skipped.
+    """
+
+    poll_interval = 0.5
+
+    def __init__(self, max_workers=4):
+        self.max_workers = max(1, int(max_workers))
+        self.wake = threading.Event()
+        self.cancelled = threading.Event()
+
+    @staticmethod
+    def _descendants(page_config):
+        for subpage in flatten_page_config_list(page_config.pages):
+            yield subpage
+
+    @staticmethod
+    def _run_task(task, page_config):
+        start = time.time()
+        status = PublishResult.PUBLISHED if task(page_config) else PublishResult.UNCHANGED
+        return status, time.time() - start
+
+    def _skip(self, page_config, reason, results):
+        for subpage in [page_config] + list(self._descendants(page_config)):
+            logger.warning('Skipping page %s (%s): %s', subpage.id, subpage.source, reason)
+            results.append(PublishResult(subpage.id, subpage.source, PublishResult.SKIPPED))
+
+    def run(self, pages, task, is_ready=None):
+        """
+        :param pages: root ``PageConfig`` objects
+        :param task: callable taking a ``PageConfig``, returns ``True`` if the
+            page was published and ``False`` if it was unchanged
+        :param is_ready: callable taking a ``PageConfig``, returns ``True`` once
+            the page can be published; every page is ready by default
+        :return: list of :class:`PublishResult` in completion order
+        """
+        results = []
+        waiting = list(pages)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            pending = {}
+            while waiting or pending:
+                if self.cancelled.is_set():
+                    for page_config in waiting:
+                        self._skip(page_config, 'publishing was cancelled', results)
+                    waiting = []
+                    for future, page_config in list(pending.items()):
+                        if future.cancel():
+                            del pending[future]
+                            self._skip(page_config, 'publishing was cancelled', results)
+                    if not pending:
+                        break
+
+                self.wake.clear()
+                for page_config in list(waiting):
+                    if is_ready is None or is_ready(page_config):
+                        waiting.remove(page_config)
+                        pending[executor.submit(self._run_task, task, page_config)] = page_config
+                if not pending:
+                    self.wake.wait(self.poll_interval)
+                    continue
+
+                done, _ = wait(pending, timeout=self.poll_interval if waiting else None,
+                               return_when=FIRST_COMPLETED)
+                for future in done:
+                    page_config = pending.pop(future)
+                    try:
+                        status, elapsed = future.result()
+                    except Exception as e:
+                        logger.warning('Failed to publish page %s (%s): %s', page_config.id, page_config.source, e)
+                        results.append(PublishResult(page_config.id, page_config.source, PublishResult.FAILED, e))
+                        for subpage in page_config.pages:
+                            self._skip(subpage, 'parent page {} failed'.format(page_config.id), results)
+                        continue
+
+                    results.append(PublishResult(page_config.id, page_config.source, status, elapsed=elapsed))
+                    waiting.extend(page_config.pages)
+        return results
+
+
+class SphinxStorageDataProvider(SphinxBaseDataProvider):
+    """
+    Reads the output of the ``confluence`` builder: the storage format body
+    from ``<source>.xml`` and the title from ``confluence_pages.json``.
+    """
+
+    DEFAULT_SOURCE_EXT = '.xml'
+    DEFAULT_SOURCE_DIR = 'docs/build/confluence'
+    PAGES_INDEX = 'confluence_pages.json'
+    LITERAL_BLOCKS_DIR = '_literal_blocks'
+
+    def __init__(self, *args, **kwargs):
+        super(SphinxStorageDataProvider, self).__init__(*args, **kwargs)
+        self._pages = None
+
+    def _page_index(self):
+        if self._pages is None:
+            with io.open(os.path.join(self._source_dir, self.PAGES_INDEX), encoding='utf-8') as f:
+                self._pages = json.load(f)
+        return self._pages
+
+    def _docname(self, filename):
+        docname = os.path.relpath(filename, self._source_dir)
+        if docname.endswith(self._source_ext):
+            docname = docname[:-len(self._source_ext)]
+        return docname.replace(os.sep, '/')
+
+    def split_pages(self, filename):
+        """
+        Docnames of the child pages a document was split into, in order
+        """
+        docname = self._docname(filename if os.path.isabs(filename) else self.get_source(filename))
+        parts = [(page.get('index', 0), name) for name, page in self._page_index().items()
+                 if page.get('parent') == docname]
+        return [name for _, name in sorted(parts)]
+
+    def literal_blocks(self, filename):
+        """
+        Files of the literal blocks the builder stored as attachments of a page
+        """
+        docname = self._docname(filename if os.path.isabs(filename) else self.get_source(filename))
+        directory = os.path.join(self._source_dir, self.LITERAL_BLOCKS_DIR, *docname.split('/'))
+        if not os.path.isdir(directory):
+            return []
+        return [os.path.join(directory, name) for name in sorted(os.listdir(directory))]
+
+    def get_source_data(self, filename):
+        if not os.path.isabs(filename):
+            filename = self.get_source(filename)
+        with io.open(filename, encoding='utf-8') as f:
+            body = f.read()
+        title = self._page_index().get(self._docname(filename), {}).get('title')
+        return title, body
+
+
+class SplitPageConfig(PageConfig):
+    """
+    Page of a document split into child pages by the ``confluence`` builder.
+
+    It is published below the page of the document, which it shares the
+    options and attachments with. Its id is unknown until the page was found
+    or created on confluence by :meth:`SplitPageManager.find_or_create`.
+    """
+
+    def __init__(self, parent, source):
+        super(SplitPageConfig, self).__init__()
+        self.parent = parent
+        self.source = source
+        self.link = parent.link
+        self.watermark = parent.watermark
+        self.images = parent.images
+        self.downloads = parent.downloads
+
+
+def add_split_pages(pages, data_provider):
+    """
+    Add the child pages of split documents to a ``pages`` tree
+    """
+    if not isinstance(data_provider, SphinxStorageDataProvider):
+        return
+    for page_config in list(flatten_page_config_list(pages)):
+        split_pages = [SplitPageConfig(page_config, source) for source in data_provider.split_pages(page_config.source)]
+        page_config.pages = split_pages + list(page_config.pages)
+
+
+class SplitPageManager(ConfluencePageManager):
+    """
+    Page manager that also finds or creates the child pages of split documents
+    """
+
+    def find_or_create(self, parent_id, title, body):
+        """
+        :return: ``(page_id, created)``, the id of the page titled ``title``
+            below the page ``parent_id``, which is created with ``body`` if it
+            does not exist yet
+        :raises PublishError: if a page with that title exists elsewhere in the
+            space, as titles are unique within a space
+        """
+        parent = self.load(parent_id)
+        data = self._api.list_content(parent.space_key, title=title, expand='ancestors')
+        for page_data in data.get('results', []):
+            ancestors = page_data.get('ancestors') or [{}]
+            if str(ancestors[-1].get('id')) != str(parent.id):
+                raise PublishError('Page "{}" already exists outside of page {}'.format(title, parent.id))
+            return page_data['id'], False
+
+        page = Page()
+        page.space_key = parent.space_key
+        page.title = title
+        page.body = body
+        ancestor = Ancestor()
+        ancestor.id = parent.id
+        page.ancestors.append(ancestor)
+        logger.info('Creating child page "%s" of page %s', title, parent.id)
+        return self.create(page), True
+
+
+def get_storage_data_provider_class(config):
+    if config.source_ext == SphinxStorageDataProvider.DEFAULT_SOURCE_EXT:
+        return SphinxStorageDataProvider
+    return get_data_provider_class(config)
+
+
+class DedupAttachmentPublisher(AttachmentPublisher):
+    """
+    Attachment publisher that compares content hashes with the attachments
+    already on the page and only uploads bytes confluence does not have yet.
+
+    The hash of every uploaded file is stored in the comment of the attachment
+    version, which confluence returns with the attachment metadata. Changed
+    files are uploaded as a new version of the existing attachment.
+    """
+
+    comment_prefix = 'sha256:'
+    list_limit = 200
+
+    def __init__(self, api, hasher=None):
+        super(DedupAttachmentPublisher, self).__init__(api)
+        self._hasher = hasher or FileHasher()
+        self._attachments = {}
+        self._lock = threading.Lock()
+
+    def _page_attachments(self, content_id):
+        """
+        Current attachments of a page by filename, fetched once per publish
+        """
+        with self._lock:
+            if content_id in self._attachments:
+                return self._attachments[content_id]
+
+        attachments = {}
+        start = 0
+        while True:
+            data = self._api.list_attachments(content_id, expand='version', start=start, limit=self.list_limit)
+            results = data.get('results', [])
+            for attachment_data in results:
+                attachments[attachment_data['title']] = {
+                    'id': attachment_data['id'],
+                    'comment': (attachment_data.get('metadata') or {}).get('comment'),
+                }
+            if len(results) < self.list_limit or 'next' not in data.get('_links', {}):
+                break
+            start += len(results)
+
+        with self._lock:
+            self._attachments[content_id] = attachments
+        return attachments
+
+    def publish(self, content_id, filepath):
+        """
+        :return: ``True`` if the file was uploaded, ``False`` if confluence
+            already has identical content
+        """
+        filename = os.path.basename(filepath)
+        comment = self.comment_prefix + self._hasher(filepath)
+        current = self._page_attachments(content_id).get(filename)
+        if current is not None and current['comment'] == comment:
+            logger.debug('Attachment %s of page %s is unchanged', filename, content_id)
+            return False
+
+        with open(filepath, 'rb') as f:
+            if current is not None:
+                self._api.update_attachment_data(content_id, current['id'], f, comment=comment)
+                attachment_id = current['id']
+            else:
+                data = self._api.create_attachment(content_id, f, comment=comment) or {}
+                attachment_id = ((data.get('results') or [data])[0]).get('id')
+        self._uploaded(content_id, filename, attachment_id, comment)
+        return True
+
+    def _uploaded(self, content_id, filename, attachment_id, comment):
+        """
+        Record an upload in the attachments of the page, so the same filename
+        published to the page again is compared with what was just uploaded
+        """
+        with self._lock:
+            if attachment_id is None:
+                # unknown id: list the attachments of the page again next time
+                self._attachments.pop(content_id, None)
+            elif content_id in self._attachments:
+                self._attachments[content_id][filename] = {'id': attachment_id, 'comment': comment}
+
+
+def create_publisher(config, confluence_api, manifest=None, max_workers=1):
+    page_manager = SplitPageManager(confluence_api)
+    attachment_publisher = DedupAttachmentPublisher(confluence_api)
+
+    data_provider_class = get_storage_data_provider_class(config)
+
+    data_provider = data_provider_class(
+        base_dir=config.base_dir,
+        downloads_dir=config.downloads_dir,
+        images_dir=config.images_dir,
+        source_ext=config.source_ext
+    )
+    add_split_pages(config.pages, data_provider)
+    return IncrementalPublisher(config, data_provider, page_manager, attachment_publisher, manifest,
+                                max_workers=max_workers)
+
+
+class IncrementalPublisher(Publisher):
+    """
+    Publisher that skips pages and attachments whose content hash did not change
+    since the last successful publish recorded in the :class:`PublishManifest`.
+
+    ``force`` publishes everything, ignoring both the manifest and the
+    comparison with the current page on the server.
+    """
+
+    def __init__(self, config, data_provider, page_manager, attachment_manager, manifest=None, max_workers=1):
+        super(IncrementalPublisher, self).__init__(config, data_provider, page_manager, attachment_manager)
+        self._manifest = manifest
+        self._manifest_lock = threading.Lock()
+        self._scheduler = PublishScheduler(max_workers)
+        self._hasher = getattr(attachment_manager, '_hasher', None) or FileHasher()
+
+    def _changed(self, page_id, digest, force):
+        return force or self._manifest is None or self._manifest.page_changed(page_id, digest)
+
+    def publish(self, force=False, watermark=False, hold_titles=False):
+        """
+        Publish all pages, parents before their children.
+
+        :return: list of :class:`PublishResult`
+        :raises PublishError: after all other pages were processed, if any page failed
+        """
+        def task(page_config):
+            return self.publish_page_config(page_config, force, watermark, hold_titles)
+
+        try:
+            results = self._scheduler.run(self._config.pages, task)
+        finally:
+            if self._manifest is not None:
+                self._manifest.save()
+        return self.summarize(results)
+
+    @staticmethod
+    def summarize(results):
+        """
+        Log the number of pages by status.
+
+        :return: ``results``
+        :raises PublishError: if any page failed
+        """
+        counts = dict((status, 0) for status in (PublishResult.PUBLISHED, PublishResult.UNCHANGED,
+                                                 PublishResult.FAILED, PublishResult.SKIPPED))
+        for result in results:
+            counts[result.status] += 1
+        logger.info('Published %(published)d pages, %(unchanged)d unchanged, %(failed)d failed, %(skipped)d skipped',
+                    counts)
+
+        if counts[PublishResult.FAILED]:
+            failed = [result for result in results if result.status == PublishResult.FAILED]
+            raise PublishError('{} of {} pages failed to publish: {}'.format(
+                len(failed), len(results), ', '.join(str(result.page_id) for result in failed)), results)
+        return results
+
+    def publish_page_config(self, page_config, force=False, watermark=False, hold_titles=False, attachments=True):
+        """
+        Publish a single page and, unless ``attachments`` is false, its
+        attachments.
+
+        :return: ``True`` if anything was sent to confluence
+        """
+        title, body = self._data_provider.get_source_data(self._data_provider.get_source(page_config.source))
+        created = False
+        if page_config.id is None and isinstance(page_config, SplitPageConfig):
+            page_config.id, created = self._split_page_id(page_config, title, body, force)
+        if page_config.id is None:
+            raise AttributeError('Missed attribute "id"')
+        digest = hash_text(title, body, page_config.title, page_config.link, page_config.watermark, hold_titles)
+
+        published = created
+        if self._changed(page_config.id, digest, force):
+            # a page created just now already has its body
+            published = self._publish_page_data(page_config, title, body, force, hold_titles) or created
+            if self._manifest is not None:
+                with self._manifest_lock:
+                    self._manifest.set_page(page_config.id, digest)
+        else:
+            logger.debug('Page %s is unchanged since the last publish', page_config.id)
+
+        if attachments and self.publish_attachments(page_config, force):
+            published = True
+        return published
+
+    def _split_page_id(self, page_config, title, body, force=False):
+        """
+        Id of the child page of a split document, from the manifest unless
+        ``force`` is set, otherwise found or created on confluence
+
+        :return: ``(page_id, created)``
+        """
+        parent_id = page_config.parent.id
+        if not force and self._manifest is not None:
+            page_id = self._manifest.part_page(parent_id, title)
+            if page_id is not None:
+                return page_id, False
+        page_id, created = self._page_manager.find_or_create(parent_id, title, body)
+        if self._manifest is not None:
+            with self._manifest_lock:
+                self._manifest.set_part_page(parent_id, title, page_id)
+        return page_id, created
+
+    def publish_attachments(self, page_config, force=False):
+        """
+        Publish the attachments of a page whose id is known.
+
+        :return: ``True`` if any attachment was uploaded
+        """
+        published = False
+        for path in self._page_attachment_files(page_config):
+            file_digest = self._hasher(path)
+            if not force and self._manifest is not None \
+                    and not self._manifest.attachment_changed(page_config.id, path, file_digest):
+                continue
+            if self._publish_page_attachement(page_config.id, path):
+                published = True
+            if self._manifest is not None:
+                with self._manifest_lock:
+                    self._manifest.set_attachment(page_config.id, path, file_digest)
+
+        return published
+
+    def _page_attachment_files(self, page_config):
+        paths = [self._page_attachment_file(attachment_config)
+                 for attachment_config in page_config.images + page_config.downloads]
+        if isinstance(self._data_provider, SphinxStorageDataProvider):
+            paths.extend(self._data_provider.literal_blocks(page_config.source))
+        return paths
+
+    def _publish_page_attachement(self, content_id, filename):
+        uploaded = self._attachment_manager.publish(content_id, filename)
+        if uploaded is False:
+            logger.debug('Skipped attachment %s (parent_id: %s): identical content on confluence', filename, content_id)
+        else:
+            logger.info('Published attachment: %s (parent_id: %s)', filename, content_id)
+        return uploaded is not False
+
+    def _publish_page_data(self, page_config, title, body, force=False, hold_titles=False):
+        current_page = self._page_manager.load(page_config.id)
+        page = copy.copy(current_page)
+        page.title, page.body = title, body
+
+        mutators = self._init_page_mutators(page_config, page.title, hold_titles)
+        self._remove_page_mutators(current_page, mutators)
+
+        page.title = self._page_title(current_page.title, page.title, page_config.title, hold_titles)
+        if not force and current_page == page:
+            return False
+
+        self._add_page_mutators(page, mutators)
+        self._publish_page(page)
+        return True
+
+
+def file_state(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+class PublishPipeline(object):
+    """
+    Publishes the output of the ``confluence`` builder while it is still
+    writing.
+
+    :meth:`start` is called before the write phase with the docnames about to
+    be written. A page is ready once its output file was replaced (the builder
+    writes every page to a temporary file first), pages of documents that are
+    not written again are ready at once, and every page is ready once writing
+    has ended: a page that was not written again is published from its
+    existing file, a page without a file fails. Pages are published by a
+    :class:`PublishScheduler` in a background thread, parents before their
+    children. Attachments are only published by :meth:`finish`, after the
+    builder copied the images and downloads.
+
+    :meth:`finish` and :meth:`stop` wait at most ``timeout`` seconds for the
+    pages still being published.
+    """
+
+    timeout = 3600
+
+    def __init__(self, publisher, metrics=None, force=False, watermark=False, hold_titles=False, timeout=None):
+        self.publisher = publisher
+        self.metrics = metrics
+        self.options = {'force': force, 'watermark': watermark, 'hold_titles': hold_titles}
+        if timeout is not None:
+            self.timeout = timeout
+        self.scheduler = publisher._scheduler
+        self.pid = os.getpid()
+        self.previous = {}
+        self.writing_finished = threading.Event()
+        self.results = None
+        self.error = None
+        self.thread = None
+
+    def _docname(self, page_config):
+        data_provider = self.publisher._data_provider
+        return data_provider._docname(data_provider.get_source(page_config.source))
+
+    def start(self, docnames):
+        docnames = set(docnames)
+        for page_config in flatten_page_config_list(self.publisher._config.pages):
+            base = page_config.parent if isinstance(page_config, SplitPageConfig) else page_config
+            if self._docname(base) in docnames:
+                path = self.publisher._data_provider.get_source(page_config.source)
+                self.previous[path] = file_state(path)
+        self.thread = threading.Thread(target=self._run, name='sphinx-confluence-publish')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        def task(page_config):
+            path = self.publisher._data_provider.get_source(page_config.source)
+            if not os.path.exists(path):
+                raise PublishError('{} was not written by the build'.format(path))
+            return self.publisher.publish_page_config(page_config, attachments=False, **self.options)
+
+        try:
+            self.results = self.scheduler.run(self.publisher._config.pages, task, self.is_ready)
+        except Exception as e:
+            self.error = e
+
+    def is_ready(self, page_config):
+        if self.writing_finished.is_set():
+            return True
+        path = self.publisher._data_provider.get_source(page_config.source)
+        if path not in self.previous:
+            return True
+        state = file_state(path)
+        return state is not None and state != self.previous[path]
+
+    def written(self):
+        """
+        Check the waiting pages again, called after a document was written
+        """
+        # a no-op in the worker processes of a parallel write
+        if os.getpid() == self.pid:
+            self.scheduler.wake.set()
+
+    def cancel(self):
+        self.scheduler.cancelled.set()
+        self.scheduler.wake.set()
+
+    def join(self, timeout=None):
+        """
+        Wait at most ``timeout`` seconds for the publishing thread
+
+        :return: ``True`` if it has ended
+        """
+        if self.thread is None:
+            return True
+        self.thread.join(timeout)
+        return not self.thread.is_alive()
+
+    def save_manifest(self):
+        if self.publisher._manifest is not None:
+            with self.publisher._manifest_lock:
+                self.publisher._manifest.save()
+
+    def stop(self):
+        """
+        Cancel the pages that were not started yet and wait for the running
+        ones; the manifest keeps the pages that were published
+        """
+        self.cancel()
+        if not self.join(self.timeout):
+            logger.warning('Gave up waiting for the running uploads after %s seconds', self.timeout)
+        self.save_manifest()
+
+    def finish(self):
+        """
+        Called once writing has ended: wait until all pages are published,
+        then publish their attachments.
+
+        :return: list of :class:`PublishResult`
+        :raises PublishError: if any page failed, or if publishing did not end
+            within ``timeout`` seconds
+        """
+        self.writing_finished.set()
+        self.scheduler.wake.set()
+        if not self.join(self.timeout):
+            self.cancel()
+            self.save_manifest()
+            raise PublishError('Pages were still being published {} seconds after writing ended, '
+                               'the remaining pages were cancelled'.format(self.timeout))
+        try:
+            if self.error is not None:
+                raise self.error
+            self._publish_attachments(self.results)
+        finally:
+            self.save_manifest()
+        return self.publisher.summarize(self.results)
+
+    def _publish_attachments(self, results):
+        by_page = dict(((result.page_id, result.source), result) for result in results
+                       if result.status in (PublishResult.PUBLISHED, PublishResult.UNCHANGED))
+        page_configs = [page_config for page_config in flatten_page_config_list(self.publisher._config.pages)
+                        if (page_config.id, page_config.source) in by_page]
+
+        def task(page_config):
+            return page_config, self.publisher.publish_attachments(page_config, self.options['force'])
+
+        with ThreadPoolExecutor(max_workers=self.scheduler.max_workers) as executor:
+            futures = dict((executor.submit(task, page_config), page_config) for page_config in page_configs)
+            for future in as_completed(futures):
+                page_config = futures[future]
+                result = by_page[(page_config.id, page_config.source)]
+                try:
+                    if future.result()[1]:
+                        result.status = PublishResult.PUBLISHED
+                except Exception as e:
+                    logger.warning('Failed to publish the attachments of page %s (%s): %s',
+                                   page_config.id, page_config.source, e)
+                    result.status = PublishResult.FAILED
+                    result.error = e
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Resolution of reference nodes to confluence links
+
+The href of a reference and the anchor macros written in front of it only
+depend on a handful of node attributes and the title of the page being
+written, so they are computed once per distinct reference and looked up for
+every further node of the build.
+
+"""
+
+from functools import lru_cache
+
+
+def page_prefix(page_title):
+    """
+    Prefix confluence gives the anchors of a page, ``#<ShortTitle>-``
+    """
+    return '#%s-' % page_title.replace(' ', '')
+
+
+def viewcode_anchor(refuri, reftitle):
+    """
+    Anchor of the object a bitbucket viewcode link points to,
+    ``package.module.Object`` from ``.../browse/package/module.py#Object``
+    """
+    if refuri is not None:
+        if not refuri:
+            return None
+        start = refuri.find('/browse/') + 8
+        uri_parts = refuri[start:].split('/')
+        uri_parts[-1] = uri_parts[-1].replace('#', '')
+        uri_parts[-2] = uri_parts[-2][:uri_parts[-2].find('.py')]
+        return '.'.join(uri_parts)
+    if reftitle:
+        return reftitle.split('#')[-1]
+    return None
+
+
+def resolve_reference(page_title, refuri, refid, internal, reftitle, refpage):
+    """
+    :param page_title: title of the page being written, ``None`` for partial
+        renders
+    :param refpage: ``(server_path, short_title)`` of the confluence page a
+        reference to another document points to
+    :return: ``(href, anchors)``, the anchors to write before the link
+    """
+    href = ''
+    # Confluence makes internal links with prefix from page title
+    if internal and page_title is not None:
+        href += page_prefix(page_title)
+    href += refuri if refuri is not None else refid
+
+    anchors = ()
+    if href.startswith('#'):
+        start = href.find('https:')
+        parts = href[start:].split('/')
+        if start >= 0 and len(parts) > 2 and '#' in parts[-2] and '#' in parts[-1]:
+            # if it's a bitbucket viewcode
+            href = '/'.join(parts[:-1])
+            anchor = viewcode_anchor(refuri, reftitle)
+            anchors = (anchor, parts[-1][1:]) if anchor else (parts[-1][1:],)
+
+    if refpage is not None and not href.startswith('http'):
+        # Fix links for confluence pages
+        target = refuri.split('/')[-1][1:] if refuri else None
+        if not target and reftitle is not None:
+            target = reftitle.split('#')[-1]
+        server_path, short_title = refpage
+        href = server_path + '#%s-' % short_title + (target or '')
+
+    return href, anchors
+
+
+def count_targets(env):
+    """
+    Number of documents and link targets (the objects of every domain, labels
+    included) of a build
+    """
+    count = len(env.found_docs)
+    for domain in getattr(env, 'domains', {}).values():
+        count += sum(1 for _ in domain.get_objects())
+    return count
+
+
+class ReferenceResolver(object):
+    """
+    :func:`resolve_reference` behind a LRU cache shared by all translators of
+    a build. The cache is sized for ``targets`` documents and link targets
+    (see :func:`count_targets`): ``entries_per_target`` entries each, at least
+    ``min_cache_size``.
+    """
+
+    min_cache_size = 1024
+    entries_per_target = 4
+
+    def __init__(self, targets=0):
+        self.cache_size = max(self.min_cache_size, targets * self.entries_per_target)
+        self.resolve = lru_cache(maxsize=self.cache_size)(resolve_reference)
+
+    def resolve_node(self, node, page_title):
+        refpage = node.get('refpage')
+        if refpage is not None:
+            refpage = (refpage.get('server_path'), refpage.get('short_title'))
+        return self.resolve(page_title, node.get('refuri'), node.get('refid'), bool(node.get('internal')),
+                            node.get('reftitle'), refpage)
+
+    def cache_info(self):
+        return self.resolve.cache_info()
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Splitting of oversized documents into child pages
+
+A document is split at its sections of a given level: every such section
+becomes a child page of the document's page, everything else stays on the
+page itself. Parts are decided while reading, so references from any
+document can be pointed at the child page that holds their target.
+
+"""
+
+from docutils import nodes
+
+
+def section_level(section):
+    """
+    Level of a section, ``1`` for the section holding the document title
+    """
+    level = 0
+    node = section
+    while node is not None:
+        if isinstance(node, nodes.section):
+            level += 1
+        node = node.parent
+    return level
+
+
+def document_size(doctree, limit=None):
+    """
+    Size of the document in UTF-8 bytes, as docutils XML; close enough to the
+    size of the storage format to compare against a page size limit.
+
+    Counting stops as soon as the size exceeds ``limit``.
+    """
+    size = 0
+    for node in doctree.traverse():
+        if isinstance(node, nodes.Text):
+            size += len(node.astext().encode('utf-8'))
+        else:
+            size += len((node.starttag() + node.endtag()).encode('utf-8'))
+        if limit is not None and size > limit:
+            break
+    return size
+
+
+def part_docname(docname, index):
+    return '{}.part{}'.format(docname, index)
+
+
+def find_parts(docname, doctree, level, title_format, page_title):
+    """
+    One part per section of ``level``, in document order.
+
+    :return: list of dicts with the ``docname`` of the part, its page
+        ``title``, the first id of its ``section`` and all ``ids`` within
+    """
+    parts = []
+    for section in doctree.traverse(nodes.section):
+        if not section['ids'] or section_level(section) != level:
+            continue
+        ids = []
+        for node in section.traverse(nodes.Element):
+            ids.extend(node.get('ids', ()))
+        section_title = section[0].astext() if len(section) and isinstance(section[0], nodes.title) else ''
+        parts.append({'docname': part_docname(docname, len(parts) + 1),
+                      'title': title_format.format(page=page_title or docname, section=section_title),
+                      'section': section['ids'][0],
+                      'section_ids': list(section['ids']),
+                      'ids': ids})
+    return parts
+
+
+def split_doctree(doctree, parts):
+    """
+    Move the section of every part out of ``doctree`` into a document of its
+    own. Targets pointing to ids on another page are dropped, as is the table
+    of contents (a raw node marked ``toc``) if no section is left below the
+    document title.
+
+    :return: list of ``(part, document)`` pairs
+    """
+    sections = {}
+    for section in doctree.traverse(nodes.section):
+        if section['ids']:
+            sections.setdefault(section['ids'][0], section)
+
+    documents = []
+    for part in parts:
+        section = sections.get(part['section'])
+        if section is None or section.parent is None:
+            continue
+        section.parent.remove(section)
+        document = doctree.copy()
+        document.append(section)
+        documents.append((part, document))
+    if not documents:
+        return documents
+
+    pages = {}
+    for part, document in documents:
+        pages.update(dict.fromkeys(part['ids'], document))
+    for document in [doctree] + [document for part, document in documents]:
+        for target in document.traverse(nodes.target):
+            if pages.get(target.get('refid'), document) is not document and not target['ids']:
+                target.parent.remove(target)
+    if not any(section_level(section) > 1 for section in doctree.traverse(nodes.section)):
+        for raw in doctree.traverse(nodes.raw):
+            if raw.get('toc'):
+                raw.parent.remove(raw)
+    return documents
+
+
+def part_links(parts):
+    """
+    Page title of the part holding every id of a split document and the anchor
+    to link to; the section of a part is its page title, which has no anchor
+    """
+    links = {}
+    for part in parts or ():
+        section_ids = part.get('section_ids', [part['section']])
+        for node_id in part['ids']:
+            links.setdefault(node_id, (part['title'], node_id if node_id not in section_ids else None))
+    return links
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Small helpers shared by the sphinx_confluence modules
+
+"""
+
+import io
+import json
+import os
+
+
+class JSONStore(object):
+    """
+    Dict persisted as a JSON file, written atomically.
+
+    ``path`` may be a directory, in which case the store lives in
+    ``<path>/<filename>``.
+    """
+
+    filename = None
+
+    def __init__(self, path):
+        if os.path.isdir(path):
+            path = os.path.join(path, self.filename)
+        self.path = path
+        self.entries = {}
+        self.load()
+
+    def load(self):
+        try:
+            with io.open(self.path, encoding='utf-8') as f:
+                self.entries = json.load(f)
+        except (IOError, OSError, ValueError):
+            self.entries = {}
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp_path = self.path + '.tmp'
+        with io.open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(self.entries, indent=1, sort_keys=True, ensure_ascii=False))
+        os.replace(tmp_path, self.path)
+
+
+class StreamingBody(object):
+    """
+    Drop-in replacement for the ``body`` list of a docutils translator that
+    writes its fragments to ``stream`` (a file or an upload stream, anything
+    with ``write``) instead of keeping the whole document in memory.
+
+    ``size`` and ``peak_buffered_chars`` count the characters of the buffered
+    fragments, not the memory they take.
+
+    Indexes stay absolute, as translators keep ``len(self.body)`` positions in
+    their context. Fragments are only written by :meth:`flush`, which the
+    translator calls at points where no such position refers to them any more;
+    accessing a written fragment raises :class:`IndexError`.
+    """
+
+    def __init__(self, stream, buffer_size=1024 * 1024):
+        self.stream = stream
+        self.buffer_size = buffer_size
+        self.fragments = []
+        self.offset = 0
+        self.size = 0
+        self.peak_buffered_chars = 0
+        self.written = 0
+
+    def _local(self, index):
+        if isinstance(index, slice):
+            return slice(self._local_bound(index.start), self._local_bound(index.stop), index.step)
+        if index >= 0:
+            index -= self.offset
+            if index < 0:
+                raise IndexError('body fragment was already written to the stream')
+        return index
+
+    def _local_bound(self, bound):
+        if bound is None or bound < 0:
+            return bound
+        if bound < self.offset:
+            raise IndexError('body fragment was already written to the stream')
+        return bound - self.offset
+
+    def _grow(self, size):
+        self.size += size
+        if self.size > self.peak_buffered_chars:
+            self.peak_buffered_chars = self.size
+
+    def _recount(self):
+        self.size = sum(len(fragment) for fragment in self.fragments)
+
+    def __len__(self):
+        return self.offset + len(self.fragments)
+
+    def __iter__(self):
+        return iter(self.fragments)
+
+    def __getitem__(self, index):
+        return self.fragments[self._local(index)]
+
+    def __setitem__(self, index, value):
+        self.fragments[self._local(index)] = value
+        self._recount()
+
+    def __delitem__(self, index):
+        del self.fragments[self._local(index)]
+        self._recount()
+
+    def append(self, fragment):
+        self.fragments.append(fragment)
+        self._grow(len(fragment))
+
+    def extend(self, fragments):
+        for fragment in fragments:
+            self.append(fragment)
+
+    def insert(self, index, fragment):
+        self.fragments.insert(self._local(index), fragment)
+        self._grow(len(fragment))
+
+    def pop(self, index=-1):
+        fragment = self.fragments.pop(self._local(index))
+        self.size -= len(fragment)
+        return fragment
+
+    def flush(self, keep=1):
+        """
+        Write all buffered fragments but the last ``keep`` ones to the stream
+        """
+        count = len(self.fragments) - keep
+        if count <= 0:
+            return
+        data = ''.join(self.fragments[:count])
+        self.stream.write(data)
+        self.written += len(data.encode('utf-8'))
+        self.offset += count
+        del self.fragments[:count]
+        self._recount()
+
+    def flush_if_full(self):
+        if self.size >= self.buffer_size:
+            self.flush()
+
+    def close(self):
+        self.flush(keep=0)
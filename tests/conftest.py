@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+
+import pytest
+
+from sphinx.application import Sphinx
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+
+
+@pytest.fixture
+def build(tmp_path):
+    """
+    Build ``example.rst`` with ``buildername`` and the given config values,
+    the way tox runs ``sphinx-build -C``
+
+    :return: the :class:`~sphinx.application.Sphinx` application
+    """
+    def build(buildername, **overrides):
+        confoverrides = {'master_doc': 'example', 'extensions': ['sphinx_confluence', 'sphinx.ext.todo']}
+        confoverrides.update(overrides)
+        app = Sphinx(TESTS, None, str(tmp_path / buildername), str(tmp_path / 'doctrees'), buildername,
+                     confoverrides, status=io.StringIO(), warning=io.StringIO(), freshenv=True)
+        app.build()
+        return app
+    return build
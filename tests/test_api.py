@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+from email.utils import formatdate
+import io
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('conf_publisher')
+
+import requests  # noqa: E402
+
+from sphinx_confluence.api import ConfluenceApi, PublishMetrics, RequestScheduler, retry_after  # noqa: E402
+
+URL = 'https://confluence.example.com'
+
+
+def response(status=200, content=b'{}', headers=None):
+    r = requests.Response()
+    r.status_code = status
+    r._content = content
+    r.headers.update(headers or {})
+    return r
+
+
+class FakeRequester(object):
+    """
+    Returns the queued responses (or raises the queued exceptions) in turn
+    and records the uploaded bytes of every attempt
+    """
+
+    __name__ = 'post'
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.uploads = []
+
+    def __call__(self, url, **kwargs):
+        self.uploads.append([f.read() for f in (kwargs.get('files') or {}).values()])
+        result = self.responses.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+def api(retries=3):
+    scheduler = RequestScheduler(retries=retries, backoff=0)
+    return ConfluenceApi(URL, 'auth', PublishMetrics(), scheduler)
+
+
+def test_retry_after():
+    assert retry_after(None) is None
+    assert retry_after(response()) is None
+    assert retry_after(response(headers={'Retry-After': '2.5'})) == 2.5
+    assert retry_after(response(headers={'Retry-After': '-1'})) == 0.0
+    assert retry_after(response(headers={'Retry-After': 'soon'})) is None
+    delay = retry_after(response(headers={'Retry-After': formatdate(time.time() + 30, usegmt=True)}))
+    assert 25 < delay <= 30
+
+
+def test_token_bucket_limits_rate():
+    scheduler = RequestScheduler(rate=50, burst=1)
+    start = time.monotonic()
+    for _ in range(6):
+        scheduler.acquire()
+        scheduler.release()
+    assert time.monotonic() - start >= 0.09
+
+
+def test_window_limits_requests_in_flight():
+    scheduler = RequestScheduler(max_concurrency=1)
+    scheduler.acquire()
+    acquired = threading.Event()
+
+    def second():
+        scheduler.acquire()
+        acquired.set()
+        scheduler.release()
+
+    thread = threading.Thread(target=second)
+    thread.start()
+    assert not acquired.wait(0.1)
+    scheduler.release()
+    assert acquired.wait(5)
+    thread.join()
+
+
+def test_window_shrinks_on_throttling_and_grows_back():
+    scheduler = RequestScheduler(max_concurrency=8, cooldown=60)
+    scheduler.acquire()
+    scheduler.release(throttled=True)
+    assert scheduler.window == 4
+    # within the cooldown, a burst of throttled responses halves it once
+    scheduler.acquire()
+    scheduler.release(throttled=True)
+    assert scheduler.window == 4
+
+    # about one more request per window of successful requests
+    for _ in range(5):
+        scheduler.acquire()
+        scheduler.release()
+    assert 5 <= scheduler.window < 5.5
+    for _ in range(100):
+        scheduler.acquire()
+        scheduler.release()
+    assert scheduler.window == 8
+
+
+def test_retry_after_pauses_every_request():
+    scheduler = RequestScheduler()
+    assert scheduler.delay(1, response(429, headers={'Retry-After': '0.2'})) == 0.2
+    start = time.monotonic()
+    scheduler.acquire()
+    scheduler.release()
+    assert time.monotonic() - start >= 0.15
+
+
+def test_backoff_is_bounded():
+    scheduler = RequestScheduler(backoff=1, max_backoff=3)
+    assert all(0 <= scheduler.delay(attempt) <= 3 for attempt in range(1, 10))
+
+
+def test_retries_throttled_requests():
+    client = api()
+    requester = FakeRequester(response(429, headers={'Retry-After': '0'}), response(503),
+                              response(content=b'{"a": 1}'))
+    assert client._request(requester, URL + '/rest/api/content/12') == {'a': 1}
+    assert client.metrics.retries == {'POST content/{id}': 2}
+    assert client.metrics.endpoints['POST content/{id}']['errors'] == 2
+
+
+def test_gives_up_after_retries():
+    client = api(retries=1)
+    requester = FakeRequester(response(502), response(502), response())
+    with pytest.raises(requests.HTTPError):
+        client._request(requester, URL + '/rest/api/content/12')
+    assert len(requester.responses) == 1
+
+
+def test_does_not_retry_client_errors():
+    requester = FakeRequester(response(404), response())
+    with pytest.raises(requests.HTTPError):
+        api()._request(requester, URL + '/rest/api/content/12')
+    assert len(requester.responses) == 1
+
+
+def test_retries_connection_errors():
+    requester = FakeRequester(requests.ConnectionError('reset'), response())
+    assert api()._request(requester, URL + '/rest/api/content/12') == {}
+
+    requester = FakeRequester(requests.ConnectionError('reset'), requests.Timeout('slow'), response())
+    with pytest.raises(requests.Timeout):
+        api(retries=1)._request(requester, URL + '/rest/api/content/12')
+
+
+def test_uploads_are_rewound_on_retry():
+    client = api()
+    attachment = io.BytesIO(b'attachment data')
+    requester = FakeRequester(response(503), requests.ConnectionError('reset'), response())
+    client._request(requester, URL + '/rest/api/content/12/child/attachment', files={'file': attachment})
+    assert requester.uploads == [[b'attachment data']] * 3
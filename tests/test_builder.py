@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+import io
+import json
+import os
+
+import pytest
+
+
+def read(path):
+    with io.open(path, encoding='utf-8') as f:
+        return f.read()
+
+
+def test_confluence_builder_writes_storage_format(build):
+    app = build('confluence')
+    page = read(os.path.join(app.outdir, 'example.xml'))
+    # no html page around the body and no page title, which is the page's own
+    assert not page.lstrip().startswith('<!DOCTYPE')
+    assert 'Document Title' not in page
+    assert '<h2>Chapter 1 Title</h2>' in page
+    assert '<ac:structured-macro ac:name="toc">' in page
+    assert '<ac:structured-macro ac:name="info">' in page
+    assert '\n  </ac:rich-text-body>\n</ac:structured-macro>\n' in page
+    assert '<ri:attachment ri:filename="image.png"' in page
+    assert os.path.exists(os.path.join(app.outdir, '_images', 'image.png'))
+    assert [name for name in os.listdir(app.outdir) if name.endswith('.tmp')] == []
+
+    pages = json.loads(read(os.path.join(app.outdir, 'confluence_pages.json')))
+    assert pages == {'example': {'title': 'Document Title'}}
+
+
+def test_confluence_builder_matches_json_builder(build):
+    body = read(os.path.join(build('confluence').outdir, 'example.xml'))
+    document = json.loads(read(os.path.join(build('json').outdir, 'example.fjson')))
+    assert body.strip() == document['body'].strip()
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_write_page_keeps_previous_page_on_failure(build, stream):
+    app = build('confluence', sphinx_confluence_stream_output=stream)
+    outfilename = os.path.join(app.outdir, 'example.xml')
+    previous = read(outfilename)
+    builder = app.builder
+
+    def failing_write(doctree, destination):
+        if builder.body_stream is not None:
+            builder.body_stream.write(u'<p>partial')
+        raise RuntimeError('writing failed')
+
+    builder.docwriter.write = failing_write
+    builder.current_docname = 'example'
+    with pytest.raises(RuntimeError):
+        builder.write_page('example', app.env.get_doctree('example'), None, outfilename)
+    assert read(outfilename) == previous
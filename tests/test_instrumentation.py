@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+import io
+import json
+import os
+import tracemalloc
+
+from sphinx_confluence.instrumentation import BuildRecorder, iter_listeners, wrap_listeners
+
+
+def allocate(docname, size):
+    return len(bytearray(size))
+
+
+def test_traced_records_peak_memory():
+    recorder = BuildRecorder()
+    write = recorder.traced(allocate)
+    assert write('big', 4 * 1024 * 1024) == 4 * 1024 * 1024
+    write('small', 1024)
+    assert recorder.peak_memory['big'] >= 4 * 1024 * 1024
+    assert recorder.peak_memory['small'] < 1024 * 1024
+    assert not tracemalloc.is_tracing()
+
+
+def test_traced_without_resetting_the_peak(monkeypatch):
+    monkeypatch.delattr(tracemalloc, 'reset_peak', raising=False)
+    recorder = BuildRecorder()
+    write = recorder.traced(allocate)
+    tracemalloc.start()
+    try:
+        write('doc', 1024)
+        assert tracemalloc.is_tracing()
+    finally:
+        tracemalloc.stop()
+    assert recorder.peak_memory == {}
+    assert recorder.memory_untraced
+
+
+class FakeApp(object):
+    def __init__(self):
+        self.events = type('Events', (object,), {})()
+        self.events.listeners = {'doctree-read': {1: on_doctree_read}}
+
+
+def on_doctree_read(app, doctree):
+    return doctree
+
+
+def test_wrap_listeners():
+    app = FakeApp()
+    recorder = BuildRecorder()
+    wrap_listeners(app, recorder)
+    handler = app.events.listeners['doctree-read'][1]
+    assert handler.__wrapped__ is on_doctree_read
+    assert handler(app, 'doctree') == 'doctree'
+    assert handler(app, 'doctree') == 'doctree'
+    assert [event for event, _, _, _ in iter_listeners(app)] == ['doctree-read']
+    timing = recorder.events['doctree-read'][__name__ + '.on_doctree_read']
+    assert timing['calls'] == 2
+
+
+def test_instrumented_build_writes_report(build, tmp_path):
+    path = str(tmp_path / 'report.json')
+    app = build('confluence', sphinx_confluence_instrument=True, sphinx_confluence_instrument_memory=True,
+                sphinx_confluence_instrument_path=path)
+    with io.open(path, encoding='utf-8') as f:
+        report = json.load(f)
+
+    assert report['builder'] == 'confluence'
+    assert set(report['documents']['example']) == set(['read', 'write'])
+    assert report['documents']['example']['write']['calls'] == 1
+    assert 'sphinx_confluence.collect_titles' in report['events']['doctree-read']
+    assert report['visitors']['visit_section']['calls'] > 0
+    assert report['page_bytes']['example'] == os.path.getsize(os.path.join(app.outdir, 'example.xml'))
+    assert report['peak_memory']['example'] > 0
+    # the report is written once
+    assert getattr(app.builder, 'confluence_recorder', None) is None
+
+
+def test_build_without_instrumentation(build):
+    app = build('confluence')
+    assert not os.path.exists(os.path.join(app.outdir, 'sphinx_confluence_instrumentation.json'))
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+import re
+from xml.dom import minidom
+
+import pytest
+
+from sphinx_confluence import macros
+
+NAMESPACES = 'xmlns:ac="http://atlassian.com/content" xmlns:ri="http://atlassian.com/resource/identifier"'
+
+
+def normalize(markup):
+    return re.sub(r'>\s+<', '><', markup).strip()
+
+
+def parse(markup):
+    return minidom.parseString('<root {}>{}</root>'.format(NAMESPACES, markup)).documentElement
+
+
+def admonition(compact):
+    return (macros.admonition('note').render_start(compact)
+            + macros.rich_text_body().render_start(compact, 1)
+            + '<p>body</p>'
+            + macros.rich_text_body().render_end(compact, 1)
+            + macros.admonition('note').render_end(compact))
+
+
+def page_link(compact):
+    return (macros.page_link('Other Page', 'anchor').render_start(compact)
+            + macros.link_body().render_start(compact, 1)
+            + '<b>text</b>'
+            + macros.link_body().render_end(compact, 1)
+            + macros.page_link('').render_end(compact))
+
+
+ELEMENTS = {
+    'anchor': lambda compact: macros.anchor('target').render(compact),
+    'code_block': lambda compact: macros.code_block('print(1)', 'python', True, True, 'title').render(compact),
+    'admonition': admonition,
+    'page_link': page_link,
+    'attachment_link': lambda compact: macros.attachment_link('file.txt', 'Full listing').render(compact),
+    'jira_issue': lambda compact: macros.jira_issue('PRJ-1').render(compact),
+    'jira_issues': lambda compact: macros.jira_issues([('jqlQuery', 'project = PRJ'),
+                                                       ('columns', 'key,summary')]).render(compact),
+    'toc': lambda compact: macros.toc().render(compact),
+    'user_link': lambda compact: macros.user_link('jdoe').render(compact),
+    'emoticon': lambda compact: macros.emoticon('smile').render(compact),
+}
+
+
+@pytest.mark.parametrize('name', sorted(ELEMENTS))
+def test_compact_and_readable_are_equivalent(name):
+    readable = ELEMENTS[name](False)
+    compact = ELEMENTS[name](True)
+    assert not re.search(r'>\s+<', compact)
+    assert normalize(readable) == compact
+    parse(compact)
+
+
+def test_readable_indents_children():
+    assert macros.toc().render().splitlines()[1].startswith('  <ac:parameter')
+
+
+@pytest.mark.parametrize('body, newline', [('<p>body</p>', True), ('<p>body</p>\n', False)])
+def test_readable_admonition_closes_on_own_lines(body, newline):
+    markup = (macros.admonition('note').render_start()
+              + macros.rich_text_body().render_start(depth=1)
+              + body
+              + macros.rich_text_body().render_end(depth=1, newline=newline)
+              + macros.admonition('note').render_end())
+    assert markup.splitlines()[-4:] == ['  <ac:rich-text-body>', '<p>body</p>', '  </ac:rich-text-body>',
+                                        '</ac:structured-macro>']
+    assert markup.endswith('\n')
+
+
+def test_parameter_values_are_escaped():
+    markup = macros.jira_issues([('jqlQuery', 'summary ~ "a <b> & c"')]).render(compact=True)
+    assert 'summary ~ "a &lt;b&gt; &amp; c"' in markup
+    parameter = parse(markup).getElementsByTagName('ac:parameter')[0]
+    assert parameter.firstChild.data == 'summary ~ "a <b> & c"'
+
+
+def test_attribute_values_are_escaped():
+    markup = macros.attachment_link('a "b" <c> & d.txt', 'text').render(compact=True)
+    assert 'ri:filename="a &quot;b&quot; &lt;c&gt; &amp; d.txt"' in markup
+    attachment = parse(markup).getElementsByTagName('ri:attachment')[0]
+    assert attachment.getAttribute('ri:filename') == 'a "b" <c> & d.txt'
+
+
+def test_cdata_end_is_split():
+    assert macros.cdata('a]]>b') == '<![CDATA[a]]]]><![CDATA[>b]]>'
+    code = 'if x[y[0]]>1: "<&>"'
+    body = parse(macros.code_block(code).render(compact=True)).getElementsByTagName('ac:plain-text-body')[0]
+    assert ''.join(child.data for child in body.childNodes) == code
+
+
+def test_attachment_link_text():
+    link = parse(macros.attachment_link('file.txt', 'see ]]> here').render(compact=True))
+    body = link.getElementsByTagName('ac:plain-text-link-body')[0]
+    assert ''.join(child.data for child in body.childNodes) == 'see ]]> here'
+    assert macros.attachment_link('file.txt', None).render(compact=True) == (
+        '<ac:link><ri:attachment ri:filename="file.txt" />'
+        '<ac:plain-text-link-body></ac:plain-text-link-body></ac:link>')
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import threading
+import time
+
+from sphinx_confluence.pages import PageMetadataCache, PageResolver
+
+CONFLUENCE = 'https://confluence.example.com'
+
+
+class FakeConfApi(object):
+    """
+    The content endpoints of the confluence REST api over a dict of pages,
+    recording every request
+    """
+
+    def __init__(self, pages, page_size=None):
+        self.pages = pages
+        self.page_size = page_size
+        self.calls = []
+        self.failing = set()
+        self.search_fails = False
+        self.lock = threading.Lock()
+
+    def info(self, page_id):
+        title, version = self.pages[str(page_id)]
+        return {'id': str(page_id), 'title': title, 'version': {'number': version},
+                '_links': {'webui': '/display/S/' + title.replace(' ', '+')}}
+
+    def get_content(self, page_id, expand=None):
+        with self.lock:
+            self.calls.append(('get', str(page_id)))
+        if str(page_id) in self.failing or str(page_id) not in self.pages:
+            raise IOError('page {} not found'.format(page_id))
+        return self.info(page_id)
+
+    def search_content(self, cql, expand=None, start=0, limit=25):
+        with self.lock:
+            self.calls.append(('search', cql, start))
+        if self.search_fails:
+            raise IOError('search failed')
+        ids = [page_id for page_id in re.match(r'id in \((.*)\)$', cql).group(1).split(',') if page_id in self.pages]
+        end = start + min(limit, self.page_size or limit)
+        data = {'results': [self.info(page_id) for page_id in ids[start:end]], '_links': {}}
+        if end < len(ids):
+            data['_links']['next'] = '/rest/api/content/search?start={}'.format(end)
+        return data
+
+
+def pages(*page_ids):
+    return [{'id': page_id, 'source': 'docs/page{}'.format(page_id)} for page_id in page_ids]
+
+
+def calls(api, kind):
+    return sorted(call[1:] for call in api.calls if call[0] == kind)
+
+
+def test_resolve_fills_in_pages():
+    api = FakeConfApi({'1': ('Home Page', 3), '2': ('Child', 1)})
+    tree = [dict(pages(1)[0], pages=pages(2))]
+    assert PageResolver(api, CONFLUENCE, batch_size=1).resolve(tree) == []
+    assert tree[0]['server_path'] == CONFLUENCE + '/display/S/Home+Page'
+    assert (tree[0]['title'], tree[0]['short_title']) == ('Home Page', 'HomePage')
+    assert tree[0]['local_path'] == os.path.abspath('docs/page1')
+    assert tree[0]['pages'][0]['title'] == 'Child'
+
+
+def test_resolve_fetches_concurrently():
+    barrier = threading.Barrier(3, timeout=5)
+
+    class BlockingApi(FakeConfApi):
+        def get_content(self, page_id, expand=None):
+            barrier.wait()
+            return FakeConfApi.get_content(self, page_id, expand)
+
+    api = BlockingApi({'1': ('A', 1), '2': ('B', 1), '3': ('C', 1)})
+    assert PageResolver(api, CONFLUENCE, max_workers=3, batch_size=1).resolve(pages(1, 2, 3)) == []
+
+
+def test_resolve_batches_with_cql():
+    api = FakeConfApi(dict((str(page_id), ('Page {}'.format(page_id), 1)) for page_id in range(1, 6)))
+    tree = pages(1, 2, 3, 4, 5)
+    assert PageResolver(api, CONFLUENCE, batch_size=2).resolve(tree) == []
+    assert calls(api, 'search') == [('id in (1,2)', 0), ('id in (3,4)', 0)]
+    # a batch of one page is fetched on its own
+    assert calls(api, 'get') == [('5',)]
+    assert [page['title'] for page in tree] == ['Page 1', 'Page 2', 'Page 3', 'Page 4', 'Page 5']
+
+
+def test_fetch_many_follows_pagination():
+    api = FakeConfApi(dict((str(page_id), ('Page {}'.format(page_id), 1)) for page_id in range(1, 6)), page_size=2)
+    found = PageResolver(api, CONFLUENCE).fetch_many(['1', '2', '3', '4', '5'])
+    assert sorted(found) == ['1', '2', '3', '4', '5']
+    assert [call[2] for call in api.calls] == [0, 2, 4]
+
+
+def test_fetch_batch_falls_back_to_single_pages():
+    api = FakeConfApi({'1': ('A', 1), '2': ('B', 1), '3': ('C', 1)})
+    api.failing.add('3')
+    resolver = PageResolver(api, CONFLUENCE)
+
+    # pages the search did not return
+    del api.pages['2']
+    results = dict((page['id'], meta) for page, meta in resolver.fetch_batch(pages(1, 2)))
+    assert results[1]['title'] == 'A'
+    assert isinstance(results[2], IOError)
+    assert calls(api, 'get') == [('2',)]
+
+    # a failed search
+    api.pages['2'] = ('B', 1)
+    api.search_fails = True
+    api.calls = []
+    results = dict((page['id'], meta) for page, meta in resolver.fetch_batch(pages(1, 2, 3)))
+    assert (results[1]['title'], results[2]['title']) == ('A', 'B')
+    assert isinstance(results[3], IOError)
+    assert calls(api, 'get') == [('1',), ('2',), ('3',)]
+
+
+def test_failed_pages_use_cached_metadata(tmp_path):
+    cache = PageMetadataCache(str(tmp_path), ttl=0)
+    cache.put(1, {'title': 'Cached', 'webui': '/display/S/Cached', 'version': 1})
+    api = FakeConfApi({})
+    tree = pages(1, 2)
+    failed = PageResolver(api, CONFLUENCE, cache=cache, batch_size=1).resolve(tree)
+    assert tree[0]['title'] == 'Cached'
+    assert failed == [tree[1]]
+    assert 'server_path' not in tree[1]
+
+    # not even from the cache when refreshing
+    tree = pages(1)
+    assert PageResolver(api, CONFLUENCE, cache=cache, refresh=True).resolve(tree) == tree
+
+
+def test_cache_skips_fresh_pages(tmp_path):
+    api = FakeConfApi({'1': ('A', 1), '2': ('B', 1)})
+    PageResolver(api, CONFLUENCE, cache=PageMetadataCache(str(tmp_path))).resolve(pages(1, 2))
+    assert len(api.calls) == 1
+
+    api.calls = []
+    tree = pages(1, 2)
+    PageResolver(api, CONFLUENCE, cache=PageMetadataCache(str(tmp_path))).resolve(tree)
+    assert api.calls == []
+    assert [page['title'] for page in tree] == ['A', 'B']
+
+    PageResolver(api, CONFLUENCE, cache=PageMetadataCache(str(tmp_path)), refresh=True).resolve(pages(1, 2))
+    assert len(api.calls) == 1
+
+
+def test_cache_revalidates_stale_pages(tmp_path):
+    cache = PageMetadataCache(str(tmp_path), ttl=60)
+    cache.put(1, {'title': 'Cached A', 'webui': '/display/S/Cached+A', 'version': 2})
+    cache.put(2, {'title': 'Cached B', 'webui': '/display/S/Cached+B', 'version': 1})
+    for entry in cache.entries.values():
+        entry['fetched'] = time.time() - 120
+    api = FakeConfApi({'1': ('A', 2), '2': ('B', 2)})
+
+    tree = pages(1, 2)
+    PageResolver(api, CONFLUENCE, cache=cache).resolve(tree)
+    assert len(api.calls) == 1
+    # still at the cached version: the metadata is kept, only the timestamp is new
+    assert tree[0]['title'] == 'Cached A'
+    assert tree[1]['title'] == 'B'
+
+    cache = PageMetadataCache(str(tmp_path), ttl=60)
+    assert cache.is_fresh(cache.get(1)) and cache.is_fresh(cache.get(2))
+    assert (cache.get(1)['title'], cache.get(2)['title'], cache.get(2)['version']) == ('Cached A', 'B', 2)
@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+import copy
+import os
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('conf_publisher')
+
+from conf_publisher.config import PageConfig  # noqa: E402
+from conf_publisher.confluence import Page  # noqa: E402
+
+from sphinx_confluence.publish import (  # noqa: E402
+    DedupAttachmentPublisher, IncrementalPublisher, PublishError, PublishManifest, PublishPipeline, PublishResult,
+    PublishScheduler, SplitPageConfig)
+
+
+def page(page_id, *subpages):
+    page_config = PageConfig()
+    page_config.id = page_id
+    page_config.source = 'page{}'.format(page_id)
+    page_config.pages = list(subpages)
+    return page_config
+
+
+def statuses(results):
+    return dict((result.page_id, result.status) for result in results)
+
+
+def test_manifest_tracks_pages_and_attachments(tmp_path):
+    manifest = PublishManifest(str(tmp_path))
+    assert manifest.page_changed(1, 'a')
+    assert manifest.attachment_changed(1, 'img.png', 'x')
+
+    manifest.set_page(1, 'a')
+    manifest.set_attachment(1, 'img.png', 'x')
+    assert not manifest.page_changed('1', 'a')
+    assert manifest.page_changed(1, 'b')
+    assert not manifest.attachment_changed(1, 'img.png', 'x')
+    assert manifest.attachment_changed(1, 'img.png', 'y')
+    assert manifest.attachment_changed(2, 'img.png', 'x')
+    manifest.save()
+
+    reloaded = PublishManifest(str(tmp_path / PublishManifest.filename))
+    assert not reloaded.page_changed(1, 'a')
+    assert not reloaded.attachment_changed(1, 'img.png', 'x')
+
+
+def test_manifest_attachment_before_page(tmp_path):
+    manifest = PublishManifest(str(tmp_path))
+    manifest.set_attachment(1, 'img.png', 'x')
+    assert manifest.page_changed(1, 'a')
+    manifest.set_page(1, 'a')
+    assert not manifest.attachment_changed(1, 'img.png', 'x')
+
+
+class FakeSplitPageManager(object):
+    def __init__(self):
+        self.calls = []
+        self.pages = {}
+        self.updated = []
+
+    def find_or_create(self, parent_id, title, body):
+        self.calls.append(title)
+        for page_id, existing in self.pages.items():
+            if existing.title == title:
+                return page_id, False
+        created = Page()
+        created.id = 100 + len(self.calls)
+        created.title, created.body = title, body
+        self.pages[created.id] = created
+        return created.id, True
+
+    def load(self, page_id):
+        return copy.copy(self.pages[page_id])
+
+    def update(self, updated):
+        self.updated.append(updated.id)
+        self.pages[updated.id] = updated
+        return updated.id
+
+
+class FakePartDataProvider(object):
+    def __init__(self, title, body):
+        self.title, self.body = title, body
+
+    def get_source(self, source):
+        return source
+
+    def get_source_data(self, filename):
+        return self.title, self.body
+
+
+def test_split_page_ids_are_kept_in_the_manifest(tmp_path):
+    manifest = PublishManifest(str(tmp_path))
+    page_manager = FakeSplitPageManager()
+    publisher = IncrementalPublisher(None, None, page_manager, None, manifest)
+    part = SplitPageConfig(page(1), 'doc.part1')
+
+    assert publisher._split_page_id(part, 'Doc - First', '<p/>') == (101, True)
+    assert publisher._split_page_id(part, 'Doc - First', '<p/>') == (101, False)
+    assert publisher._split_page_id(part, 'Doc - Second', '<p/>') == (102, True)
+    assert page_manager.calls == ['Doc - First', 'Doc - Second']
+    assert manifest.page_changed(1, 'a')
+
+    manifest.save()
+    publisher = IncrementalPublisher(None, None, page_manager, None, PublishManifest(str(tmp_path)))
+    assert publisher._split_page_id(part, 'Doc - First', '<p/>') == (101, False)
+    assert publisher._split_page_id(part, 'Doc - First', '<p/>', force=True) == (101, False)
+    assert page_manager.calls == ['Doc - First', 'Doc - Second', 'Doc - First']
+
+
+def test_created_split_pages_count_as_published():
+    page_manager = FakeSplitPageManager()
+    data_provider = FakePartDataProvider('Doc - First', '<p>first</p>')
+
+    publisher = IncrementalPublisher(None, data_provider, page_manager, None)
+    assert publisher.publish_page_config(SplitPageConfig(page(1), 'doc.part1'), attachments=False)
+    assert page_manager.updated == []
+
+    publisher = IncrementalPublisher(None, data_provider, page_manager, None)
+    assert not publisher.publish_page_config(SplitPageConfig(page(1), 'doc.part1'), attachments=False)
+
+    data_provider.body = '<p>changed</p>'
+    assert publisher.publish_page_config(SplitPageConfig(page(1), 'doc.part1'), attachments=False)
+    assert page_manager.updated == [101]
+
+
+def test_scheduler_publishes_parents_first():
+    tree = [page(1, page(2, page(4)), page(3)), page(5)]
+    started = []
+    lock = threading.Lock()
+
+    def task(page_config):
+        with lock:
+            started.append(page_config.id)
+        return page_config.id != 3
+
+    results = PublishScheduler(max_workers=3).run(tree, task)
+    assert sorted(started) == [1, 2, 3, 4, 5]
+    assert started.index(1) < started.index(2) < started.index(4)
+    assert started.index(1) < started.index(3)
+    assert statuses(results) == {1: 'published', 2: 'published', 3: 'unchanged', 4: 'published', 5: 'published'}
+
+
+def test_scheduler_runs_siblings_concurrently():
+    barrier = threading.Barrier(3, timeout=5)
+
+    def task(page_config):
+        if page_config.id != 1:
+            barrier.wait()
+        return True
+
+    results = PublishScheduler(max_workers=3).run([page(1, page(2), page(3), page(4))], task)
+    assert set(statuses(results).values()) == {PublishResult.PUBLISHED}
+
+
+def test_scheduler_skips_descendants_of_failed_pages():
+    tree = [page(1, page(2, page(3, page(4))), page(5)), page(6)]
+
+    def task(page_config):
+        if page_config.id == 2:
+            raise ValueError('boom')
+        return True
+
+    results = PublishScheduler(max_workers=2).run(tree, task)
+    assert statuses(results) == {1: 'published', 2: 'failed', 3: 'skipped', 4: 'skipped', 5: 'published',
+                                 6: 'published'}
+    failed = [result for result in results if result.status == PublishResult.FAILED]
+    assert str(failed[0].error) == 'boom'
+
+
+def test_scheduler_waits_until_pages_are_ready():
+    scheduler = PublishScheduler(max_workers=2)
+    scheduler.poll_interval = 0.01
+    ready = set()
+    published = []
+
+    def is_ready(page_config):
+        return page_config.id in ready
+
+    def task(page_config):
+        published.append(page_config.id)
+        if page_config.id == 1:
+            ready.add(2)
+            scheduler.wake.set()
+        return True
+
+    ready.add(1)
+    results = scheduler.run([page(1, page(2))], task, is_ready)
+    assert published == [1, 2]
+    assert len(results) == 2
+
+
+def test_scheduler_cancel_skips_remaining_pages():
+    scheduler = PublishScheduler(max_workers=1)
+    scheduler.poll_interval = 0.01
+
+    def task(page_config):
+        scheduler.cancelled.set()
+        return True
+
+    results = scheduler.run([page(1, page(2, page(3))), page(4)], task, lambda page_config: page_config.id != 4)
+    assert statuses(results) == {1: 'published', 2: 'skipped', 3: 'skipped', 4: 'skipped'}
+
+
+class FakeAttachmentApi(object):
+    def __init__(self, attachments=()):
+        self.attachments = dict((attachment['title'], attachment) for attachment in attachments)
+        self.calls = []
+
+    def list_attachments(self, content_id, expand=None, start=0, limit=50):
+        self.calls.append(('list', content_id))
+        return {'results': list(self.attachments.values())[start:start + limit], '_links': {}}
+
+    def create_attachment(self, content_id, attachment, comment=None):
+        title = attachment.name.replace('\\', '/').split('/')[-1]
+        if title in self.attachments:
+            raise ValueError('attachment {} already exists'.format(title))
+        self.calls.append(('create', title))
+        self.attachments[title] = {'id': 'att{}'.format(len(self.attachments)), 'title': title,
+                                   'metadata': {'comment': comment}}
+        return {'results': [self.attachments[title]]}
+
+    def update_attachment_data(self, content_id, attachment_id, attachment, comment=None):
+        self.calls.append(('update', attachment_id))
+        return {}
+
+
+def test_dedup_attachments(tmp_path):
+    image = tmp_path / 'image.png'
+    image.write_bytes(b'image')
+    api = FakeAttachmentApi()
+    publisher = DedupAttachmentPublisher(api)
+
+    assert publisher.publish(1, str(image))
+    assert not publisher.publish(1, str(image))
+
+    other = tmp_path / 'other'
+    other.mkdir()
+    (other / 'image.png').write_bytes(b'changed')
+    assert publisher.publish(1, str(other / 'image.png'))
+    assert api.calls == [('list', 1), ('create', 'image.png'), ('update', 'att0')]
+
+
+def test_dedup_attachments_compares_with_confluence(tmp_path):
+    image = tmp_path / 'image.png'
+    image.write_bytes(b'image')
+    publisher = DedupAttachmentPublisher(FakeAttachmentApi())
+    comment = publisher.comment_prefix + publisher._hasher(str(image))
+    api = FakeAttachmentApi([{'id': 'att9', 'title': 'image.png', 'metadata': {'comment': comment}}])
+    publisher = DedupAttachmentPublisher(api)
+
+    assert not publisher.publish(1, str(image))
+    image.write_bytes(b'changed')
+    assert publisher.publish(1, str(image))
+    assert api.calls == [('list', 1), ('update', 'att9')]
+
+
+class FakeDataProvider(object):
+    def __init__(self, source_dir):
+        self.source_dir = source_dir
+
+    def get_source(self, source):
+        return os.path.join(self.source_dir, source + '.xml')
+
+    def _docname(self, filename):
+        return os.path.basename(filename)[:-4]
+
+
+class FakePipelinePublisher(object):
+    summarize = staticmethod(IncrementalPublisher.summarize)
+
+    def __init__(self, source_dir, pages):
+        self._scheduler = PublishScheduler(max_workers=2)
+        self._scheduler.poll_interval = 0.01
+        self._data_provider = FakeDataProvider(source_dir)
+        self._config = type('Config', (object,), {'pages': pages})()
+        self._manifest = None
+        self._manifest_lock = threading.Lock()
+        self.release = threading.Event()
+        self.release.set()
+        self.published = []
+
+    def publish_page_config(self, page_config, attachments=True, **options):
+        self.release.wait()
+        self.published.append(page_config.id)
+        return True
+
+    def publish_attachments(self, page_config, force=False):
+        return False
+
+
+def write(tmp_path, *page_ids):
+    for page_id in page_ids:
+        tmp = tmp_path / 'page{}.xml.tmp'.format(page_id)
+        tmp.write_text(u'<p>{}</p>'.format(page_id))
+        os.replace(str(tmp), str(tmp_path / 'page{}.xml'.format(page_id)))
+
+
+def test_pipeline_publishes_pages_once_written(tmp_path):
+    write(tmp_path, 1, 2, 3)
+    publisher = FakePipelinePublisher(str(tmp_path), [page(1, page(2)), page(3)])
+    pipeline = PublishPipeline(publisher)
+    pipeline.start(['page1', 'page2'])
+
+    time.sleep(0.1)
+    assert publisher.published == [3]
+    write(tmp_path, 1)
+    pipeline.written()
+    for _ in range(100):
+        if len(publisher.published) == 2:
+            break
+        time.sleep(0.01)
+    assert sorted(publisher.published) == [1, 3]
+
+    # page2 was not written again, it is published from its existing file
+    results = pipeline.finish()
+    assert statuses(results) == {1: 'published', 2: 'published', 3: 'published'}
+
+
+def test_pipeline_fails_pages_that_were_never_written(tmp_path):
+    write(tmp_path, 1)
+    publisher = FakePipelinePublisher(str(tmp_path), [page(1, page(2, page(4))), page(3)])
+    pipeline = PublishPipeline(publisher)
+    pipeline.start(['page1', 'page2', 'page3'])
+    write(tmp_path, 1)
+
+    with pytest.raises(PublishError) as error:
+        pipeline.finish()
+    assert statuses(error.value.results) == {1: 'published', 2: 'failed', 3: 'failed', 4: 'skipped'}
+    assert sorted(publisher.published) == [1]
+
+
+def test_pipeline_finish_times_out(tmp_path):
+    write(tmp_path, 1, 2)
+    publisher = FakePipelinePublisher(str(tmp_path), [page(1, page(2))])
+    publisher.release.clear()
+    pipeline = PublishPipeline(publisher, timeout=0.2)
+    pipeline.start([])
+
+    start = time.time()
+    with pytest.raises(PublishError):
+        pipeline.finish()
+    assert time.time() - start < 1
+    publisher.release.set()
+    assert pipeline.join(5)
+    assert statuses(pipeline.results) == {1: 'published', 2: 'skipped'}
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+import os
+
+import pytest
+
+from docutils import nodes
+
+from sphinx_confluence import find_reference_page, fix_references, target_docname
+from sphinx_confluence.pages import PageIndex
+from sphinx_confluence.references import (
+    ReferenceResolver, count_targets, page_prefix, resolve_reference, viewcode_anchor)
+
+VIEWCODE_URI = 'https://bitbucket.example.com/projects/P/repos/r/browse/pkg/mod.py#Widget/#pkg.mod.Widget'
+
+
+class FakeBuilder(object):
+    link_suffix = ''
+
+    @staticmethod
+    def get_target_uri(docname, typ=None):
+        # the json and confluence builders
+        if docname == 'index':
+            return ''
+        if docname.endswith('/index'):
+            return docname[:-5]
+        return docname + '/'
+
+
+class FakeEnv(object):
+    found_docs = set(['index', 'intro', 'guide/index', 'guide/setup', 'guide/usage'])
+
+
+class FakeApp(object):
+    srcdir = os.path.abspath('docs')
+    builder = FakeBuilder()
+    env = FakeEnv()
+
+
+class FakeConfluenceBuilder(FakeBuilder):
+    name = 'confluence'
+
+    def __init__(self, env):
+        self.env = env
+
+
+class FakeConfig(object):
+    def __init__(self, pages):
+        self.sphinx_confluence_pages = pages
+
+
+class FakeSplitApp(FakeApp):
+    def __init__(self, pages, parts):
+        self.env = FakeEnv()
+        self.env._confluence_parts = parts
+        self.builder = FakeConfluenceBuilder(self.env)
+        self.config = FakeConfig(pages)
+
+
+@pytest.mark.parametrize('docname, uri, expected', [
+    ('index', 'intro/', 'intro'),
+    ('index', 'guide/', 'guide/index'),
+    ('intro', '../guide/setup/', 'guide/setup'),
+    ('guide/setup', '../usage/', 'guide/usage'),
+    ('guide/setup', '../', 'guide/index'),
+    ('guide/setup', '../../intro/', 'intro'),
+    ('guide/index', 'setup/', 'guide/setup'),
+    ('guide/setup', '../missing/', None),
+])
+def test_target_docname(docname, uri, expected):
+    assert target_docname(FakeApp(), docname, uri) == expected
+
+
+def test_find_reference_page():
+    pages = [{'source': 'docs/intro', 'local_path': os.path.abspath('docs/intro')},
+             {'source': 'guide/setup', 'local_path': os.path.abspath('elsewhere/guide/setup')}]
+    index = PageIndex(pages)
+    assert find_reference_page(FakeApp(), index, 'guide/usage', '../../intro/') is pages[0]
+    # by docname, wherever config.yml sources are relative to
+    assert find_reference_page(FakeApp(), index, 'intro', '../guide/setup/') is pages[1]
+    # relative to the current directory, as before
+    assert find_reference_page(FakeApp(), index, 'index', 'docs/intro') is pages[0]
+    assert find_reference_page(FakeApp(), index, 'intro', '../guide/usage/') is None
+
+
+def test_page_prefix():
+    assert page_prefix('My Page Title') == '#MyPageTitle-'
+
+
+def test_viewcode_anchor():
+    assert viewcode_anchor('', 'pkg.mod#pkg.mod.Widget') is None
+    assert viewcode_anchor(None, 'pkg.mod#pkg.mod.Widget') == 'pkg.mod.Widget'
+    assert viewcode_anchor(None, None) is None
+
+
+@pytest.mark.parametrize('args, expected', [
+    (('My Page', None, 'sec', True, None, None), ('#MyPage-sec', ())),
+    ((None, None, 'sec', True, None, None), ('sec', ())),
+    (('My Page', 'https://example.com/', None, False, None, None), ('https://example.com/', ())),
+    (('My Page', 'other/#sec', None, False, None, ('/display/S/Other', 'Other')), ('/display/S/Other#Other-sec', ())),
+    (('My Page', 'other/', None, False, 'Other#sec', ('/display/S/Other', 'Other')),
+     ('/display/S/Other#Other-sec', ())),
+    (('My Page', 'other/', None, False, None, ('/display/S/Other', 'Other')), ('/display/S/Other#Other-', ())),
+])
+def test_resolve_reference(args, expected):
+    assert resolve_reference(*args) == expected
+
+
+def test_resolve_viewcode_reference():
+    href, anchors = resolve_reference('My Page', VIEWCODE_URI, None, True, None, None)
+    assert href == VIEWCODE_URI.rsplit('/', 1)[0]
+    assert len(anchors) == 2 and anchors[-1] == 'pkg.mod.Widget'
+    # a partial render gets no page prefix and leaves the link alone
+    assert resolve_reference(None, VIEWCODE_URI, None, False, None, None) == (VIEWCODE_URI, ())
+
+
+def test_reference_resolver_caches_distinct_references():
+    resolver = ReferenceResolver()
+    section = nodes.reference('', '', refid='sec', internal=True)
+    other = nodes.reference('', '', refuri='other/#sec',
+                            refpage={'server_path': '/display/S/Other', 'short_title': 'Other'})
+
+    for _ in range(3):
+        assert resolver.resolve_node(section, 'My Page') == ('#MyPage-sec', ())
+        assert resolver.resolve_node(other.deepcopy(), 'My Page') == ('/display/S/Other#Other-sec', ())
+    assert resolver.resolve_node(section, 'Other Page') == ('#OtherPage-sec', ())
+    info = resolver.cache_info()
+    assert (info.hits, info.misses) == (4, 3)
+
+
+def test_reference_resolver_cache_size():
+    assert ReferenceResolver().cache_info().maxsize == ReferenceResolver.min_cache_size
+    assert ReferenceResolver(10000).cache_info().maxsize == 10000 * ReferenceResolver.entries_per_target
+
+
+def test_count_targets(build):
+    app = build('confluence')
+    env = app.builder.env
+    labels = len(env.domaindata['std']['labels'])
+    assert count_targets(env) >= len(env.found_docs) + labels
+
+
+def test_fix_references_to_split_documents():
+    pages = [{'source': 'intro', 'local_path': os.path.abspath('intro'), 'server_path': '/display/S/Intro',
+              'short_title': 'Intro', 'title': 'Intro'},
+             {'source': 'guide/setup', 'local_path': os.path.abspath('guide/setup'),
+              'server_path': '/display/S/Setup', 'short_title': 'Setup', 'title': 'Setup'}]
+    parts = {'guide/setup': [{'docname': 'guide/setup.part1', 'title': 'Setup - Install', 'section': 'install',
+                              'section_ids': ['install'], 'ids': ['install', 'requirements']}]}
+    doctree = nodes.document(None, None)
+    moved = nodes.reference('', '', refuri='../guide/setup/#requirements')
+    section = nodes.reference('', '', refuri='../guide/setup/#install')
+    kept = nodes.reference('', '', refuri='../guide/setup/#usage')
+    doctree.extend([moved, section, kept])
+
+    fix_references(FakeSplitApp(pages, parts), doctree, 'intro')
+    assert moved['refpage']['part_title'] == 'Setup - Install'
+    assert moved['refpage']['part_anchor'] == 'requirements'
+    assert (section['refpage']['part_title'], section['refpage']['part_anchor']) == ('Setup - Install', None)
+    assert kept['refpage'] == {'server_path': '/display/S/Setup', 'short_title': 'Setup', 'title': 'Setup'}
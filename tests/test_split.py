@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+from docutils import nodes
+from docutils.core import publish_doctree
+
+from sphinx_confluence import split
+
+SOURCE = u'''
+Title
+=====
+
+.. _intro:
+
+intro
+
+.. _label:
+
+First
+-----
+
+text `Second`_
+
+Sub
+~~~
+
+.. _other:
+
+Second
+------
+
+more
+'''
+
+
+def doctree(source=SOURCE):
+    document = publish_doctree(source, settings_overrides={'doctitle_xform': False, 'report_level': 5})
+    toc = nodes.raw('', '<toc/>', format='html')
+    toc['toc'] = True
+    document[0].insert(1, toc)
+    return document
+
+
+def parts(document, level=2):
+    return split.find_parts('doc', document, level, '{page} - {section}', 'Title')
+
+
+def targets(document):
+    return [target['refid'] for target in document.traverse(nodes.target)]
+
+
+def tocs(document):
+    return [raw for raw in document.traverse(nodes.raw) if raw.get('toc')]
+
+
+def test_find_parts():
+    assert parts(doctree()) == [
+        {'docname': 'doc.part1', 'title': 'Title - First', 'section': 'first', 'section_ids': ['first', 'label'],
+         'ids': ['first', 'label', 'sub']},
+        {'docname': 'doc.part2', 'title': 'Title - Second', 'section': 'second', 'section_ids': ['second', 'other'],
+         'ids': ['second', 'other']},
+    ]
+    assert [part['title'] for part in parts(doctree(), 3)] == ['Title - Sub']
+
+
+def test_document_size():
+    document = doctree()
+    size = split.document_size(document)
+    assert abs(size - len(str(document).encode('utf-8'))) < size // 10
+    assert split.document_size(document, 100) < size
+    assert split.document_size(document, 100) > 100
+
+
+def test_split_doctree():
+    document = doctree()
+    documents = split.split_doctree(document, parts(document))
+    assert [(part['docname'], [section['ids'][0] for section in page.traverse(nodes.section)])
+            for part, page in documents] == [('doc.part1', ['first', 'sub']), ('doc.part2', ['second'])]
+    assert [section['ids'][0] for section in document.traverse(nodes.section)] == ['title']
+
+    # no anchors for ids on another page, no table of contents without sections
+    assert targets(document) == ['intro']
+    assert targets(documents[0][1]) == []
+    assert tocs(document) == []
+
+
+def test_split_doctree_keeps_toc_of_remaining_sections():
+    document = doctree()
+    documents = split.split_doctree(document, parts(document)[1:])
+    assert [part['docname'] for part, page in documents] == ['doc.part2']
+    assert targets(document) == ['intro', 'label']
+    assert len(tocs(document)) == 1
+
+
+def test_split_doctree_without_parts():
+    document = doctree()
+    before = str(document)
+    assert split.split_doctree(document, []) == []
+    assert str(document) == before
+
+
+def test_part_links():
+    assert split.part_links(None) == {}
+    assert split.part_links(parts(doctree())) == {
+        'first': ('Title - First', None),
+        'label': ('Title - First', None),
+        'sub': ('Title - First', 'sub'),
+        'second': ('Title - Second', None),
+        'other': ('Title - Second', None),
+    }
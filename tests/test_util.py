@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+import io
+
+import pytest
+
+from sphinx_confluence.util import JSONStore, StreamingBody
+
+
+def test_streaming_body_keeps_absolute_indexes():
+    stream = io.StringIO()
+    body = StreamingBody(stream, buffer_size=4)
+    body.extend(['<p>', 'a', '</p>'])
+    position = len(body)
+    body.append('<p>')
+    body.flush()
+
+    assert stream.getvalue() == '<p>a</p>'
+    assert len(body) == 4
+    assert body[position] == '<p>'
+    body.insert(position, '<div>')
+    assert body[position:] == ['<div>', '<p>']
+    with pytest.raises(IndexError):
+        body[0]
+    with pytest.raises(IndexError):
+        body[1:]
+
+    body.close()
+    assert stream.getvalue() == '<p>a</p><div><p>'
+    assert body.written == len(stream.getvalue())
+
+
+def test_streaming_body_flushes_when_full():
+    stream = io.StringIO()
+    body = StreamingBody(stream, buffer_size=4)
+    body.append('ab')
+    body.flush_if_full()
+    assert stream.getvalue() == ''
+    body.append('cdef')
+    body.append('g')
+    body.flush_if_full()
+    assert stream.getvalue() == 'abcdef'
+    assert body.size == 1
+    assert body.peak_buffered_chars == 7
+
+
+def test_streaming_body_counts_characters():
+    body = StreamingBody(io.StringIO())
+    body.append(u'äö')
+    body[-1] = u'ä'
+    assert body.size == 1
+    assert body.pop() == u'ä'
+    assert body.size == 0
+    assert body.peak_buffered_chars == 2
+    body.append(u'ü')
+    body.close()
+    assert body.written == 2
+
+
+class Store(JSONStore):
+    filename = 'store.json'
+
+
+def test_json_store_round_trip(tmp_path):
+    store = Store(str(tmp_path))
+    assert store.entries == {}
+    store.entries['a'] = {'b': [1, 2]}
+    store.save()
+    assert not (tmp_path / 'store.json.tmp').exists()
+    assert Store(str(tmp_path / 'store.json')).entries == {'a': {'b': [1, 2]}}
+
+    (tmp_path / 'store.json').write_text(u'{broken')
+    assert Store(str(tmp_path)).entries == {}
@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+import inspect
+import os
+import sys
+import textwrap
+import time
+
+import pytest
+
+from sphinx.highlighting import PygmentsBridge
+from sphinx.pycode import ModuleAnalyzer
+
+from sphinx_confluence.ext.viewcode import (
+    HighlightCache, ImportPool, ModuleRecord, SourceLineTable, _get_full_modname, env_merge_info, find_module_file,
+    get_module_record)
+
+
+@pytest.fixture
+def package(tmp_path, monkeypatch):
+    root = tmp_path / 'vcpkg'
+    (root / 'sub').mkdir(parents=True)
+    files = {
+        '__init__.py': '''
+            from ._impl import Widget
+            from ._impl import helper as renamed
+            from . import sub
+            from .star import *
+            import vcpkg.sub.leaf as leaf
+        ''',
+        '_impl.py': '''
+            import os
+
+
+            class Widget(object):
+
+                def method(self):
+                    pass
+
+
+            def helper():
+                pass
+        ''',
+        'star.py': '''
+            def starred():
+                pass
+        ''',
+        'sub/__init__.py': '''
+            from .leaf import *
+        ''',
+        'sub/leaf.py': '''
+            def func():
+                pass
+        ''',
+    }
+    for name, code in files.items():
+        (root / name).write_text(textwrap.dedent(code).lstrip())
+    monkeypatch.syspath_prepend(str(tmp_path))
+    return root
+
+
+def test_find_module_file(package):
+    assert find_module_file('vcpkg') == str(package / '__init__.py')
+    assert find_module_file('vcpkg.sub.leaf') == str(package / 'sub' / 'leaf.py')
+    assert find_module_file('vcpkg.missing') is None
+
+
+@pytest.mark.parametrize('modname, attribute, expected', [
+    ('vcpkg._impl', 'Widget', ('vcpkg._impl', 4)),
+    ('vcpkg', 'Widget', ('vcpkg._impl', 4)),
+    ('vcpkg', 'Widget.method', ('vcpkg._impl', 6)),
+    ('vcpkg', 'renamed', ('vcpkg._impl', 10)),
+    ('vcpkg', 'starred', ('vcpkg.star', 1)),
+    ('vcpkg', 'sub.func', ('vcpkg.sub.leaf', 1)),
+    ('vcpkg', 'leaf.func', ('vcpkg.sub.leaf', 1)),
+    ('vcpkg.sub', 'leaf.func', ('vcpkg.sub.leaf', 1)),
+    ('vcpkg', 'missing', None),
+    ('vcpkg.missing', 'Widget', None),
+])
+def test_find_static(package, modname, attribute, expected):
+    assert SourceLineTable(static=True).find_static(modname, attribute) == expected
+
+
+def test_find_static_does_not_import(package):
+    import sys
+    SourceLineTable(static=True).find_static('vcpkg', 'Widget.method')
+    assert 'vcpkg' not in sys.modules
+
+
+def test_find_static_stops_on_import_cycles(tmp_path, monkeypatch):
+    root = tmp_path / 'cycle'
+    root.mkdir()
+    (root / '__init__.py').write_text(u'from .a import *\n')
+    (root / 'a.py').write_text(u'from .b import *\n')
+    (root / 'b.py').write_text(u'from .a import *\n')
+    monkeypatch.syspath_prepend(str(tmp_path))
+    assert SourceLineTable(static=True).find_static('cycle', 'nothing') is None
+
+
+def test_highlight_cache(tmp_path):
+    code = u'def func():\n    return 1\n'
+    cache = HighlightCache(str(tmp_path))
+    highlighter = PygmentsBridge('html', 'sphinx')
+    highlighted = cache.highlight(highlighter, code, 'python')
+    assert highlighted == highlighter.highlight_block(code, 'python', linenos=False)
+
+    cache = HighlightCache(str(tmp_path))
+    assert cache.highlight(highlighter, code, 'python') == highlighted
+    assert cache.hits == 1
+
+    cache = HighlightCache(str(tmp_path))
+    cache.prune()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_highlight_cache_key_covers_settings(tmp_path):
+    code = u'x = 1\n'
+    sphinx_style = PygmentsBridge('html', 'sphinx')
+    keys = set([
+        HighlightCache(str(tmp_path)).key(sphinx_style, code, 'python'),
+        HighlightCache(str(tmp_path)).key(sphinx_style, code, 'python3'),
+        HighlightCache(str(tmp_path)).key(sphinx_style, code + u'\n', 'python'),
+        HighlightCache(str(tmp_path)).key(PygmentsBridge('html', 'monokai'), code, 'python'),
+        HighlightCache(str(tmp_path), {'highlight_options': {'stripnl': False}}).key(sphinx_style, code, 'python'),
+        HighlightCache(str(tmp_path), {'pygments_style': 'monokai'}).key(sphinx_style, code, 'python'),
+    ])
+    assert len(keys) == 6
+    assert HighlightCache(str(tmp_path)).key(PygmentsBridge('html', 'sphinx'), code, 'python') in keys
+
+
+@pytest.fixture
+def slow_modules(tmp_path, monkeypatch):
+    for name, delay in (('vc_ok', 0), ('vc_hang1', 60), ('vc_hang2', 60), ('vc_slow', 0.3)):
+        (tmp_path / (name + '.py')).write_text(textwrap.dedent(u'''
+            import time
+            time.sleep({})
+
+
+            def func():
+                pass
+        ''').format(delay))
+    monkeypatch.syspath_prepend(str(tmp_path))
+
+
+def test_import_pool_resolves_in_workers(slow_modules):
+    import sys
+    table = SourceLineTable(static=True)
+    pool = ImportPool(2, timeout=10)
+    try:
+        pool.resolve(table, [('vc_ok', 'func'), ('vc_ok', 'missing'), ('vc_slow', 'func'), (None, 'func')])
+    finally:
+        pool.close()
+    assert table.resolved == {('vc_ok', 'func'): ('vc_ok', 6), ('vc_ok', 'missing'): None,
+                              ('vc_slow', 'func'): ('vc_slow', 6)}
+    assert 'vc_ok' not in sys.modules
+    assert pool.pool is None
+
+
+def test_import_pool_deadline_per_module(slow_modules):
+    table = SourceLineTable(static=True)
+    pool = ImportPool(2, timeout=1)
+    start = time.time()
+    try:
+        pool.resolve(table, [('vc_hang1', 'func'), ('vc_hang2', 'func'), ('vc_ok', 'func'), ('vc_slow', 'func')])
+    finally:
+        pool.close()
+    # both hanging modules time out together, the others are not charged for them
+    assert time.time() - start < 1.9
+    assert table.resolved == {('vc_hang1', 'func'): None, ('vc_hang2', 'func'): None,
+                              ('vc_ok', 'func'): ('vc_ok', 6), ('vc_slow', 'func'): ('vc_slow', 6)}
+
+
+class FakeBuilder(object):
+    def __init__(self, table):
+        self._viewcode_lines = table
+
+
+class FakeApp(object):
+    def __init__(self, static=True):
+        self.builder = FakeBuilder(SourceLineTable(static=static))
+
+
+class FakeEnv(object):
+    def __init__(self, modules=None):
+        self._viewcode_modules = modules if modules is not None else {}
+
+
+def analyzer_calls(monkeypatch, factory='for_file'):
+    """
+    Modules a ``ModuleAnalyzer`` is created for, through ``for_file`` (static
+    lookups) or ``for_module``
+    """
+    calls = []
+    create = getattr(ModuleAnalyzer, factory)
+
+    def counting(*args):
+        calls.append(args[-1])
+        return create(*args)
+
+    monkeypatch.setattr(ModuleAnalyzer, factory, staticmethod(counting))
+    # analyzers are cached for the lifetime of the process, a build starts with none
+    monkeypatch.setattr(ModuleAnalyzer, 'cache', {})
+    return calls
+
+
+def test_module_record_is_checked_once_per_build(package, monkeypatch):
+    calls = analyzer_calls(monkeypatch)
+    app, env = FakeApp(), FakeEnv()
+    record = get_module_record(app, env, 'vcpkg._impl', 'vcpkg._impl')
+    assert record.path == str(package / '_impl.py')
+    assert record.tags['Widget'][1] == 4
+    assert get_module_record(app, env, 'vcpkg._impl', 'vcpkg._impl') is record
+    assert env._viewcode_modules == {'vcpkg._impl': record}
+    assert calls == ['vcpkg._impl']
+
+
+def test_module_record_is_kept_while_the_source_is_unchanged(package, monkeypatch):
+    calls = analyzer_calls(monkeypatch)
+    env = FakeEnv()
+    record = get_module_record(FakeApp(), env, 'vcpkg._impl', 'vcpkg._impl')
+    record.used.update({'Widget': 'widgets', 'helper': 'helpers'})
+
+    # unchanged mtime: the source is not read again
+    assert get_module_record(FakeApp(), env, 'vcpkg._impl', None) is record
+    assert calls == ['vcpkg._impl']
+
+    # touched but unchanged: read, but the record is kept
+    path = str(package / '_impl.py')
+    os.utime(path, (record.mtime + 10, record.mtime + 10))
+    assert get_module_record(FakeApp(), env, 'vcpkg._impl', None) is record
+    assert record.mtime == os.stat(path).st_mtime
+    assert len(calls) == 2
+
+    # changed: parsed again, keeping the documents of objects that still exist
+    source = (package / '_impl.py').read_text()
+    (package / '_impl.py').write_text(source.replace('def helper', 'def other'))
+    ModuleAnalyzer.cache.clear()
+    os.utime(path, (record.mtime + 20, record.mtime + 20))
+    changed = get_module_record(FakeApp(), env, 'vcpkg._impl', None)
+    assert changed is not record
+    assert 'other' in changed.tags and 'helper' not in changed.tags
+    assert changed.used == {'Widget': 'widgets'}
+    assert changed.refname == 'vcpkg._impl'
+    assert env._viewcode_modules['vcpkg._impl'] is changed
+
+
+def test_module_record_of_unanalyzable_module(package):
+    env = FakeEnv()
+    assert get_module_record(FakeApp(), env, 'vcpkg.missing', 'vcpkg.missing') is None
+    assert env._viewcode_modules == {'vcpkg.missing': False}
+    assert get_module_record(FakeApp(), env, 'vcpkg.missing', 'vcpkg.missing') is None
+
+
+def record(hash, **used):
+    entry = ModuleRecord('mod.py', 1.0, hash, {}, 'mod')
+    entry.used.update(used)
+    return entry
+
+
+def test_env_merge_info():
+    same, changed, analyzed = record('a', func='doc1'), record('a', other='doc3'), record('a')
+    env = FakeEnv({'same': same, 'changed': changed, 'failed': analyzed})
+    worker = FakeEnv({'same': record('a', cls='doc2'), 'changed': record('b', cls='doc2'), 'failed': False,
+                      'new': False})
+    worker._viewcode_modules['same'].mtime = 2.0
+
+    env_merge_info(None, env, ['doc2'], worker)
+    modules = env._viewcode_modules
+    # records of the same source are merged, a different source replaces them
+    assert modules['same'] is same
+    assert same.used == {'func': 'doc1', 'cls': 'doc2'}
+    assert same.mtime == 2.0
+    assert modules['changed'] is worker._viewcode_modules['changed']
+    # a module a worker could not analyze does not replace a record
+    assert modules['failed'] is analyzed
+    assert modules['new'] is False
+
+
+@pytest.fixture
+def decorated(tmp_path, monkeypatch):
+    (tmp_path / 'vcdeco.py').write_text(textwrap.dedent(u'''
+        import functools
+
+
+        def wrapped(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                return func(*args, **kwargs)
+            return wrapper
+
+
+        def unwrapped(func):
+            def wrapper(*args, **kwargs):
+                return func(*args, **kwargs)
+            return wrapper
+
+
+        @wrapped
+        def plain():
+            pass
+
+
+        @unwrapped
+        def hidden():
+            pass
+
+
+        class Widget(object):
+
+            @wrapped
+            def method(self):
+                pass
+
+            @staticmethod
+            def static():
+                pass
+
+            class Inner(object):
+                def deep(self):
+                    pass
+    '''))
+    monkeypatch.syspath_prepend(str(tmp_path))
+    yield
+    sys.modules.pop('vcdeco', None)
+
+
+def test_full_modname_analyzes_every_module_once(decorated, monkeypatch):
+    calls = analyzer_calls(monkeypatch, 'for_module')
+    app = FakeApp(static=False)
+    attributes = ['plain', 'hidden', 'wrapped', 'Widget', 'Widget.method', 'Widget.static', 'Widget.Inner',
+                  'Widget.Inner.deep']
+    for attribute in attributes:
+        value = __import__('vcdeco')
+        for name in attribute.split('.'):
+            value = getattr(value, name)
+        # the same lines as inspect, also for decorated objects
+        assert _get_full_modname(app, 'vcdeco', attribute) == ('vcdeco', inspect.getsourcelines(value)[1])
+        assert _get_full_modname(app, 'vcdeco', attribute) == ('vcdeco', inspect.getsourcelines(value)[1])
+    assert calls == ['vcdeco']